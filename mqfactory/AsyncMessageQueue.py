@@ -0,0 +1,194 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+from mqfactory.MessageQueue  import MessageQueue
+from mqfactory.Queue         import Queue
+from mqfactory.message       import Message
+from mqfactory.transport.aio import call
+
+# an asyncio variant of the MessageQueue, using an AsyncTransport. hooks and
+# handlers can be plain functions or coroutine functions, so the existing
+# aspects (Acknowledging, Signing, Persisting,...) can be applied unchanged.
+# many MQs can be run as tasks on a single event loop, using `await mq.run()`.
+
+class Completed(object):
+  def __await__(self):
+    return iter([])
+
+# asyncio primitives are bound to an event loop when created, on older Pythons,
+# so they are only created once the loop is running. this allows setting up
+# MQs before starting the loop, e.g. using `asyncio.run(main())`. until then,
+# the activity event only keeps track of being set.
+
+class Activity(object):
+  def __init__(self):
+    self.event   = None
+    self.flagged = False
+
+  def bind(self):
+    self.event = asyncio.Event()
+    if self.flagged: self.event.set()
+
+  def set(self):
+    self.flagged = True
+    if self.event: self.event.set()
+
+  def clear(self):
+    self.flagged = False
+    if self.event: self.event.clear()
+
+  def is_set(self):
+    return self.flagged
+
+  def wait(self):
+    if self.event is None: self.bind()
+    return self.event.wait()
+
+# messages received on a subscription without a handler are delivered to the
+# inbox stream, which can be consumed using `async for message in mq.inbox`.
+
+class AsyncQueue(Queue):
+  def __init__(self, name="queue", event=None):
+    super(AsyncQueue, self).__init__(name, event=event)
+    self.stream = None
+
+  @property
+  def delivered(self):
+    if self.stream is None: self.stream = asyncio.Queue()
+    return self.stream
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    return await self.delivered.get()
+
+async def wrap_all(messages, wrappers):
+  failed = []
+  for wrapper in wrappers:
+    done = []
+    for message in messages:
+      try:
+        await call(wrapper, message)
+        done.append(message)
+      except Exception as e:
+        failed.append((message, e))
+    messages = done
+  return messages, failed
+
+class AsyncMessageQueue(MessageQueue):
+  Inbox = AsyncQueue
+
+  def __init__(self, transport, name="mq", backoff=None, interval=0.001):
+    self.interval = interval
+    self.running  = False
+    super(AsyncMessageQueue, self).__init__(transport, name, backoff)
+
+  def event(self):
+    return Activity()
+
+  # the transport is connected when running the MQ
+
+  def connect(self):
+    pass
+
+  # sending only adds the message to the outbox, the returned object can be
+  # awaited, but hooks that call send synchronously (e.g. acks) work as well.
+  # a full outbox never blocks the event loop, which is emptying it.
+
+  def send(self, to, payload, tags=None):
+    self.outbox.add(Message(to, payload, tags), timeout=0)
+    return Completed()
+
+  def on_message(self, to, handler=None):
+    super(AsyncMessageQueue, self).on_message(to, handler)
+
+  async def process_outbox(self, max_batch=1):
+    return await self.process(
+      self.outbox, self.deliver_outgoing,
+      self.before_sending, self.after_sending, max_batch
+    )
+
+  async def process_inbox(self, max_batch=1):
+    return await self.process(
+      self.inbox, self.deliver_incoming,
+      self.before_handling[::-1], self.after_handling[::-1], max_batch
+    )
+
+  async def send_and_receive(self, max_batch=1):
+    sent     = await self.process_outbox(max_batch)
+    received = await self.process_inbox(max_batch)
+    return sent or received
+
+  async def deliver_outgoing(self, messages):
+    if len(messages) < 2:
+      failed = []
+      for message in messages:
+        try:
+          await self.transport.send(message)
+        except Exception as e:
+          failed.append((message, e))
+    else:
+      failed = await self.transport.send_all(messages) or []
+    failing = set(id(message) for message, _ in failed)
+    return [ msg for msg in messages if not id(msg) in failing ], failed
+
+  async def deliver_incoming(self, messages):
+    done, failed = [], []
+    for message in messages:
+      try:
+        await self.handle(message)
+        done.append(message)
+      except Exception as e:
+        failed.append((message, e))
+    return done, failed
+
+  # subscriptions without a handler deliver messages to the inbox stream, once
+
+  async def handle(self, message):
+    handled = message.private.setdefault("handled", [])
+    for to, handler in self.handlers_for(message):
+      if to in handled: continue
+      if handler is None:
+        if not None in handled: self.inbox.delivered.put_nowait(message)
+        handled.append(None)
+      else:
+        await call(handler, message)
+      handled.append(to)
+
+  async def process(self, box, deliver, before, after, max_batch=1):
+    messages = box.take(max_batch)
+    if not messages: return False
+    return await self.process_messages(box, messages, deliver, before, after)
+
+  async def process_messages(self, box, messages, deliver, before, after):
+    for message in messages:
+      logger.debug("{0}: processing {1}".format(box.name, message))
+    messages, failed   = await wrap_all(messages, before)
+    messages, failures = await deliver(messages)
+    failed.extend(failures)
+    messages, failures = await wrap_all(messages, after)
+    failed.extend(failures)
+    return self.settle(box, messages, failed)
+
+  async def run(self, max_batch=1):
+    self.activity.bind()
+    await self.transport.connect()
+    self.running = True
+    while self.running:
+      self.activity.clear()
+      if await self.send_and_receive(max_batch):
+        await asyncio.sleep(0)  # give other tasks a chance
+        continue
+      timeout = self.idle()
+      if timeout == 0: timeout = self.interval  # due message(s) failed
+      try:
+        await asyncio.wait_for(self.activity.wait(), timeout)
+      except asyncio.TimeoutError:
+        pass
+
+  def stop(self):
+    self.running = False
+    self.activity.set()
@@ -3,91 +3,316 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-import inspect
+from threading import Thread, Event, local
 
-from threading import Thread
-
-from mqfactory.tools   import wrap
-from mqfactory.message import Message
-from mqfactory.Queue   import Queue
+from mqfactory.tools     import clock, apply, wrap, wrap_all, TopicTrie
+from mqfactory.message   import Message
+from mqfactory.Queue     import Queue, DROP_OLDEST
+from mqfactory.transport import is_transport_failure
 
 # a defer exception will skip sending a message and schedule it again at the
-# end of the outbox
+# end of the outbox, optionally only making it available again at a given time
 
 class DeferException(Exception):
+  def __init__(self, until=None):
+    super(DeferException, self).__init__()
+    self.until = until
+
+# a drop exception, raised before adding a received message to the inbox, e.g.
+# for a duplicate, silently discards the message
+
+class DropException(Exception):
   pass
 
+# messages that fail to be processed are retried after an exponentially growing
+# delay. after a given number of attempts, they are moved to the dead letters.
+# transport failures aren't counted as attempts, so outgoing messages are kept
+# until the transport is able to send them again.
+
+class Backoff(object):
+  def __init__(self, attempts=5, delay=100, factor=2, maximum=60000):
+    self.attempts = attempts
+    self.delay    = delay
+    self.factor   = factor
+    self.maximum  = maximum
+
+  def exhausted(self, attempts):
+    return not self.attempts is None and attempts >= self.attempts
+
+  def __call__(self, attempts):
+    return min(self.maximum, self.delay * self.factor ** (attempts - 1))
+
 # the top-level message queue object
 
 class MessageQueue(object):
-  def __init__(self, transport, name="mq"):
+  Inbox = Queue
+
+  def __init__(self, transport, name="mq", backoff=None):
     self.transport       = transport
     self.name            = name
-    self.inbox           = Queue(self.name + "-inbox")
-    self.outbox          = Queue(self.name + "-outbox")
+    self.backoff         = backoff or Backoff()
+    self.activity        = self.event()
+    self.inbox           = self.Inbox(self.name + "-inbox", event=self.activity)
+    self.outbox          = Queue(self.name + "-outbox", event=self.activity)
+    self.dead            = Queue(self.name + "-dead")
     self.before_sending  = []
     self.after_sending   = []
     self.handlers        = {}
+    self.subscriptions   = TopicTrie()
     self.before_handling = []
     self.after_handling  = []
+    self.pool            = None
+    self.local           = local()
+    self.connect()
+
+  # variants can provide their own kind of event and connect differently
+
+  def event(self):
+    return Event()
+
+  def connect(self):
     self.transport.connect()
 
-  def send(self, to, payload, tags=None):
+  # sending from within processing, e.g. an ack, never blocks on a full outbox,
+  # since that would block the thread that is emptying it
+
+  def send(self, to, payload, tags=None, timeout=None):
     msg = Message(to, payload, tags)
-    self.outbox.add(msg)
+    if getattr(self.local, "processing", False): timeout = 0
+    return self.outbox.add(msg, timeout=timeout)
+
+  # subscribes to the transport once per subscription, subscribing again only
+  # replaces the handler. all subscriptions share a single callback, which the
+  # transport calls once per incoming message, so it is added to the inbox once.
 
   def on_message(self, to, handler):
+    subscribed = to in self.handlers
     self.handlers[to] = handler
-    def store_to_inbox(message):
-      message.private["handler"] = to
+    if subscribed: return
+    self.subscriptions.add(to, (len(self.handlers), to))
+    self.transport.on_message(to, self.store_to_inbox)
+
+  def store_to_inbox(self, message):
+    message.private["subscriptions"] = self.subscriptions_for(message.to)
+    try:
       self.inbox.add(message)
-    self.transport.on_message(to, store_to_inbox)
+    except DropException:
+      logger.debug("{0}: dropped {1}".format(self.inbox.name, message.id))
+
+  def process_outbox(self, max_batch=1):
+    return self.process(
+      self.outbox, self.deliver_outgoing,
+      self.before_sending, self.after_sending, max_batch
+    )
 
-  def process_outbox(self):
-    self.process(
-      self.outbox, self.transport,
-      self.before_sending, self.after_sending
+  def process_inbox(self, max_batch=1):
+    if self.pool:
+      messages = self.inbox.take(max_batch)
+      for message in messages: self.pool.submit(message)
+      return len(messages) > 0
+    return self.process(
+      self.inbox, self.deliver_incoming,
+      self.before_handling[::-1], self.after_handling[::-1], max_batch
     )
 
-  def process_inbox(self):
-    self.process(
-      self.inbox, self.handlers,
+  def send_and_receive(self, max_batch=1):
+    sent     = self.process_outbox(max_batch)
+    received = self.process_inbox(max_batch)
+    return sent or received
+
+  # returns the time in seconds until the next message is due, or None if there
+  # are no messages at all
+
+  def idle(self):
+    dues = [ due for due in [ self.outbox.due(), self.inbox.due() ] \
+                 if not due is None ]
+    if not dues: return None
+    return max(0, min(dues) - clock.now()) / 1000.0
+
+  def deliver_outgoing(self, messages):
+    if len(messages) < 2:
+      return apply(self.transport.send, messages)
+    failed  = self.transport.send_all(messages) or []
+    failing = set(id(message) for message, _ in failed)
+    return [ msg for msg in messages if not id(msg) in failing ], failed
+
+  def deliver_incoming(self, messages):
+    return apply(self.handle, messages)
+
+  # messages are handled by the handlers of all subscriptions matching them on
+  # arrival, or when that is unknown, e.g. after loading them from a store, when
+  # they are handled, in the order they were subscribed. when a handler fails,
+  # the message is retried with the handlers that didn't handle it yet.
+
+  def handle(self, message, call=None):
+    handled = message.private.setdefault("handled", [])
+    for to, handler in self.handlers_for(message):
+      if to in handled: continue
+      if call is None:
+        handler(message)
+      else:
+        call(handler, message)
+      handled.append(to)
+
+  def handlers_for(self, message):
+    subscriptions = message.private.get("subscriptions") or \
+                    self.subscriptions_for(message.to)
+    if not subscriptions: raise KeyError(message.to)
+    return [ (to, self.handlers[to]) for to in subscriptions ]
+
+  def subscriptions_for(self, to):
+    return [ sub for _, sub in sorted(self.subscriptions.match(to)) ]
+
+  def handle_incoming(self, message, deliver=None):
+    return self.process_messages(
+      self.inbox, [ message ], deliver or self.deliver_incoming,
       self.before_handling[::-1], self.after_handling[::-1]
     )
 
-  def send_and_receive(self):
-    self.process_outbox()
-    self.process_inbox()
+  def process(self, box, deliver, before, after, max_batch=1):
+    messages = box.take(max_batch)
+    if not messages: return False
+    return self.process_messages(box, messages, deliver, before, after)
 
-  def process(self, box, transport, before, after):
-    caller = inspect.getouterframes(inspect.currentframe())[1][3].split("_")[1]
+  def process_messages(self, box, messages, deliver, before, after):
+    for message in messages:
+      logger.debug("{0}: processing {1}".format(box.name, message))
+    self.local.processing = True
     try:
-      message = next(box)
-      logger.debug("{0}: processing {1}".format(caller, message))
-    except StopIteration:
-      return
+      messages, failed   = wrap_all(messages, before)  # defer here avoids sending
+      messages, failures = deliver(messages)
+      failed.extend(failures)
+      messages, failures = wrap_all(messages, after)   # defer here avoids removal
+      failed.extend(failures)
+    finally:
+      self.local.processing = False
+    return self.settle(box, messages, failed)
+
+  # removes processed messages, defers deferred ones and schedules a retry for
+  # failing ones, or moves them to the dead letters after too many attempts
+
+  def settle(self, box, messages, failed):
+    if messages:
+      logger.info("{0}: {1} message(s) processed, removing".format(
+        box.name, len(messages)
+      ))
+      failed.extend(box.remove_all(messages))
+    deferred = [ (message, e.until) for message, e in failed \
+                                    if isinstance(e, DeferException) ]
+    retries  = []
+    for message, e in failed:
+      if isinstance(e, DeferException): continue
+      failures = message.private.get("failures", 0) + 1
+      message.private["failures"] = failures
+      if not is_transport_failure(e):
+        attempts = message.private.get("attempts", 0) + 1
+        message.private["attempts"] = attempts
+        logger.warning("{0}: processing {1} failed ({2} attempts): {3}".format(
+          box.name, str(message), attempts, repr(e)
+        ))
+        if self.backoff.exhausted(attempts):
+          self.bury(box, message, e)
+          continue
+      else:
+        logger.warning("{0}: sending {1} failed: {2}".format(
+          box.name, message.id, repr(e)
+        ))
+      retries.append((message, clock.now() + self.backoff(failures)))
+    # defer will put msg at end of queue
+    for message, e in box.defer_all(deferred + retries):
+      logger.error("{0}: deferring {1} failed: {2}".format(
+        box.name, str(message), repr(e)
+      ))
+      box.release(message)
+    return len(messages) + len(deferred) > 0
+
+  # dead letters are kept in a separate queue, tagged with their origin
+
+  def bury(self, box, message, error):
+    logger.error("{0}: moving {1} to dead letters".format(box.name, message.id))
     try:
-      wrap(message, before) # defer here avoids sending
-      try:
-        transport[message.private["handler"]](message)
-      except KeyError:
-        transport.send(message)
-      wrap(message, after)  # defer here avoids removal
-      logger.info("{0}: message sent, removing".format(caller))
       box.remove(message)
-    except DeferException:
-      box.defer(message)    # defer will put msg at end of queue
     except Exception as e:
-      logger.warning("{0}: processing {0} failed".format(caller, str(message)))
-      logger.exception("message")
-      # TODO: failing messages remain in the queue and might fail forever
-
-def Threaded(mq, interval=0.001):
-  def processor():
-    while True:
-      mq.send_and_receive()
-      time.sleep(interval)
-  t = Thread(target=processor)
-  t.daemon = True
-  t.start()
+      logger.error("{0}: removing {1} failed: {2}".format(
+        box.name, message.id, repr(e)
+      ))
+    message.private.pop("failures", None)
+    message.tags["dead"] = {
+      "box"     : "inbox" if box is self.inbox else "outbox",
+      "handled" : message.private.pop("handled", None),
+      "attempts": message.private.pop("attempts"),
+      "error"   : repr(error)
+    }
+    self.dead.add(message)
+
+  def dead_letters(self):
+    return self.dead.all()
+
+  def replay(self, message=None):
+    messages = self.dead_letters() if message is None else [ message ]
+    for message in messages:
+      self.dead.remove(message)
+      dead = message.tags.pop("dead")
+      if dead.get("handled"): message.private["handled"] = dead["handled"]
+      logger.info("{0}: replaying {1}".format(self.name, message.id))
+      getattr(self, dead["box"]).add(message)
+    return messages
+
+# bounds the outbox (and optionally the inbox) of an MQ, see Queue.limit. the
+# dead letters are unbounded, unless a maximum number of them is given, in
+# which case the oldest ones are dropped.
+
+def Bounded(mq, inbox=False, dead=None, **limits):
+  mq.outbox.limit(**limits)
+  if inbox: mq.inbox.limit(**limits)
+  if dead:  mq.dead.limit(max_messages=dead, overflow=DROP_OLDEST)
+  return mq
+
+# assigns priorities to messages in the outbox and inbox, using a policy on top
+# of explicit "priority" tags, optionally sharing capacity using weights
+
+def Prioritized(mq, policy=None, weights=None):
+  mq.outbox.prioritize(policy=policy, weights=weights)
+  mq.inbox.prioritize(policy=policy, weights=weights)
+  return mq
+
+# a processor runs the processing of an MQ in a separate thread. by default it
+# waits until messages are added or deferred messages become due, optionally
+# it can poll the MQ at a fixed interval. when waiting, the interval is used to
+# pause before retrying messages that failed to be processed.
+
+class Processor(object):
+  def __init__(self, mq, interval=0.001, polling=False, max_batch=1):
+    self.mq        = mq
+    self.interval  = interval
+    self.polling   = polling
+    self.max_batch = max_batch
+    self.running   = True
+    self.thread    = Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def run(self):
+    while self.running:
+      if self.polling:
+        self.mq.send_and_receive(self.max_batch)
+        time.sleep(self.interval)
+        continue
+      self.mq.activity.clear()
+      if self.mq.send_and_receive(self.max_batch): continue
+      timeout = self.mq.idle()
+      if timeout == 0: timeout = self.interval  # due message(s) failed
+      self.mq.activity.wait(timeout)
+
+  def stop(self):
+    self.running = False
+    self.mq.activity.set()
+
+  def join(self, timeout=None):
+    self.thread.join(timeout)
+
+def Threaded(mq, interval=0.001, polling=False, max_batch=1):
+  mq.processor = Processor(
+    mq, interval=interval, polling=polling, max_batch=max_batch
+  )
   return mq
@@ -0,0 +1,134 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+from collections import deque
+from threading   import Thread, Condition
+
+# a pool of workers handles incoming messages outside of the processing thread.
+# messages are routed to a worker based on a key, the topic by default, which
+# guarantees that messages with the same key are handled in order, while
+# messages with different keys are handled in parallel.
+# optionally handlers are executed in a pool of processes. only handlers that
+# are subscribed using `mq.pool.on_message` opt in to this: they need to be
+# picklable and can't change the state of the MQ itself. all other handlers,
+# e.g. those of acks and the inbox stream, are always handled in-process.
+
+class Worker(object):
+  def __init__(self, handle):
+    self.handle    = handle
+    self.messages  = deque()
+    self.condition = Condition()
+    self.busy      = False
+    self.running   = True
+    self.thread    = Thread(target=self.run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, message):
+    with self.condition:
+      self.messages.append(message)
+      self.condition.notify()
+
+  def run(self):
+    while True:
+      with self.condition:
+        while self.running and not self.messages:
+          self.condition.wait()
+        if not self.messages: return
+        message = self.messages.popleft()
+        self.busy = True
+      try:
+        self.handle(message)
+      except Exception:
+        logger.exception("worker: handling {0} failed".format(message.id))
+      finally:
+        self.busy = False
+
+  def stop(self):
+    with self.condition:
+      self.running = False
+      self.condition.notify()
+
+  def join(self, timeout=None):
+    self.thread.join(timeout)
+
+class Pool(object):
+  def __init__(self, mq, workers=4, key=None, processes=None):
+    self.mq        = mq
+    self.key       = key
+    self.processes = processes
+    self.executor  = None
+    self.offloaded = []
+    self.workers   = [ Worker(self.handle) for _ in range(workers) ]
+
+  # the pool of processes is only started once a handler needs it
+
+  def on_message(self, to, handler):
+    assert self.processes, "handling in processes requires a pool of processes"
+    if self.executor is None:
+      from concurrent.futures import ProcessPoolExecutor
+      self.executor = ProcessPoolExecutor(self.processes)
+    self.offloaded.append(handler)
+    self.mq.on_message(to, handler)
+
+  def route(self, message):
+    if self.key is None:
+      key = message.to
+    elif callable(self.key):
+      key = self.key(message)
+    else:
+      key = message.tags.get(self.key, message.to)
+    return self.workers[hash(key) % len(self.workers)]
+
+  def submit(self, message):
+    self.route(message).submit(message)
+
+  def handle(self, message):
+    if self.executor:
+      self.mq.handle_incoming(message, deliver=self.deliver)
+    else:
+      self.mq.handle_incoming(message)
+
+  def deliver(self, messages):
+    done, failed = [], []
+    for message in messages:
+      try:
+        self.mq.handle(message, self.execute)
+        done.append(message)
+      except Exception as e:
+        failed.append((message, e))
+    return done, failed
+
+  def execute(self, handler, message):
+    if handler in self.offloaded:
+      self.executor.submit(handler, message).result()
+    else:
+      handler(message)
+
+  def depth(self):
+    return sum(len(worker.messages) for worker in self.workers)
+
+  def busy(self):
+    return sum(1 for worker in self.workers if worker.busy)
+
+  def stats(self):
+    return {
+      "workers" : len(self.workers),
+      "depth"   : self.depth(),
+      "busy"    : self.busy()
+    }
+
+  # stopping waits for handlers that are running in processes, since processes
+  # that are left behind can keep the interpreter from exiting (Python 3.7)
+
+  def stop(self):
+    for worker in self.workers: worker.stop()
+    if self.executor: self.executor.shutdown()
+
+  def join(self, timeout=None):
+    for worker in self.workers: worker.join(timeout)
+
+def Pooled(mq, workers=4, key=None, processes=None):
+  mq.pool = Pool(mq, workers=workers, key=key, processes=processes)
+  return mq
@@ -2,14 +2,72 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from threading import RLock
+import time
+import heapq
+import itertools
 
-from mqfactory.tools import clock, wrap
+from threading import RLock, Event, Condition
+
+from mqfactory.tools import clock, wrap, wrap_all
+
+# messages are kept in a dict, indexed by their id, and scheduled using heaps
+# of [due, order, id] entries, one for each priority lane. rescheduling or
+# removing a message invalidates its current entry, which is lazily discarded
+# when it reaches the top.
+# a message is due at its last activity time, unless it was deferred until some
+# later time, in which case it will only be returned once that time has come.
+# the (optionally shared) event is set whenever a message is added or deferred,
+# allowing processors to wait for work instead of polling the queue.
+# taking messages removes them from the schedule until they are removed,
+# deferred or released, while they remain part of the queue.
+# the priority of a message is taken from its "priority" tag, or a policy, and
+# defaults to NORMAL. lanes with a higher priority are served first, unless
+# weights are given, which shares the available messages according to these
+# weights (smooth weighted round robin).
+# a queue can be bounded by a maximum number of messages and/or payload bytes.
+# when full, adding a message either raises a QueueFullException, blocks until
+# there is room (or a timeout expires), or drops the oldest or newest message.
+# callbacks can be registered to be notified when the number of messages in the
+# queue reaches a high watermark and when it drops back to a low watermark.
+
+INVALID = None
+
+LOW    = -1
+NORMAL =  0
+HIGH   =  1
+
+RAISE       = "raise"
+BLOCK       = "block"
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+
+class QueueFullException(Exception):
+  pass
+
+def size(message):
+  if isinstance(message.payload, (str, bytes, bytearray)):
+    return len(message.payload)
+  return len(str(message.payload))
 
 class Queue(object):
-  def __init__(self, name="queue"):
+  def __init__(self, name="queue", event=None, max_messages=None,
+                     max_bytes=None, overflow=RAISE, timeout=None,
+                     high=None, low=None):
     self.name          = name
+    self.event         = event or Event()
+    self.bytes         = 0
+    self.flooded       = False
+    self.on_high       = []
+    self.on_low        = []
+    self.limit(max_messages, max_bytes, overflow, timeout, high, low)
     self.messages      = {}
+    self.lanes         = {}
+    self.priorities    = []
+    self.entries       = {}
+    self.policy        = None
+    self.weights       = None
+    self.credits       = {}
+    self.order         = itertools.count()
     self.before_add    = []
     self.after_add     = []
     self.before_remove = []
@@ -18,47 +76,246 @@ class Queue(object):
     self.after_defer   = []
     self.before_get    = []
     self.lock = RLock()
+    self.space = Condition(self.lock)
+
+  def limit(self, max_messages=None, max_bytes=None, overflow=RAISE,
+                  timeout=None, high=None, low=None):
+    self.max_messages = max_messages
+    self.max_bytes    = max_bytes
+    self.overflow     = overflow
+    self.timeout      = timeout
+    self.high         = high
+    self.low          = high // 2 if low is None and high else low
+
+  def prioritize(self, policy=None, weights=None):
+    self.policy  = policy
+    self.weights = weights
 
-  def add(self, message, wrapping=True):
+  def priority(self, message):
+    if "priority" in message.tags: return message.tags["priority"]
+    if self.policy:
+      priority = self.policy.match(message).value
+      if not priority is None: return priority
+    return NORMAL
+
+  def add(self, message, wrapping=True, timeout=None):
     with self.lock:
       logger.info("queue[{0}]: add: {1}".format(self.name, message.id))
-      if wrapping: wrap(message, self.before_add)
+      if wrapping:
+        wrap(message, self.before_add)
+        if not self._admit(message, timeout): return False
+      self._forget(message)
       self.messages[message.id] = message
+      if not self.max_bytes is None:
+        message.private["size"] = size(message)
+        self.bytes += message.private["size"]
       message.private["last"] = clock.now()
-      if wrapping: wrap(message, self.after_add)    
+      message.private["priority"] = self.priority(message)
+      message.private.pop("due", None)
+      self._schedule(message)
+      if wrapping: wrap(message, self.after_add)
+      self.event.set()
+      self._watermarks()
+      return True
 
   def remove(self, message):
     with self.lock:
       logger.info("queue[{0}]: remove: {1}".format(self.name, message.id))
       wrap(message, self.before_remove)
+      self._forget(message)
       del self.messages[message.id]
+      self._unschedule(message)
+      self.space.notify_all()
       wrap(message, self.after_remove)
+      self._watermarks()
 
-  def defer(self, message):
+  def defer(self, message, until=None):
     with self.lock:
       wrap(message, self.before_defer)
       message.private["last"] = clock.now()
+      if until is None:
+        message.private.pop("due", None)
+      else:
+        message.private["due"] = until
+      self._schedule(message)
       wrap(message, self.after_defer)
+      self.event.set()
+
+  def take(self, count=1):
+    with self.lock:
+      wrap(None, self.before_get)
+      messages = []
+      while len(messages) < count:
+        schedule = self._select()
+        if schedule is None: break
+        entry = heapq.heappop(schedule)
+        del self.entries[entry[-1]]
+        messages.append(self.messages[entry[-1]])
+      return messages
+
+  def release(self, message):
+    with self.lock:
+      if message.id in self.messages and not message.id in self.entries:
+        self._schedule(message)
+        self.event.set()
+
+  def remove_all(self, messages):
+    with self.lock:
+      for message in messages:
+        logger.info("queue[{0}]: remove: {1}".format(self.name, message.id))
+      messages, failed = wrap_all(messages, self.before_remove)
+      for message in messages:
+        self._forget(message)
+        del self.messages[message.id]
+        self._unschedule(message)
+      self.space.notify_all()
+      messages, failures = wrap_all(messages, self.after_remove)
+      self._watermarks()
+      return failed + failures
+
+  def defer_all(self, deferrals):
+    if not deferrals: return []
+    with self.lock:
+      messages, failed = wrap_all([ msg for msg, _ in deferrals ], self.before_defer)
+      now = clock.now()
+      until = dict( (id(msg), due) for msg, due in deferrals )
+      for message in messages:
+        message.private["last"] = now
+        if until[id(message)] is None:
+          message.private.pop("due", None)
+        else:
+          message.private["due"] = until[id(message)]
+        self._schedule(message)
+      messages, failures = wrap_all(messages, self.after_defer)
+      if messages: self.event.set()
+      return failed + failures
+
+  def all(self):
+    with self.lock:
+      wrap(None, self.before_get)
+      return list(self.messages.values())
 
   def __len__(self):
     return len(self.messages)
 
   def __iter__(self):
     return self  # pragma: no cover
-  
+
   def next(self):
     return self.__next__() # pragma: no cover
-  
+
   def __next__(self):
     with self.lock:
       wrap(None, self.before_get)
-      if len(self.messages) < 1:
+      schedule = self._select()
+      if schedule is None:
         raise StopIteration
-      message = min(self.messages.values(), key=lambda msg: msg.private["last"])
-      return message
+      return self.messages[schedule[0][-1]]
+
+  def due(self):
+    with self.lock:
+      dues = [ entry[0] for entry in map(self._top, self.lanes.values()) \
+                        if not entry is None ]
+      return min(dues) if dues else None
 
   def __getitem__(self, id):
     with self.lock:
       message = self.messages[id]
       wrap(message, self.before_get)
       return message
+
+  def _schedule(self, message):
+    self._unschedule(message)
+    due   = message.private.get("due", message.private["last"])
+    entry = [ due, next(self.order), message.id ]
+    self.entries[message.id] = entry
+    lane  = message.private.get("priority", NORMAL)
+    if not lane in self.lanes:
+      self.lanes[lane] = []
+      self.priorities  = sorted(self.lanes, reverse=True)
+    schedule = self.lanes[lane]
+    heapq.heappush(schedule, entry)
+    # avoid piling up invalidated entries when messages are deferred a lot
+    if len(schedule) > 2 * len(self.entries) + 64:
+      schedule[:] = [ entry for entry in schedule if entry[-1] is not INVALID ]
+      heapq.heapify(schedule)
+
+  # returns the lane with the next message that is due, if any
+
+  def _select(self):
+    now   = None
+    lanes = []
+    for priority in self.priorities:
+      entry = self._top(self.lanes[priority])
+      if entry is None: continue
+      message = self.messages[entry[-1]]
+      if "due" in message.private:
+        if now is None: now = clock.now()
+        if message.private["due"] > now: continue
+      if not self.weights: return self.lanes[priority]
+      lanes.append(priority)
+    if not lanes: return None
+    total, selected = 0, None
+    for priority in lanes:
+      weight = self.weights.get(priority, 1)
+      total += weight
+      self.credits[priority] = self.credits.get(priority, 0) + weight
+      if selected is None or self.credits[priority] > self.credits[selected]:
+        selected = priority
+    self.credits[selected] -= total
+    return self.lanes[selected]
+
+  def _fits(self, message):
+    if message.id in self.messages: return True
+    if not self.max_messages is None and \
+       len(self.messages) >= self.max_messages:
+      return False
+    if not self.max_bytes is None and \
+       self.bytes + size(message) > self.max_bytes:
+      return False
+    return True
+
+  def _admit(self, message, timeout=None):
+    if self._fits(message): return True
+    if self.overflow == DROP_NEWEST:
+      logger.warning("queue[{0}]: full, dropping {1}".format(self.name, message.id))
+      return False
+    if self.overflow == DROP_OLDEST:
+      while not self._fits(message):
+        # only drop messages that aren't being processed
+        oldest = next((msg for msg in self.messages.values() \
+                           if msg.id in self.entries), None)
+        if oldest is None: break
+        logger.warning("queue[{0}]: full, dropping {1}".format(self.name, oldest.id))
+        self.remove(oldest)
+    elif self.overflow == BLOCK:
+      timeout = self.timeout if timeout is None else timeout
+      end     = None if timeout is None else time.time() + timeout
+      while not self._fits(message):
+        remaining = None if end is None else end - time.time()
+        if not remaining is None and remaining <= 0: break
+        self.space.wait(remaining)
+    if self._fits(message): return True
+    raise QueueFullException("queue[{0}] is full".format(self.name))
+
+  def _forget(self, message):
+    if message.id in self.messages:
+      self.bytes -= self.messages[message.id].private.pop("size", 0)
+
+  def _watermarks(self):
+    if self.high is None: return
+    if not self.flooded and len(self.messages) >= self.high:
+      self.flooded = True
+      wrap(self, self.on_high)
+    elif self.flooded and len(self.messages) <= self.low:
+      self.flooded = False
+      wrap(self, self.on_low)
+
+  def _top(self, schedule):
+    while schedule and schedule[0][-1] is INVALID:
+      heapq.heappop(schedule)
+    return schedule[0] if schedule else None
+
+  def _unschedule(self, message):
+    entry = self.entries.pop(message.id, None)
+    if entry: entry[-1] = INVALID
@@ -4,5 +4,7 @@ __version__ = "0.0.4"
 # like: from mqfactory import MessageQueue ;-)
 
 from mqfactory.message      import Message
-from mqfactory.Queue        import Queue
-from mqfactory.MessageQueue import Threaded, MessageQueue, DeferException
+from mqfactory.Queue        import Queue, QueueFullException
+from mqfactory.MessageQueue import Threaded, Bounded, Prioritized
+from mqfactory.MessageQueue import MessageQueue, DeferException, DropException
+from mqfactory.Pool         import Pooled
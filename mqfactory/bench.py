@@ -0,0 +1,315 @@
+import json
+import logging
+import argparse
+import platform
+import tracemalloc
+
+from timeit import default_timer as timer
+
+# offline benchmarks, using the in-process loopback transport and in-memory
+# collections. results are written as JSON, allowing to track regressions.
+#
+#   python -m mqfactory.bench [suite...] [--messages N] [--output file]
+
+from mqfactory                          import MessageQueue
+from mqfactory.Queue                    import Queue
+from mqfactory.message                  import Message, uuid4
+from mqfactory.message.ids              import Counter, Ulid
+from mqfactory.message.format           import jsonlib
+from mqfactory.message.format.js        import JsonFormatting
+from mqfactory.message.security         import Signing
+from mqfactory.message.security         import rsa, ed25519
+from mqfactory.message.security.keys    import encode
+from mqfactory.message.security.rsa     import RsaSignature, generate_key_pair
+from mqfactory.message.security.ed25519 import Ed25519Signature
+from mqfactory.message.security.hmac    import HmacSignature, generate_secret
+from mqfactory.store                    import Persisting
+from mqfactory.store.memory             import MemoryStore
+from mqfactory.transport.loopback       import Loopback, LoopbackTransport
+from mqfactory.transport.qos            import Acknowledging
+from mqfactory.transport.mqtt           import TransportRule
+from mqfactory.tools                    import Policy, CATCH_ALL
+
+SUITES = {}
+
+def suite(function):
+  SUITES[function.__name__] = function
+  return function
+
+def percentile(values, p):
+  values = sorted(values)
+  if not values: return None
+  return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+# layer combinations, applied to both the sending and the receiving MQ. only
+# the payload is transported, so layers that add tags need JsonFormatting.
+
+def keys(store):
+  if not "bench" in store["keys"].docs:
+    private, public = generate_key_pair()
+    store["keys"].add({
+      "_id"    : "bench",
+      "private": encode(private),
+      "public" : encode(public)
+    })
+  return store["keys"]
+
+def bare(mq, store):
+  return mq
+
+def formatting(mq, store):
+  return JsonFormatting(mq)
+
+def signing(mq, store):
+  return JsonFormatting(
+    Signing(mq, adding=RsaSignature(keys(store), me="bench"))
+  )
+
+def acknowledging(mq, store):
+  return JsonFormatting(Acknowledging(mq))
+
+def persisting(mq, store):
+  return Persisting(mq,
+    inbox=store[mq.name + "-inbox"], outbox=store[mq.name + "-outbox"]
+  )
+
+def full(mq, store):
+  return JsonFormatting(
+    Signing(
+      Acknowledging(persisting(mq, store)),
+      adding=RsaSignature(keys(store), me="bench")
+    )
+  )
+
+STACKS = [
+  ("bare",           bare),
+  ("JsonFormatting", formatting),
+  ("Signing",        signing),
+  ("Acknowledging",  acknowledging),
+  ("Persisting",     persisting),
+  ("full",           full)
+]
+
+def pump(mqs, done, limit=1000):
+  for _ in range(limit):
+    if done(): return True
+    for mq in mqs: mq.send_and_receive()
+  return done()
+
+def measure_stack(layers, count, store):
+  broker   = Loopback()
+  sender   = layers(MessageQueue(LoopbackTransport(broker), name="sender"), store)
+  receiver = layers(MessageQueue(LoopbackTransport(broker), name="receiver"), store)
+  received = []
+  receiver.on_message("bench", lambda message: received.append(timer()))
+
+  idle = lambda: len(sender.outbox) == 0 and len(receiver.outbox) == 0 \
+                 and len(sender.inbox) == 0 and len(receiver.inbox) == 0
+
+  latencies = []
+  start     = timer()
+  for i in range(count):
+    sent = timer()
+    sender.send("bench", { "index" : i, "data" : "x" * 64 })
+    if not pump([ sender, receiver ], lambda: len(received) > i):
+      raise RuntimeError("message {0} was not delivered".format(i))
+    latencies.append((received[i] - sent) * 1000)
+    pump([ sender, receiver ], idle)
+  elapsed = timer() - start
+
+  return {
+    "messages"  : count,
+    "msgs_per_s": count / elapsed,
+    "p50_ms"    : percentile(latencies, 50),
+    "p99_ms"    : percentile(latencies, 99)
+  }
+
+@suite
+def stack(count):
+  store = MemoryStore()
+  return dict( (name, measure_stack(layers, count, store)) \
+               for name, layers in STACKS )
+
+# per message cost of a dequeue/defer cycle for increasing queue depths, which
+# should remain (roughly) flat, independent of the number of queued messages
+
+@suite
+def queue(count):
+  results = {}
+  for depth in [ 10, 100, 1000, 10000, 100000 ]:
+    q = Queue()
+    for i in range(depth):
+      q.add(Message("to", "payload", id=i))
+    start = timer()
+    for _ in range(count):
+      q.defer(next(q))
+    results[str(depth)] = { "us_per_msg" : (timer() - start) / count * 1000000 }
+  return results
+
+# construction time and memory per message, for each id generator
+
+GENERATORS = [
+  ("uuid4",   lambda: uuid4),
+  ("Counter", Counter),
+  ("Ulid",    Ulid)
+]
+
+@suite
+def message(count):
+  results = {}
+  default = Message.id_generator
+  try:
+    for name, generator in GENERATORS:
+      Message.id_generator = staticmethod(generator())
+      start    = timer()
+      messages = [ Message("to", "payload") for _ in range(count) ]
+      elapsed  = timer() - start
+      del messages
+      tracemalloc.start()
+      messages = [ Message("to", "payload") for _ in range(count) ]
+      memory   = tracemalloc.get_traced_memory()[0]
+      tracemalloc.stop()
+      del messages
+      results[name] = {
+        "us_per_msg"   : elapsed / count * 1000000,
+        "bytes_per_msg": memory / count
+      }
+  finally:
+    Message.id_generator = staticmethod(default)
+  return results
+
+# encoding and decoding time of the available JSON backends, for typical
+# message envelopes
+
+SHAPES = {
+  "telemetry": {
+    "tags"   : { "id" : "01M5712RNE9HNPS616RXCD41SG", "ack" : "sender/ack" },
+    "payload": { "sensor" : "temperature", "value" : 21.5, "ts" : 1571234567 }
+  },
+  "signed": {
+    "tags"   : {
+      "id"       : "01M5712RNE9HNPS616RXCD41SG",
+      "signature": { "origin" : "bench", "ts" : "2019-10-16 12:00:00.000000" }
+    },
+    "payload": { "index" : 1, "data" : "x" * 64 }
+  },
+  "document": {
+    "tags"   : { "id" : "01M5712RNE9HNPS616RXCD41SG" },
+    "payload": {
+      "items" : [ { "name" : "item {0}".format(i), "value" : i * 1.5,
+                    "labels" : [ "a", "b", "c" ] } for i in range(100) ]
+    }
+  }
+}
+
+@suite
+def backends(count):
+  results = {}
+  encoded = {}
+  results["dumps"] = {}
+  for shape, doc in SHAPES.items():
+    start   = timer()
+    for _ in range(count): encoded[shape] = jsonlib.dumps(doc)
+    dumping = timer() - start
+    results["dumps"][shape] = {
+      "us"   : dumping / count * 1000000,
+      "bytes": len(encoded[shape])
+    }
+  for backend in jsonlib.available():
+    results[backend.name] = {}
+    for shape in SHAPES:
+      start   = timer()
+      for _ in range(count): backend.loads(encoded[shape])
+      loading = timer() - start
+      results[backend.name][shape] = { "loads_us": loading / count * 1000000 }
+  return results
+
+# sign and verify throughput of the signature implementations
+
+def pem_keys(module):
+  private, public = module.generate_key_pair()
+  return { "bench" : { "private" : encode(private), "public" : encode(public) } }
+
+SIGNATURES = [
+  ("RsaSignature",     lambda: RsaSignature(pem_keys(rsa), me="bench")),
+  ("Ed25519Signature", lambda: Ed25519Signature(pem_keys(ed25519), me="bench")),
+  ("HmacSignature",    lambda: HmacSignature(
+                         { "bench" : { "secret" : generate_secret() } }, me="bench"
+                       )),
+  ("RsaSignature (batch)",
+                       lambda: RsaSignature(pem_keys(rsa), me="bench", batch=True))
+]
+
+BATCH = 32
+
+@suite
+def signatures(count):
+  results = {}
+  for name, signature in SIGNATURES:
+    signer   = signature()
+    messages = [ Message("bench", SHAPES["signed"]["payload"]) for _ in range(count) ]
+    start    = timer()
+    if signer.batch:
+      for i in range(0, count, BATCH): signer.sign_all(messages[i:i+BATCH])
+    else:
+      for message in messages: signer.sign(message)
+    signing  = timer() - start
+    start    = timer()
+    for message in messages: signer.validate(message)
+    validating = timer() - start
+    results[name] = {
+      "signs_per_s"   : count / signing,
+      "verifies_per_s": count / validating
+    }
+  return results
+
+# matching messages against a policy with many per-topic rules, walking the
+# rules linearly, using the compiled policy, and using its per-topic cache
+
+@suite
+def policy(count):
+  rules    = [ TransportRule({ "to" : "devices/{0}/+".format(i) }, i) \
+               for i in range(500) ] + [ TransportRule({ "to" : "#" }, None) ]
+  messages = [ Message("devices/{0}/status".format(i % 600), "payload") \
+               for i in range(count) ]
+  def linear(message):
+    return next((rule for rule in rules if rule.matches(message)), CATCH_ALL)
+  matchers = [
+    ("linear",   linear),
+    ("compiled", Policy(rules, cache=0).match),
+    ("cached",   Policy(rules).match)
+  ]
+  results = {}
+  for name, match in matchers:
+    start = timer()
+    for message in messages: match(message)
+    results[name] = { "us_per_msg" : (timer() - start) / count * 1000000 }
+  return results
+
+def run(suites, count):
+  return {
+    "python"  : platform.python_version(),
+    "platform": platform.platform(),
+    "results" : dict( (name, SUITES[name](count)) for name in suites )
+  }
+
+def main(args=None):
+  parser = argparse.ArgumentParser(prog="python -m mqfactory.bench")
+  parser.add_argument("suites", nargs="*", choices=[[]] + sorted(SUITES),
+                      help="suites to run (default: all)")
+  parser.add_argument("--messages", type=int, default=1000,
+                      help="number of messages per measurement")
+  parser.add_argument("--output", help="write results to file")
+  args = parser.parse_args(args)
+
+  logging.disable(logging.CRITICAL)
+  results = run(args.suites or sorted(SUITES), args.messages)
+  output  = json.dumps(results, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, "w") as fp: fp.write(output + "\n")
+  else:
+    print(output)
+  return results
+
+if __name__ == "__main__":
+  main()
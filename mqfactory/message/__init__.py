@@ -1,26 +1,77 @@
 import copy
 import uuid
 
+def uuid4():
+  return str(uuid.uuid4())
+
+# messages are slotted, and their tags and private dicts are only created when
+# they are accessed. until then, the id is kept separately. new ids are
+# generated using the (configurable) Message.id_generator, see message.ids.
+# functions are assigned as a staticmethod, since python 2 would turn them into
+# unbound methods: Message.id_generator = staticmethod(generate)
+
 class Message(object):
+  __slots__    = ("to", "payload", "_tags", "_private", "_id")
+  id_generator = staticmethod(uuid4)
+
   def __init__(self, to, payload, tags=None, id=None):
-    self.to         = to
-    self.payload    = payload
-    self.tags       = tags or {}
-    self.private    = {}
-    self.tags["id"] = id or str(uuid.uuid4())
+    self.to       = to
+    self.payload  = payload
+    self._tags    = None
+    self._private = None
+    self._id      = id or Message.id_generator()
+    if tags is not None:
+      tags["id"] = self._id
+      self._tags = tags
+
+  @property
+  def tags(self):
+    if self._tags is None:
+      self._tags = { "id" : self._id }
+    return self._tags
+
+  @tags.setter
+  def tags(self, tags):
+    self._tags = tags
+
+  @property
+  def private(self):
+    if self._private is None:
+      self._private = {}
+    return self._private
+
+  @private.setter
+  def private(self, private):
+    self._private = private
 
   @property
   def id(self):
-    return self.tags["id"]
+    return self._id if self._tags is None else self._tags["id"]
 
-  def copy(self):
+  # a shallow copy shares the payload and the values of the tags and private
+  # info with the original, allowing them to be replaced, but not changed
+
+  def copy(self, deep=True):
+    if not deep:
+      tags = None if self._tags is None else dict(self._tags)
+      dup  = Message(self.to, self.payload, tags=tags, id=self.id)
+      if self._private: dup._private = dict(self._private)
+      return dup
     return Message(
       self.to,
       copy.deepcopy(self.payload),
       tags=copy.deepcopy(self.tags),
-      id=self.tags["id"]
+      id=self.id
     )
 
+  # allows policies to match messages, without turning them into a dict
+
+  def __getitem__(self, key):
+    if key == "to":      return self.to
+    if key == "payload": return self.payload
+    if key == "tags":    return self.tags
+    raise KeyError(key)
+
   def __iter__(self):
     yield ("to",      self.to)
     yield ("payload", self.payload)
@@ -34,11 +85,11 @@ class Message(object):
       "tags"   : self.tags
     })
 
-  def __eq__(self, other): 
+  def __eq__(self, other):
     return self.to      == other.to \
        and self.payload == other.payload \
        and self.tags    == other.tags \
-       and self.private == other.private
+       and (self._private or {}) == (other.private or {})
 
   def __ne__(self, other):
     return not self == other
@@ -0,0 +1,199 @@
+import zlib
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+import paho.mqtt.client as mqtt
+
+# compression of (formatted) payloads, using zlib, or lz4 and zstd when they are
+# installed. compressed payloads are marked with a header, holding the codec and
+# optionally the id of the dictionary that was used:
+#
+#   \x00<codec>[:<dictionary id>]\x00<compressed payload>
+#
+# the header marks the payload itself, since tags are part of the payload once
+# it is formatted. Compressing should therefore be applied on top of e.g.
+# JsonFormatting: Compressing(JsonFormatting(mq))
+#
+# received payloads are decompressed up to a maximum size, rejecting payloads
+# that would expand beyond it (decompression bombs).
+
+MARKER   = b"\x00"
+MAX_SIZE = 16 * 1024 * 1024
+
+def too_large(max_size):
+  return ValueError("decompressed payload exceeds {0} bytes".format(max_size))
+
+class Codec(object):
+  name         = None
+  dictionaries = True
+
+  def compress(self, data, dictionary=None):
+    raise NotImplementedError("implement compressing data")
+
+  def decompress(self, data, dictionary=None, max_size=None):
+    raise NotImplementedError("implement decompressing data")
+
+  # by default a dictionary consists of the most recent samples
+
+  def train(self, samples, size=32768):
+    return b"".join(samples)[-size:]
+
+class Zlib(Codec):
+  name = "zlib"
+
+  def __init__(self, level=6):
+    self.level = level
+
+  def compress(self, data, dictionary=None):
+    if dictionary:
+      compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=dictionary)
+    else:
+      compressor = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+    return compressor.compress(data) + compressor.flush()
+
+  def decompress(self, data, dictionary=None, max_size=None):
+    if dictionary:
+      decompressor = zlib.decompressobj(-15, zdict=dictionary)
+    else:
+      decompressor = zlib.decompressobj(-15)
+    if max_size is None:
+      return decompressor.decompress(data) + decompressor.flush()
+    decompressed = decompressor.decompress(data, max_size + 1)
+    if len(decompressed) <= max_size:
+      decompressed += decompressor.flush()
+    if len(decompressed) > max_size: raise too_large(max_size)
+    return decompressed
+
+class Lz4(Codec):
+  name         = "lz4"
+  dictionaries = False
+
+  def __init__(self):
+    import lz4.frame
+    self.lz4 = lz4.frame
+
+  def compress(self, data, dictionary=None):
+    if dictionary: raise ValueError("lz4 doesn't support dictionaries")
+    return self.lz4.compress(data)
+
+  def decompress(self, data, dictionary=None, max_size=None):
+    if dictionary: raise ValueError("lz4 doesn't support dictionaries")
+    if max_size is None: return self.lz4.decompress(data)
+    decompressed = self.lz4.LZ4FrameDecompressor().decompress(
+      data, max_length=max_size + 1
+    )
+    if len(decompressed) > max_size: raise too_large(max_size)
+    return decompressed
+
+class Zstd(Codec):
+  name = "zstd"
+
+  def __init__(self, level=3):
+    import zstandard
+    self.zstd         = zstandard
+    self.level        = level
+    self.compressors  = {}
+    self.decompressor = zstandard.ZstdDecompressor()
+
+  def dictionary(self, dictionary):
+    if not dictionary in self.compressors:
+      data = self.zstd.ZstdCompressionDict(dictionary)
+      self.compressors[dictionary] = (
+        self.zstd.ZstdCompressor(level=self.level, dict_data=data),
+        self.zstd.ZstdDecompressor(dict_data=data)
+      )
+    return self.compressors[dictionary]
+
+  def compress(self, data, dictionary=None):
+    if dictionary:
+      return self.dictionary(dictionary)[0].compress(data)
+    return self.zstd.ZstdCompressor(level=self.level).compress(data)
+
+  def decompress(self, data, dictionary=None, max_size=None):
+    if dictionary:
+      decompressor = self.dictionary(dictionary)[1]
+    else:
+      decompressor = self.decompressor
+    if max_size is None: return decompressor.decompress(data)
+    # the content size in the frame header can't be trusted, so the payload is
+    # read incrementally
+    decompressed = decompressor.stream_reader(data).read(max_size + 1)
+    if len(decompressed) > max_size: raise too_large(max_size)
+    return decompressed
+
+  def train(self, samples, size=32768):
+    return self.zstd.train_dictionary(size, samples).as_bytes()
+
+CODECS = {}
+for codec in [ Zlib, Lz4, Zstd ]:
+  try:
+    CODECS[codec.name] = codec()
+  except ImportError:
+    pass
+
+# dictionaries are assigned to topics (or subscription patterns), and are
+# identified by a hash of their content. both sides need the same dictionaries.
+
+class Dictionaries(object):
+  def __init__(self):
+    self.topics = []
+    self.ids    = {}
+
+  def add(self, topic, dictionary):
+    id = hashlib.sha1(dictionary).hexdigest()[:8]
+    self.ids[id] = dictionary
+    self.topics.insert(0, (topic, id))
+    return id
+
+  def train(self, topic, samples, codec="zlib", size=32768):
+    return self.add(topic, CODECS[codec].train(samples, size))
+
+  def lookup(self, topic):
+    for sub, id in self.topics:
+      if mqtt.topic_matches_sub(sub, topic): return id
+    return None
+
+  def __getitem__(self, id):
+    return self.ids[id]
+
+class Compression(object):
+  def __init__(self, codec="zlib", min_size=128, dictionaries=None,
+                     max_size=MAX_SIZE):
+    self.codec        = CODECS[codec]
+    self.min_size     = min_size
+    self.dictionaries = dictionaries
+    self.max_size     = max_size
+    if dictionaries and not self.codec.dictionaries:
+      raise ValueError("{0} doesn't support dictionaries".format(codec))
+
+  def compress(self, msg):
+    if not isinstance(msg.payload, bytes) or len(msg.payload) < self.min_size:
+      return
+    header, dictionary = self.codec.name, None
+    if self.dictionaries:
+      id = self.dictionaries.lookup(msg.to)
+      if id:
+        header, dictionary = header + ":" + id, self.dictionaries[id]
+    compressed = MARKER + header.encode("ascii") + MARKER + \
+                 self.codec.compress(msg.payload, dictionary)
+    if len(compressed) < len(msg.payload):
+      msg.payload = compressed
+
+  def decompress(self, msg):
+    if not isinstance(msg.payload, bytes) or not msg.payload[:1] == MARKER:
+      return
+    end    = msg.payload.index(MARKER, 1)
+    header = msg.payload[1:end].decode("ascii").split(":")
+    dictionary = (self.dictionaries or {})[header[1]] if len(header) > 1 else None
+    msg.payload = CODECS[header[0]].decompress(
+      msg.payload[end+1:], dictionary, self.max_size
+    )
+
+def Compressing(mq, codec="zlib", min_size=128, dictionaries=None,
+                max_size=MAX_SIZE):
+  compression = Compression(codec, min_size, dictionaries, max_size)
+  mq.transport.before_sending.append(compression.compress)
+  mq.transport.after_receiving.append(compression.decompress)
+  return mq
@@ -0,0 +1,18 @@
+import importlib
+
+# the canonical encoding of a message, which is what signatures sign, depends on
+# the format it is sent in, as given by its "content-type" tag. by default, it
+# is the JSON envelope. formats are imported when needed, since e.g. worker
+# processes validating signatures don't install formatting themselves.
+
+JSON = "application/json"
+
+ENVELOPES = {
+  JSON                  : "mqfactory.message.format.js",
+  "application/msgpack" : "mqfactory.message.format.msgpack"
+}
+
+def envelope(msg):
+  content_type = msg.tags.get("content-type", JSON)
+  module = ENVELOPES.get(content_type, ENVELOPES[JSON])
+  return importlib.import_module(module).envelope(msg)
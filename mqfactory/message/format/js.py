@@ -1,17 +1,47 @@
-import json
+from mqfactory.message        import Message
+from mqfactory.message.format import jsonlib
 
-from mqfactory.message import Message
+# the canonical encoding of a message, which is also what signatures sign. when
+# a signature kept it, it is sent as-is, with the hash of the signature added
+# as a top-level property, so the receiver can validate the received encoding.
 
-def serialize(msg):
-  msg.payload = json.dumps({
+HASH = b',"hash":'
+
+def envelope(msg):
+  return jsonlib.dumps({
     "tags"   : msg.tags,
     "payload": msg.payload
-  }, sort_keys=True)
+  })
+
+def serialize(msg):
+  canonical = msg.private.get("canonical")
+  if canonical is None:
+    msg.payload = envelope(msg)
+  else:
+    hash = msg.tags["signature"]["hash"]
+    msg.payload = canonical[:-1] + HASH + jsonlib.dumps(hash) + b"}"
+
+# only the canonical encoding is signed, so when a hash is present, tags and
+# payload are taken from the canonical encoding, which may only be followed by
+# the hash itself.
 
 def unserialize(msg):
-  raw = json.loads(msg.payload)
+  encoded = msg.payload
+  if not isinstance(encoded, bytes): encoded = encoded.encode("utf-8")
+  raw  = jsonlib.loads(encoded)
+  hash = None
+  if "hash" in raw:
+    end       = encoded.rindex(HASH)
+    canonical = encoded[:end] + b"}"
+    hash      = jsonlib.loads(encoded[end+len(HASH):-1])
+    if encoded != canonical[:-1] + HASH + jsonlib.dumps(hash) + b"}":
+      raise ValueError("unexpected content after canonical encoding")
+    raw = jsonlib.loads(canonical)
+    msg.private["canonical"] = canonical
   msg.tags    = raw["tags"]    if "tags" in raw else {}
   msg.payload = raw["payload"] if "payload" in raw else ""
+  if not hash is None:
+    msg.tags["signature"]["hash"] = hash
 
 def JsonFormatting(mq):
   mq.transport.before_sending.append(serialize)
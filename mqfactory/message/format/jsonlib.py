@@ -0,0 +1,73 @@
+import json
+
+# JSON backends. the canonical encoding, which signatures sign, is always the
+# compact, key-sorted UTF-8 encoding of the standard library, since other
+# backends format numbers differently (e.g. orjson writes 1e16 and 1e-7 where
+# the standard library writes 1e+16 and 1e-07) and reject some values (e.g.
+# non-str keys, integers beyond 64 bits), which would make peers disagree.
+#
+# parsing uses the fastest installed backend that returns the same values as
+# the standard library, falling back to it for anything the backend rejects.
+# orjson parses integers beyond 64 bits as floats, so it is only used when it
+# is selected explicitly.
+
+def dumps(obj):
+  return json.dumps(
+    obj, sort_keys=True, ensure_ascii=False, separators=(",", ":")
+  ).encode("utf-8")
+
+class Backend(object):
+  def __init__(self, name, loads, exact=True):
+    self.name  = name
+    self.loads = loads
+    self.exact = exact
+
+def falling_back(parse):
+  def loads(encoded):
+    try:
+      return parse(encoded)
+    except ValueError:
+      return json.loads(encoded)
+  return loads
+
+def load_ujson():
+  import ujson
+  return Backend("ujson", falling_back(ujson.loads))
+
+def load_rapidjson():
+  import rapidjson
+  return Backend("rapidjson", falling_back(rapidjson.loads))
+
+def load_orjson():
+  import orjson
+  return Backend("orjson", falling_back(orjson.loads), exact=False)
+
+def load_json():
+  return Backend("json", json.loads)
+
+LOADERS = [
+  ("ujson",     load_ujson),
+  ("rapidjson", load_rapidjson),
+  ("orjson",    load_orjson),
+  ("json",      load_json)
+]
+
+def available():
+  backends = []
+  for _, loader in LOADERS:
+    try:
+      backends.append(loader())
+    except ImportError:
+      pass
+  return backends
+
+# selects a backend by name, or the first available exact one
+
+def use(name=None):
+  global backend, loads
+  backend = [ b for b in available() \
+                if b.name == name or (name is None and b.exact) ][0]
+  loads   = backend.loads
+  return backend
+
+use()
@@ -0,0 +1,59 @@
+import msgpack
+
+from collections import OrderedDict
+
+from mqfactory.message.format import js
+
+# a binary wire format, using the same tags/payload envelope as JsonFormatting,
+# with native support for bytes. received messages are accepted in both
+# formats, so receivers can be migrated before senders. a "content-type" tag
+# on a message allows to still send it as JSON, e.g. to receivers that weren't
+# migrated yet.
+# outgoing messages are tagged with their content-type, before they are signed,
+# so signatures use the msgpack envelope as canonical encoding, which supports
+# bytes payloads.
+
+CONTENT_TYPE = "application/msgpack"
+JSON         = "application/json"
+
+def is_json(payload):
+  return payload[:1] in (b"{", "{")
+
+# the canonical msgpack encoding of a message, with all keys sorted
+
+def ordered(value):
+  if isinstance(value, dict):
+    return OrderedDict( (key, ordered(value[key])) for key in sorted(value) )
+  if isinstance(value, (list, tuple)):
+    return [ ordered(item) for item in value ]
+  return value
+
+def envelope(msg):
+  return msgpack.packb(ordered({
+    "tags"   : msg.tags,
+    "payload": msg.payload
+  }), use_bin_type=True)
+
+def tag(msg):
+  msg.tags.setdefault("content-type", CONTENT_TYPE)
+
+def serialize(msg):
+  if msg.tags.get("content-type", CONTENT_TYPE) == JSON:
+    return js.serialize(msg)
+  msg.payload = msgpack.packb({
+    "tags"   : msg.tags,
+    "payload": msg.payload
+  }, use_bin_type=True)
+
+def unserialize(msg):
+  if is_json(msg.payload):
+    return js.unserialize(msg)
+  raw = msgpack.unpackb(msg.payload, raw=False)
+  msg.tags    = raw["tags"]    if "tags" in raw else {}
+  msg.payload = raw["payload"] if "payload" in raw else ""
+
+def MsgpackFormatting(mq):
+  mq.before_sending.insert(0, tag)
+  mq.transport.before_sending.append(serialize)
+  mq.transport.after_receiving.append(unserialize)
+  return mq
@@ -0,0 +1,66 @@
+import os
+import time
+import uuid
+import random
+import itertools
+
+from threading import Lock
+
+# alternative id generators, that are cheaper than uuid4 and produce ids that
+# sort by creation time. to use one, configure it on the Message class:
+#
+#   Message.id_generator = Counter()
+
+# a monotonic counter, prefixed with a node identifier. the counter starts at
+# the current time in microseconds, keeping ids increasing across restarts.
+
+class Counter(object):
+  def __init__(self, node=None):
+    if node is None:
+      node = "{0:012x}{1:06x}".format(uuid.getnode(), os.getpid() & 0xffffff)
+    self.prefix  = node + "-"
+    self.counter = itertools.count(int(time.time() * 1000000))
+
+  def __call__(self):
+    return "{0}{1:014x}".format(self.prefix, next(self.counter))
+
+# ULID-style ids: a 48-bit millisecond timestamp, followed by 80 random bits,
+# encoded in Crockford's base32. within the same millisecond, the random part
+# is incremented, keeping the ids monotonic. only the lower 40 bits of the
+# random part are encoded for each id, the rest is cached with the timestamp.
+
+CROCKFORD = "0123456789ABCDEFGHJKMNPQRSTVWXYZ"
+PAIRS     = [ a + b for a in CROCKFORD for b in CROCKFORD ]
+LOW       = (1 << 40) - 1
+RANDOM    = (1 << 80) - 1
+
+def encode(value, length):
+  chars = []
+  for _ in range(length):
+    chars.append(CROCKFORD[value & 31])
+    value >>= 5
+  return "".join(reversed(chars))
+
+class Ulid(object):
+  def __init__(self):
+    self.lock   = Lock()
+    self.last   = None
+    self.high   = None
+    self.prefix = None
+    self.random = 0
+
+  def __call__(self):
+    with self.lock:
+      now = int(time.time() * 1000)
+      if self.last is None or now > self.last:
+        self.last   = now
+        self.random = random.getrandbits(80)
+      else:
+        self.random = (self.random + 1) & RANDOM
+      high = (self.last << 40) | (self.random >> 40)
+      if high != self.high:
+        self.high   = high
+        self.prefix = encode(self.last, 10) + encode(self.random >> 40, 8)
+      prefix, low = self.prefix, self.random & LOW
+    return prefix + PAIRS[low >> 30] + PAIRS[(low >> 20) & 1023] \
+                  + PAIRS[(low >> 10) & 1023] + PAIRS[low & 1023]
@@ -1,3 +1,17 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+import base64
+import datetime
+
+from collections import OrderedDict
+from threading   import Lock
+
+from mqfactory.tools             import Hook, apply, touch
+from mqfactory.message.format    import envelope
+from mqfactory.message.security  import merkle
+
 class Signature(object):
   policy = None
 
@@ -5,23 +19,236 @@ class Signature(object):
     self.policy = policy
 
   def sign(self, message, *args, **kwargs):
-    if self.policy is None or self.policy.match(dict(message)).value is None:
+    if self.policy is None or self.policy.match(message).value is None:
       return self._sign(message, *args, **kwargs)
     return False
 
   def _sign(self, message):
     raise NotImplementedError("implement signing of message")
 
+  # batch variants, returning (message, exception) tuples for failures
+
+  def sign_all(self, messages):
+    return apply(self.sign, messages)[1]
+
+  def validate_all(self, messages):
+    return apply(self.validate, messages)[1]
+
   def validate(self, message, *args, **kwargs):
-    if self.policy is None or self.policy.match(dict(message)).value is None:
+    if self.policy is None or self.policy.match(message).value is None:
       return self._validate(message, *args, **kwargs)
     return False
 
   def _validate(self, message):
     raise NotImplementedError("implement validation of message")
 
-def Signing(mq, adding=Signature(), policy=None):
+# signatures using keys from a collection of { "private", "public" } keys per
+# origin. messages are tagged with a signature, holding the origin, a timestamp
+# and the (base64 encoded) hash of the canonical encoding of the message.
+#
+# in batch mode, messages that are signed together are signed once, using the
+# root of a Merkle tree of their canonical encodings. their hash then consists
+# of the signature of the root and the proof of their inclusion in the tree.
+# validated roots are cached, so a batch costs a single verification.
+
+class KeyedSignature(Signature):
+  def __init__(self, keys, me=None, policy=None, batch=False, roots=1024):
+    super(KeyedSignature, self).__init__(policy)
+    self.keys  = keys
+    self.me    = me
+    self.key   = self.keys[self.me]["private"]
+    self.batch = batch
+    self.roots = roots
+    self.valid = OrderedDict()
+    self.lock  = Lock()
+
+  def _sign(self, message, ts=None):
+    logger.debug("signing {0}".format(message.id))
+    self.prepare(message, ts)
+    message.tags["signature"]["hash"] = self.encode(
+      self.signed(message.private["canonical"], self.key)
+    )
+
+  # a message that can't be encoded is left untouched, so it can be retried
+  # without its batch
+
+  def prepare(self, message, ts=None):
+    message.tags["signature"] = {
+      "origin" : self.me,
+      "ts"     : ts or str(datetime.datetime.utcnow())
+    }
+    try:
+      message.private["canonical"] = envelope(message)
+    except Exception:
+      message.tags.pop("signature")
+      raise
+
+  def sign_all(self, messages):
+    if not self.batch or len(messages) < 2:
+      return super(KeyedSignature, self).sign_all(messages)
+    messages = [ message for message in messages \
+                 if self.policy is None or \
+                    self.policy.match(message).value is None ]
+    if not messages: return []
+    logger.debug("signing batch of {0} messages".format(len(messages)))
+    ts = str(datetime.datetime.utcnow())
+    messages, failed = apply(lambda message: self.prepare(message, ts), messages)
+    if not messages: return failed
+    root, proofs = merkle.tree([
+      merkle.leaf(message.private["canonical"]) for message in messages
+    ])
+    signature = self.encode(self.signed(root, self.key))
+    for message, proof in zip(messages, proofs):
+      message.tags["signature"]["hash"] = {
+        "root" : signature,
+        "proof": [ [ side, self.encode(sibling) ] for side, sibling in proof ]
+      }
+    return failed
+
+  def _validate(self, message):
+    origin    = message.tags["signature"]["origin"]
+    key       = self.keys[origin]["public"]
+    hash      = message.tags["signature"].pop("hash")
+    canonical = message.private.pop("canonical", None) or envelope(message)
+    if isinstance(hash, dict):
+      self.validate_root(origin, key, canonical, hash)
+    else:
+      self.verify(canonical, base64.b64decode(hash), key)
+    message.tags.pop("signature")
+
+  def validate_root(self, origin, key, canonical, hash):
+    root = merkle.root(merkle.leaf(canonical), [
+      (side, base64.b64decode(sibling)) for side, sibling in hash["proof"]
+    ])
+    cached = (origin, root, hash["root"])
+    with self.lock:
+      if cached in self.valid:
+        touch(self.valid, cached)
+        return
+    self.verify(root, base64.b64decode(hash["root"]), key)
+    with self.lock:
+      self.valid[cached] = True
+      while len(self.valid) > self.roots:
+        self.valid.popitem(last=False)
+
+  def encode(self, data):
+    return base64.b64encode(data).decode("ascii")
+
+  def signed(self, canonical, key):
+    raise NotImplementedError("implement signing of canonical encoding")
+
+  def verify(self, canonical, signature, key):
+    raise NotImplementedError("implement validation of canonical encoding")
+
+# runs signing and validation in a pool of threads or processes. all messages
+# of a batch are submitted before their results are collected, in order. worker
+# processes create their own signature once, using a (picklable) factory, e.g.
+# functools.partial(RsaSignature, keys, me="me"). batch signatures are given
+# the entire batch at once, returning the exception of each message that failed.
+
+worker = None
+
+def load(factory):
+  global worker
+  worker = factory()
+
+def sign(message, signature=None):
+  (signature or worker)._sign(message)
+  return message.tags, message.private.get("canonical")
+
+def sign_batch(messages, signature=None):
+  failed = dict(
+    (id(message), e) for message, e in (signature or worker).sign_all(messages)
+  )
+  return [ failed.get(id(message)) or \
+           (message.tags, message.private.get("canonical")) \
+           for message in messages ]
+
+def validate(message, signature=None):
+  (signature or worker)._validate(message)
+  return message.tags
+
+class Offloaded(Signature):
+  def __init__(self, signature, workers=4, processes=False, factory=None):
+    super(Offloaded, self).__init__(signature.policy)
+    self.signature = signature
+    self.batch     = getattr(signature, "batch", False)
+    if processes:
+      from concurrent.futures import ProcessPoolExecutor
+      assert factory, "worker processes need a factory to create a signature"
+      self.local    = None
+      self.executor = ProcessPoolExecutor(
+        workers, initializer=load, initargs=(factory,)
+      )
+    else:
+      from concurrent.futures import ThreadPoolExecutor
+      self.local    = signature
+      self.executor = ThreadPoolExecutor(workers)
+
+  def _sign(self, message):
+    self.signed(message, self.executor.submit(sign, message, self.local).result())
+
+  def _validate(self, message):
+    self.validated(
+      message, self.executor.submit(validate, message, self.local).result()
+    )
+
+  def sign_all(self, messages):
+    messages = [ message for message in messages \
+                 if self.policy is None or \
+                    self.policy.match(message).value is None ]
+    if self.batch and len(messages) > 1:
+      try:
+        results = self.executor.submit(sign_batch, messages, self.local).result()
+      except Exception as e:
+        return [ (message, e) for message in messages ]
+      failed = []
+      for message, result in zip(messages, results):
+        if isinstance(result, Exception):
+          failed.append((message, result))
+        else:
+          self.signed(message, result)
+      return failed
+    futures = [ self.executor.submit(sign, message, self.local) \
+                for message in messages ]
+    return self.collect(messages, futures, self.signed)
+
+  def validate_all(self, messages):
+    messages = [ message for message in messages \
+                 if self.policy is None or \
+                    self.policy.match(message).value is None ]
+    futures = [ self.executor.submit(validate, message, self.local) \
+                for message in messages ]
+    return self.collect(messages, futures, self.validated)
+
+  def collect(self, messages, futures, apply):
+    failed = []
+    for message, future in zip(messages, futures):
+      try:
+        apply(message, future.result())
+      except Exception as e:
+        failed.append((message, e))
+    return failed
+
+  def signed(self, message, result):
+    message.tags, canonical = result
+    if canonical: message.private["canonical"] = canonical
+
+  def validated(self, message, tags):
+    message.tags = tags
+    message.private.pop("canonical", None)
+
+  # waits for pending work, since processes that are left behind can keep the
+  # interpreter from exiting (Python 3.7)
+
+  def stop(self):
+    self.executor.shutdown()
+
+def Signing(mq, adding=Signature(), policy=None, workers=None, processes=False,
+            factory=None):
   if policy: adding.policy = policy
-  mq.before_sending.append(adding.sign)
-  mq.before_handling.append(adding.validate)
+  if workers: adding = Offloaded(adding, workers, processes, factory)
+  mq.signature = adding
+  mq.before_sending.append(Hook(adding.sign, adding.sign_all))
+  mq.before_handling.append(Hook(adding.validate, adding.validate_all))
   return mq
@@ -0,0 +1,25 @@
+import socket
+
+from cryptography.hazmat.primitives.asymmetric import ed25519
+
+from mqfactory.message.security      import KeyedSignature
+from mqfactory.message.security.keys import Decoded
+
+# Ed25519 signatures are a lot cheaper to create than RSA ones, and use the
+# same PEM encoded key documents, see keys.encode
+
+class Ed25519Signature(KeyedSignature):
+  def __init__(self, keys, me=socket.gethostname(), policy=None, batch=False):
+    super(Ed25519Signature, self).__init__(
+      Decoded(keys), me=me, policy=policy, batch=batch
+    )
+
+  def signed(self, canonical, key):
+    return key.sign(canonical)
+
+  def verify(self, canonical, signature, key):
+    key.verify(signature, canonical)
+
+def generate_key_pair():
+  key = ed25519.Ed25519PrivateKey.generate()
+  return key, key.public_key()
@@ -0,0 +1,36 @@
+import os
+import hmac
+import socket
+import hashlib
+
+from cryptography.exceptions import InvalidSignature
+
+from mqfactory.message.security      import KeyedSignature
+from mqfactory.message.security.keys import Decoded
+
+# HMAC signatures use a shared secret per origin, stored in a key document as
+# { "secret" : ... }. all parties that validate messages from an origin need
+# its secret, which also allows them to sign messages as that origin. secrets
+# are cached like decoded keys.
+
+class Secrets(Decoded):
+  def parse(self, key):
+    secret = key["secret"]
+    if not isinstance(secret, bytes): secret = secret.encode("utf-8")
+    return { "private" : secret, "public" : secret }
+
+class HmacSignature(KeyedSignature):
+  def __init__(self, keys, me=socket.gethostname(), policy=None, batch=False):
+    super(HmacSignature, self).__init__(
+      Secrets(keys), me=me, policy=policy, batch=batch
+    )
+
+  def signed(self, canonical, key):
+    return hmac.new(key, canonical, hashlib.sha256).digest()
+
+  def verify(self, canonical, signature, key):
+    if not hmac.compare_digest(self.signed(canonical, key), signature):
+      raise InvalidSignature()
+
+def generate_secret(size=32):
+  return os.urandom(size)
@@ -0,0 +1,113 @@
+from collections import OrderedDict
+from threading   import Lock
+
+from cryptography.hazmat.backends import default_backend
+
+from cryptography.hazmat.primitives import serialization
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from mqfactory.tools import clock, touch
+
+# PEM encoding and decoding of asymmetric keys, and a wrapper for a collection
+# of keys that transparently decodes PEM encoded keys. decoded keys are cached
+# for ttl ms, keeping at most size keys, evicting the least recently used ones.
+# unknown keys are also cached, for a shorter negative_ttl ms, avoiding repeated
+# lookups for unknown origins, while still picking up newly added keys soon.
+# keys that are changed in the collection can be invalidated explicitly.
+
+MISSING = object()
+
+class Decoded(object):
+  def __init__(self, keys, size=1024, ttl=300000, negative_ttl=5000):
+    self.keys         = keys
+    self.size         = size
+    self.ttl          = ttl
+    self.negative_ttl = negative_ttl
+    self.cache        = OrderedDict()
+    self.lock         = Lock()
+    self.hits         = 0
+    self.misses       = 0
+
+  def __getitem__(self, name):
+    now = clock.now()
+    with self.lock:
+      entry = self.cache.get(name)
+      if entry and entry[0] > now:
+        touch(self.cache, name)
+        self.hits += 1
+        key = entry[1]
+      else:
+        self.misses += 1
+        key = None
+    if key is None:
+      key = self.load(name)
+      ttl = self.negative_ttl if key is MISSING else self.ttl
+      with self.lock:
+        self.cache.pop(name, None)
+        self.cache[name] = (now + ttl, key)
+        while len(self.cache) > self.size:
+          self.cache.popitem(last=False)
+    if key is MISSING: raise KeyError(name)
+    return key
+
+  # collections return None for unknown keys, mappings raise a KeyError
+
+  def load(self, name):
+    try:
+      key = self.keys[name]
+    except KeyError:
+      key = None
+    if key is None: return MISSING
+    return self.parse(key)
+
+  def parse(self, key):
+    decoded = {}
+    for part in [ "private", "public" ]:
+      if not part in key: continue
+      value = key[part]
+      decoded[part] = decode(value) if isinstance(value, (bytes, str)) else value
+    return decoded
+
+  def invalidate(self, name=None):
+    with self.lock:
+      if name is None:
+        self.cache.clear()
+      else:
+        self.cache.pop(name, None)
+
+  def stats(self):
+    return { "hits" : self.hits, "misses" : self.misses, "size" : len(self.cache) }
+
+def encode(key):
+  if not hasattr(key, "private_bytes"):
+    return key.public_bytes(
+      encoding=serialization.Encoding.PEM,
+      format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+  if isinstance(key, rsa.RSAPrivateKey):
+    format = serialization.PrivateFormat.TraditionalOpenSSL
+  else:
+    format = serialization.PrivateFormat.PKCS8
+  return key.private_bytes(
+    encoding=serialization.Encoding.PEM,
+    format=format,
+    encryption_algorithm=serialization.NoEncryption()
+  )
+
+def decode(pem):
+  try:
+    pem = pem.encode("ascii","ignore") # unicode -> str
+  except AttributeError:
+    pass
+  if b"PUBLIC KEY" in pem:
+    return serialization.load_pem_public_key(
+      pem,
+      backend=default_backend()
+    )
+  else:
+    return serialization.load_pem_private_key(
+      pem,
+      password=None,
+      backend=default_backend()
+    )
@@ -0,0 +1,35 @@
+import hashlib
+
+# a Merkle tree over a batch of messages, allowing to sign all of them at once
+# by signing the root. each message gets a proof, a list of (side, sibling)
+# pairs, to recompute the root from its own leaf hash. leaves and nodes are
+# hashed with a different prefix, so a node can't pose as a leaf. an odd node
+# at the end of a level is moved up as-is.
+
+def leaf(data):
+  return hashlib.sha256(b"\x00" + data).digest()
+
+def node(left, right):
+  return hashlib.sha256(b"\x01" + left + right).digest()
+
+def tree(leaves):
+  proofs  = [ [] for _ in leaves ]
+  level   = list(leaves)
+  members = [ [ index ] for index in range(len(leaves)) ]
+  while len(level) > 1:
+    hashes, groups = [], []
+    for i in range(0, len(level) - 1, 2):
+      for index in members[i]:   proofs[index].append(("R", level[i+1]))
+      for index in members[i+1]: proofs[index].append(("L", level[i]))
+      hashes.append(node(level[i], level[i+1]))
+      groups.append(members[i] + members[i+1])
+    if len(level) % 2:
+      hashes.append(level[-1])
+      groups.append(members[-1])
+    level, members = hashes, groups
+  return level[0], proofs
+
+def root(hash, proof):
+  for side, sibling in proof:
+    hash = node(sibling, hash) if side == "L" else node(hash, sibling)
+  return hash
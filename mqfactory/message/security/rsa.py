@@ -1,58 +1,32 @@
-import sys
 import logging
 
 logger = logging.getLogger(__name__)
 
 import base64
-import json
-import datetime
+import socket
 
 from cryptography.hazmat.backends import default_backend
 
 from cryptography.hazmat.primitives import hashes
-from cryptography.hazmat.primitives import serialization
 
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.primitives.asymmetric import padding
 
-from mqfactory.message.security import Signature
-
-import socket
-
-class Decoded(object):
-  def __init__(self, keys):
-    self.keys = keys
+from mqfactory.message.security      import KeyedSignature
+from mqfactory.message.security.keys import Decoded, encode, decode
+from mqfactory.message.format        import envelope
 
-  def __getitem__(self, name):
-    key = self.keys[name]
-    if not isinstance(key["public"], rsa.RSAPublicKey):
-      return {
-        "private": decode(key["private"]),
-        "public" : decode(key["public"])
-      }
-    return key
+class RsaSignature(KeyedSignature):
+  def __init__(self, keys, me=socket.gethostname(), policy=None, batch=False):
+    super(RsaSignature, self).__init__(
+      Decoded(keys), me=me, policy=policy, batch=batch
+    )
 
-class RsaSignature(Signature):
-  def __init__(self, keys, me=socket.gethostname()):
-    self.keys = Decoded(keys)
-    self.me   = me
-    self.key  = self.keys[self.me]["private"]
+  def signed(self, canonical, key):
+    return sign(base64.b64encode(canonical), key)
 
-  def _sign(self, message, ts=None):
-    logger.debug("signing {0}".format(message.id))
-    message.tags["signature"] = {
-      "origin" : self.me,
-      "ts"     : ts or str(datetime.datetime.utcnow())
-    }
-    payload = serialize(message)
-    message.tags["signature"]["hash"] = base64.b64encode(sign(payload, self.key))
-  
-  def _validate(self, message):
-    key = self.keys[message.tags["signature"]["origin"]]["public"]
-    signature =  base64.b64decode(message.tags["signature"].pop("hash"))
-    payload = serialize(message)    
-    validate(payload, signature, key)
-    message.tags.pop("signature")
+  def verify(self, canonical, signature, key):
+    validate(base64.b64encode(canonical), signature, key)
 
 # utility functions wrapping cryptography functions
 
@@ -64,42 +38,12 @@ def generate_key_pair():
   )
   return key, key.public_key()
 
-def encode(key):
-  if isinstance(key, rsa.RSAPublicKey):
-    return key.public_bytes(
-      encoding=serialization.Encoding.PEM,
-      format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
-  else:
-    return key.private_bytes(
-      encoding=serialization.Encoding.PEM,
-      format=serialization.PrivateFormat.TraditionalOpenSSL,
-      encryption_algorithm=serialization.NoEncryption()
-    )
-
-def decode(pem):
-  try:
-    pem = pem.encode("ascii","ignore") # unicode -> str
-  except AttributeError:
-    pass
-  if b"PUBLIC KEY" in pem:
-    return serialization.load_pem_public_key(
-      pem,
-      backend=default_backend()
-    )
-  else:
-    return serialization.load_pem_private_key(
-      pem,
-      password=None,
-      backend=default_backend()
-    )
+# signs the canonical encoding of a message, when it is known, e.g. because it
+# was received like that, or it is computed
 
-def serialize(message):
-  serialized = json.dumps({
-    "tags" : message.tags,
-    "payload" : message.payload
-  }, sort_keys=True).encode("utf-8")
-  return base64.b64encode(serialized)
+def serialize(message, canonical=None):
+  if canonical is None: canonical = envelope(message)
+  return base64.b64encode(canonical)
 
 def sign(payload, key):
   return key.sign(
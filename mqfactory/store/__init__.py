@@ -3,6 +3,7 @@ import logging
 logger = logging.getLogger(__name__)
 
 from mqfactory.message import Message
+from mqfactory.tools   import Hook
 
 class Store(object):
   def __getitem__(self, key):
@@ -24,6 +25,14 @@ class Collection(object):
   def update(self, key, item):
     raise NotImplementedError("implement updating item in the collection")
 
+  # batch variants, implementations can override these with bulk operations
+
+  def remove_all(self, keys):
+    for key in keys: self.remove(key)
+
+  def update_all(self, updates):
+    for key, item in updates: self.update(key, item)
+
 class MessageStore(object):
   def __init__(self, queue, collection):
     self.queue      = queue
@@ -33,8 +42,8 @@ class MessageStore(object):
     self.queue.before_add.append(self.before_add)
     self.queue.after_add.append(self.after_add)
     self.queue.before_remove.append(self.before_remove)
-    self.queue.after_remove.append(self.after_remove)
-    self.queue.after_defer.append(self.after_defer)
+    self.queue.after_remove.append(Hook(self.after_remove, self.after_remove_all))
+    self.queue.after_defer.append(Hook(self.after_defer, self.after_defer_all))
     self.queue.before_get.append(self.before_get)
 
   def before_add(self, message):
@@ -51,6 +60,11 @@ class MessageStore(object):
 
   def after_remove(self, message):
     self.collection.remove(message.private["store-id"])
+
+  def after_remove_all(self, messages):
+    self.collection.remove_all([
+      message.private["store-id"] for message in messages
+    ])
     
   def before_get(self, message=None):
     self.load_messages()
@@ -63,6 +77,16 @@ class MessageStore(object):
         str(message), str(e)
       ))
 
+  def after_defer_all(self, messages):
+    try:
+      self.collection.update_all([
+        (message.private["store-id"], dict(message)) for message in messages
+      ])
+    except Exception as e:
+      logger.error("store: after_defer: update of {0} messages failed: {1}".format(
+        len(messages), str(e)
+      ))
+
   def load_messages(self):
     if not self.loaded:
       logger.info("loading messages...")
@@ -73,7 +97,8 @@ class MessageStore(object):
       self.loaded = True
       logger.info("loaded")
 
-def Persisting(mq, outbox=None, inbox=None):
+def Persisting(mq, outbox=None, inbox=None, dead=None):
   if outbox: MessageStore(mq.outbox, outbox)
   if inbox:  MessageStore(mq.inbox,  inbox)
+  if dead:   MessageStore(mq.dead,   dead)
   return mq
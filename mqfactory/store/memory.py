@@ -0,0 +1,50 @@
+import copy
+import itertools
+import logging
+
+logger = logging.getLogger(__name__)
+
+from mqfactory.store import Store, Collection
+
+# in-memory implementation of a store, e.g. for testing and benchmarking.
+# documents are copied when stored and loaded, mimicking an actual database.
+
+class MemoryStore(Store):
+  def __init__(self):
+    self.collections = {}
+
+  def __getitem__(self, collection):
+    if not collection in self.collections:
+      self.collections[collection] = MemoryCollection()
+    return self.collections[collection]
+
+class MemoryCollection(Collection):
+  def __init__(self):
+    self.docs = {}
+    self.ids  = itertools.count(1)
+
+  def load(self):
+    docs = []
+    for id, doc in self.docs.items():
+      doc = copy.deepcopy(doc)
+      doc["_id"] = id
+      docs.append(doc)
+    return docs
+
+  def __getitem__(self, id):
+    doc = self.docs.get(id)
+    return None if doc is None else copy.deepcopy(doc)
+
+  def add(self, doc):
+    doc = copy.deepcopy(doc)
+    id  = doc.pop("_id", None) or str(next(self.ids))
+    self.docs[id] = doc
+    return id
+
+  def remove(self, id):
+    self.docs.pop(id, None)
+
+  def update(self, id, doc):
+    doc = copy.deepcopy(doc)
+    doc.pop("_id", None)
+    self.docs[id].update(doc)
@@ -3,7 +3,7 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from bson.objectid import ObjectId 
 
 from mqfactory.store import Store, Collection
@@ -56,6 +56,11 @@ class MongoCollection(Collection):
       pass
     self.collection.delete_one({"_id" : id})
 
+  def remove_all(self, ids):
+    self.collection.delete_many({"_id" : { "$in" : [
+      object_id(id) for id in ids
+    ]}})
+
   def update(self, id, doc):
     updated_doc = copy.deepcopy(doc)
     try:
@@ -64,3 +69,15 @@ class MongoCollection(Collection):
     except:
       pass
     self.collection.update_one({"_id" : id}, {"$set" : updated_doc})
+
+  def update_all(self, updates):
+    if not updates: return
+    self.collection.bulk_write([
+      UpdateOne({"_id" : object_id(id)}, {"$set" : doc}) for id, doc in updates
+    ], ordered=False)
+
+def object_id(id):
+  try:
+    return ObjectId(id)
+  except:
+    return id
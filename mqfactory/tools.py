@@ -7,11 +7,139 @@ class Millis(object):
     return int(round(time.time() * 1000))
 clock = Millis()
 
+# moves a key of an OrderedDict to its end, marking it as most recently used,
+# also on python 2, which lacks OrderedDict.move_to_end
+
+def touch(ordered, key):
+  ordered[key] = ordered.pop(key)
+
 # helper function to apply a list of functions to an object
 
 def wrap(msg, wrappers):
   for wrapper in wrappers: wrapper(msg)
 
+# a hook is a wrapper that also offers a batch variant, accepting a list of
+# messages and returning a list of (message, exception) tuples for failures
+
+class Hook(object):
+  def __init__(self, each, many):
+    self.each = each
+    self.many = many
+
+  def __call__(self, msg):
+    return self.each(msg)
+
+  def __eq__(self, other):
+    if isinstance(other, Hook): other = other.each
+    return self.each == other
+
+  def __ne__(self, other):
+    return not self == other
+
+  def __hash__(self):
+    return hash(self.each)
+
+# helper functions to apply a function to a list of messages, collecting the
+# failing messages, and to apply a list of wrappers, preferring batch variants
+
+def apply(function, msgs):
+  done, failed = [], []
+  for msg in msgs:
+    try:
+      function(msg)
+      done.append(msg)
+    except Exception as e:
+      failed.append((msg, e))
+  return done, failed
+
+def wrap_all(msgs, wrappers):
+  failed = []
+  for wrapper in wrappers:
+    if not msgs: break
+    many = getattr(wrapper, "many", None)
+    if many and len(msgs) > 1:
+      try:
+        failures = many(msgs) or []
+      except Exception as e:
+        failures = [ (msg, e) for msg in msgs ]
+      failing  = set(id(msg) for msg, _ in failures)
+      msgs     = [ msg for msg in msgs if not id(msg) in failing ]
+    else:
+      msgs, failures = apply(wrapper, msgs)
+    failed.extend(failures)
+  return msgs, failed
+
+# the distinct handlers of a list of (order, handler) matches, in order. a
+# handler that is registered for several matching patterns is called once.
+
+def distinct(matches):
+  handlers = []
+  for _, handler in sorted(matches):
+    if not handler in handlers: handlers.append(handler)
+  return handlers
+
+# a trie of MQTT-style topic patterns, supporting + and # wildcards, mapping
+# topics to the values of all matching patterns in O(topic depth). as in MQTT,
+# wildcards at the first level don't match topics starting with $.
+
+class TopicNode(object):
+  __slots__ = ("children", "values")
+
+  def __init__(self):
+    self.children = {}
+    self.values   = []
+
+class TopicTrie(object):
+  def __init__(self):
+    self.root  = TopicNode()
+    self.count = 0
+
+  def add(self, pattern, value):
+    node = self.root
+    for level in pattern.split("/"):
+      node = node.children.setdefault(level, TopicNode())
+    node.values.append(value)
+    self.count += 1
+
+  def remove(self, pattern, value):
+    levels = pattern.split("/")
+    path   = [ self.root ]
+    for level in levels:
+      node = path[-1].children.get(level)
+      if node is None: return False
+      path.append(node)
+    try:
+      path[-1].values.remove(value)
+    except ValueError:
+      return False
+    self.count -= 1
+    for depth in range(len(levels), 0, -1):    # prune empty nodes
+      if path[depth].values or path[depth].children: break
+      del path[depth-1].children[levels[depth-1]]
+    return True
+
+  def match(self, topic):
+    levels  = topic.split("/")
+    last    = len(levels)
+    matches = []
+    nodes   = [ (self.root, 0) ]
+    while nodes:
+      node, depth = nodes.pop()
+      wildcards   = not (depth == 0 and topic.startswith("$"))
+      if wildcards and "#" in node.children:
+        matches.extend(node.children["#"].values)
+      if depth == last:
+        matches.extend(node.values)
+        continue
+      child = node.children.get(levels[depth])
+      if child: nodes.append((child, depth + 1))
+      if wildcards and "+" in node.children:
+        nodes.append((node.children["+"], depth + 1))
+    return matches
+
+  def __len__(self):
+    return self.count
+
 # basic first-match Policy
 
 class Rule(object):
@@ -21,18 +149,88 @@ class Rule(object):
 
   def matches(self, instance):
     for key, value in self.pattern.items():
-      try: assert self.match(instance[key], value)
-      except: return False
+      try:
+        if not self.match(instance[key], value): return False
+      except Exception:
+        return False
     return True
 
   def match(self, actual, expected):
     return actual == expected
 
+  # returns how the rule can be looked up: ("exact", key, value), using one of
+  # its (hashable) key/value pairs, or None if it always needs to be checked
+
+  def index(self):
+    if type(self).match != Rule.match: return None
+    for key, value in self.pattern.items():
+      try:
+        hash(value)
+        return ("exact", key, value)
+      except TypeError:
+        pass
+    return None
+
 CATCH_ALL = Rule({}, None)
 
+# rules are compiled into hash maps for exact matches and tries for topic
+# patterns, selecting candidate rules, which are checked in order. when all
+# rules only consider the topic ("to"), the result is cached per topic.
+# rules are compiled again when rules are added, removed or replaced. after
+# changing the pattern of a rule itself, call `invalidate()`.
+
 class Policy(object):
-  def __init__(self, rules=[]):
-    self.rules = rules
+  def __init__(self, rules=[], cache=10000):
+    self.rules    = rules
+    self.cache    = cache
+    self.compiled = None
+
+  def compile(self):
+    self.exact    = {}
+    self.topics   = {}
+    self.always   = []
+    self.results  = {}
+    self.topical  = True
+    for order, rule in enumerate(self.rules):
+      if set(rule.pattern) - set([ "to" ]): self.topical = False
+      index = rule.index()
+      if index is None:
+        self.always.append(order)
+      elif index[0] == "exact":
+        self.exact.setdefault(index[1], {}).setdefault(index[2], []).append(order)
+      else:
+        self.topics.setdefault(index[1], TopicTrie()).add(index[2], order)
+    self.compiled = list(self.rules)
+
+  def invalidate(self):
+    self.compiled = None
 
   def match(self, instance):
-    return next((rule for rule in self.rules if rule.matches(instance)), CATCH_ALL)
+    if self.compiled != self.rules: self.compile()
+    if not (self.topical and self.cache): return self.first(instance)
+    try:
+      topic = instance["to"]
+    except Exception:
+      return self.first(instance)
+    rule = self.results.get(topic)
+    if rule is None:
+      rule = self.first(instance)
+      if len(self.results) >= self.cache: self.results.clear()
+      self.results[topic] = rule
+    return rule
+
+  def first(self, instance):
+    candidates = list(self.always)
+    for key, values in self.exact.items():
+      try:
+        candidates.extend(values.get(instance[key], []))
+      except Exception:
+        pass
+    for key, trie in self.topics.items():
+      try:
+        candidates.extend(trie.match(instance[key]))
+      except Exception:
+        pass
+    for order in sorted(candidates):
+      if self.rules[order].matches(instance): return self.rules[order]
+    return CATCH_ALL
@@ -2,10 +2,22 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+from mqfactory.tools import apply
+
+# failures of the transport itself to send a message, e.g. while the broker is
+# unreachable, are marked, to tell them apart from e.g. formatting failures
+
+def mark_failure(error):
+  error.transport = True
+
+def is_transport_failure(error):
+  return getattr(error, "transport", False)
+
 class Transport(object):
   def __init__(self):
     self.before_sending  = []
     self.after_receiving = []
+    self.wrapped         = []  # (handler, wrapped handler)
 
   def connect(self):
     raise NotImplementedError("implement connecting to the transport")
@@ -14,21 +26,41 @@ class Transport(object):
     raise NotImplementedError("implement disconnecting from the transport")
 
   def send(self, message):
-    message = message.copy()
+    message = message.copy(deep=False)  # wrappers replace, not change, parts
     for wrapper in self.before_sending:
       wrapper(message)
     logger.debug("sending: {0}".format(message))
-    self._send(message)
+    try:
+      self._send(message)
+    except Exception as e:
+      mark_failure(e)
+      raise
+
+  # sends a batch of messages, returning (message, exception) tuples for the
+  # messages that failed to be sent
+
+  def send_all(self, messages):
+    return apply(self.send, messages)[1]
 
   def _send(self, message):
     raise NotImplementedError("implement sending using transport")
 
+  # a handler is wrapped once, so when it is registered for several patterns,
+  # it can be recognized and called once per message. handlers are compared,
+  # not hashed, since e.g. bound methods of lists can't be hashed on Python 3.7
+
   def on_message(self, to, handler):
+    self._on_message(to, self.wrap(handler))
+
+  def wrap(self, handler):
+    for known, wrapped in self.wrapped:
+      if known == handler: return wrapped
     def wrapped_handler(message):
       for wrapper in self.after_receiving[::-1]:
         wrapper(message)
       handler(message)
-    self._on_message(to, wrapped_handler)
+    self.wrapped.append((handler, wrapped_handler))
+    return wrapped_handler
 
   def _on_message(self, to, handler):
     raise NotImplementedError("implement message callback registration")
@@ -0,0 +1,78 @@
+import asyncio
+import inspect
+import logging
+
+logger = logging.getLogger(__name__)
+
+from mqfactory.transport import mark_failure
+
+# asyncio counterpart of the Transport base class. wrappers and handlers can
+# be plain functions or coroutine functions, so the same formatting aspects
+# (e.g. JsonFormatting) can be applied to both kinds of transports.
+
+async def call(function, *args):
+  result = function(*args)
+  if inspect.isawaitable(result):
+    result = await result
+  return result
+
+class AsyncTransport(object):
+  def __init__(self):
+    self.before_sending  = []
+    self.after_receiving = []
+    self.wrapped         = []  # (handler, wrapped handler)
+
+  async def connect(self):
+    raise NotImplementedError("implement connecting to the transport")
+
+  async def disconnect(self):
+    raise NotImplementedError("implement disconnecting from the transport")
+
+  async def send(self, message):
+    message = message.copy(deep=False)  # wrappers replace, not change, parts
+    for wrapper in self.before_sending:
+      await call(wrapper, message)
+    logger.debug("sending: {0}".format(message))
+    try:
+      await self._send(message)
+    except Exception as e:
+      mark_failure(e)
+      raise
+
+  async def send_all(self, messages):
+    failed = []
+    for message in messages:
+      try:
+        await self.send(message)
+      except Exception as e:
+        failed.append((message, e))
+    return failed
+
+  async def _send(self, message):
+    raise NotImplementedError("implement sending using transport")
+
+  def on_message(self, to, handler):
+    self._on_message(to, self.wrap(handler))
+
+  def wrap(self, handler):
+    for known, wrapped in self.wrapped:
+      if known == handler: return wrapped
+    async def wrapped_handler(message):
+      for wrapper in self.after_receiving[::-1]:
+        await call(wrapper, message)
+      await call(handler, message)
+    self.wrapped.append((handler, wrapped_handler))
+    return wrapped_handler
+
+  def _on_message(self, to, handler):
+    raise NotImplementedError("implement message callback registration")
+
+  # schedules handling of a received message on the event loop
+
+  def receive(self, handler, message):
+    task = asyncio.ensure_future(handler(message))
+    task.add_done_callback(self.received)
+
+  def received(self, task):
+    if not task.cancelled() and task.exception():
+      logger.error("receiving failed: {0}".format(repr(task.exception())))
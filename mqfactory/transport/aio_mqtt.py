@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import itertools
+
+logger = logging.getLogger(__name__)
+
+from urllib.parse import urlparse
+
+import paho.mqtt.client as mqtt
+
+from mqfactory.message        import Message
+from mqfactory.transport.aio  import AsyncTransport
+from mqfactory.transport.mqtt import BATCH
+from mqfactory.tools          import TopicTrie, distinct
+
+# an MQTT transport running the paho client on an asyncio event loop, instead
+# of in its own network thread: the client's socket is registered with the
+# loop, which calls the client's read and write functions when needed.
+# incoming messages are dispatched using a trie, as with the MQTTTransport.
+# after an unexpected disconnect, the transport reconnects with an exponentially
+# growing delay (in seconds), resubscribing once connected again.
+
+class AsyncMQTTTransport(AsyncTransport):
+  def __init__(self, uri, paho=None, id="", qos=0, loop=None,
+                     reconnect_delay=1, max_reconnect_delay=60):
+    super(AsyncMQTTTransport, self).__init__()
+    self.client = paho or mqtt.Client()
+    self.client.reinitialise(client_id=id)
+    self.id     = id
+    self.qos    = qos
+    self.loop   = loop
+    self.client.on_connect      = self.handle_on_connect
+    self.client.on_disconnect   = self.handle_on_disconnect
+    self.client.on_message      = self.handle_on_message
+    self.client.on_socket_open  = self.handle_on_socket_open
+    self.client.on_socket_close = self.handle_on_socket_close
+    self.client.on_socket_register_write   = self.handle_on_register_write
+    self.client.on_socket_unregister_write = self.handle_on_unregister_write
+
+    self.config = urlparse(uri)
+    if self.config.username and self.config.password:
+      self.client.username_pw_set(self.config.username, self.config.password)
+    self.connected     = None
+    self.misc          = None
+    self.reconnecting  = None
+    self.delay         = reconnect_delay
+    self.max_delay     = max_reconnect_delay
+    self.subscriptions = TopicTrie()
+    self.patterns      = {}
+    self.order         = itertools.count()
+
+  def handle_on_connect(self, client, id, flags, rc):
+    if rc == 0:
+      patterns = list(self.patterns)
+      for i in range(0, len(patterns), BATCH):
+        self.client.subscribe([ (sub, 0) for sub in patterns[i:i+BATCH] ])
+      if not self.connected.done(): self.connected.set_result(True)
+    elif not self.connected.done():
+      self.connected.set_exception(ConnectionError("MQTT connect failed: {0}".format(rc)))
+
+  def handle_on_disconnect(self, client, userdata, rc):
+    connected, self.connected = self.connected, None
+    if connected and not connected.done():
+      connected.set_exception(ConnectionError("MQTT disconnected: {0}".format(rc)))
+    if rc != mqtt.MQTT_ERR_SUCCESS and not self.reconnecting:
+      logger.warning("MQTT disconnected unexpectedly: {0}".format(rc))
+      self.reconnecting = self.loop.create_task(self.reconnect())
+
+  async def reconnect(self):
+    delay = self.delay
+    try:
+      while True:
+        await asyncio.sleep(delay)
+        try:
+          await self.connect()
+          logger.info("MQTT reconnected")
+          return
+        except Exception as e:
+          logger.warning("MQTT reconnect failed: {0}".format(repr(e)))
+          delay = min(delay * 2, self.max_delay)
+    finally:
+      self.reconnecting = None
+
+  def handle_on_socket_open(self, client, userdata, sock):
+    self.loop.add_reader(sock, client.loop_read)
+    self.misc = self.loop.create_task(self.misc_loop())
+
+  def handle_on_socket_close(self, client, userdata, sock):
+    self.loop.remove_reader(sock)
+    if self.misc: self.misc.cancel()
+
+  def handle_on_register_write(self, client, userdata, sock):
+    self.loop.add_writer(sock, client.loop_write)
+
+  def handle_on_unregister_write(self, client, userdata, sock):
+    self.loop.remove_writer(sock)
+
+  async def misc_loop(self):
+    while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+      try:
+        await asyncio.sleep(1)
+      except asyncio.CancelledError:
+        break
+
+  def handle_on_message(self, client, userdata, msg):
+    for handler in distinct(self.subscriptions.match(msg.topic)):
+      self.receive(handler, Message(msg.topic, msg.payload))
+
+  def is_connected(self):
+    return self.connected is not None and self.connected.done() \
+       and not self.connected.exception()
+
+  async def connect(self):
+    self.loop = self.loop or asyncio.get_event_loop()
+    self.connected = self.loop.create_future()
+    self.client.connect(self.config.hostname, self.config.port)
+    await self.connected
+
+  async def disconnect(self):
+    if self.reconnecting: self.reconnecting.cancel()
+    self.client.disconnect()
+
+  async def _send(self, message):
+    assert self.is_connected()
+    self.client.publish(message.to, message.payload, self.qos)
+
+  def _on_message(self, to, handler):
+    self.subscriptions.add(to, (next(self.order), handler))
+    if to in self.patterns: return
+    self.patterns[to] = True
+    if self.is_connected():
+      self.client.subscribe(to)
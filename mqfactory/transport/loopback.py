@@ -0,0 +1,46 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+import itertools
+
+from mqfactory.message   import Message
+from mqfactory.transport import Transport
+from mqfactory.tools     import TopicTrie, distinct
+
+# an in-process transport, delivering messages to all subscriptions on the same
+# broker, using MQTT topic semantics, without any network involved. only the
+# payload is passed on, just like a real transport would do.
+
+class Loopback(object):
+  def __init__(self):
+    self.subscriptions = TopicTrie()
+    self.order         = itertools.count()
+
+  def subscribe(self, sub, handler):
+    self.subscriptions.add(sub, (next(self.order), handler))
+
+  def publish(self, to, payload):
+    for handler in distinct(self.subscriptions.match(to)):
+      handler(Message(to, payload))
+
+BROKER = Loopback()
+
+class LoopbackTransport(Transport):
+  def __init__(self, broker=None):
+    super(LoopbackTransport, self).__init__()
+    self.broker    = broker or BROKER
+    self.connected = False
+
+  def connect(self):
+    self.connected = True
+
+  def disconnect(self):
+    self.connected = False
+
+  def _send(self, message):
+    assert self.connected
+    self.broker.publish(message.to, message.payload)
+
+  def _on_message(self, to, handler):
+    self.broker.subscribe(to, handler)
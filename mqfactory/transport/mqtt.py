@@ -3,12 +3,20 @@ try:
 except ImportError:                 # pragma: no cover
   from urlparse import urlparse
 
+import itertools
+
 import paho.mqtt.client as mqtt
 
 from mqfactory.message   import Message
 from mqfactory.transport import Transport
 
-from mqfactory.tools     import Rule
+from mqfactory.tools     import Rule, TopicTrie, distinct
+
+# incoming messages are dispatched to all handlers with a matching subscription
+# using a trie, instead of paho's per subscription callbacks. the broker is
+# subscribed to once per subscription, in batches when (re)connecting.
+
+BATCH = 100
 
 class MQTTTransport(Transport):
   def __init__(self, uri, paho=None, id="", qos=0):
@@ -19,24 +27,26 @@ class MQTTTransport(Transport):
     self.qos    = qos
     self.client.on_connect    = self.handle_on_connect
     self.client.on_disconnect = self.handle_on_disconnect
+    self.client.on_message    = self.handle_on_message
 
     self.config = urlparse(uri)
     if self.config.username and self.config.password:
       self.client.username_pw_set(self.config.username, self.config.password)
-    self.connected = False
-    self.subscriptions = []
+    self.connected     = False
+    self.subscriptions = TopicTrie()
+    self.patterns      = {}
+    self.order         = itertools.count()
 
   def handle_on_connect(self, client, id, flags, rc):
     if rc == 0:
       self.connected = True
-      for (sub, callback) in self.subscriptions:
-        self.register_callback(sub, callback)
+      patterns = list(self.patterns)
+      for i in range(0, len(patterns), BATCH):
+        self.client.subscribe([ (sub, 0) for sub in patterns[i:i+BATCH] ])
 
-  def register_callback(self, sub, callback):
-    def wrapped_callback(client, userdata, msg):
-      callback(Message(msg.topic, msg.payload))
-    self.client.subscribe(sub)
-    self.client.message_callback_add(sub, wrapped_callback)
+  def handle_on_message(self, client, userdata, msg):
+    for handler in distinct(self.subscriptions.match(msg.topic)):
+      handler(Message(msg.topic, msg.payload))
 
   def handle_on_disconnect(self,):
     self.connected = False
@@ -53,10 +63,17 @@ class MQTTTransport(Transport):
     self.client.publish(message.to, message.payload, self.qos)
 
   def _on_message(self, to, handler):
-    self.subscriptions.append((to, handler))
+    self.subscriptions.add(to, (next(self.order), handler))
+    if to in self.patterns: return
+    self.patterns[to] = True
     if self.connected:
-      self.register_callback(to, handler)
+      self.client.subscribe(to)
 
 class TransportRule(Rule):
   def match(self, actual, expected):
     return mqtt.topic_matches_sub(expected, actual)
+
+  def index(self):
+    for key, value in self.pattern.items():
+      if isinstance(value, str): return ("topic", key, value)
+    return None
@@ -3,8 +3,12 @@ import logging
 
 logger = logging.getLogger(__name__)
 
-from mqfactory         import DeferException
-from mqfactory.tools   import clock
+from collections import OrderedDict
+from threading   import Lock, Timer
+
+from mqfactory         import DeferException, DropException
+from mqfactory.tools   import clock, Hook, touch
+from mqfactory.Queue   import HIGH
 from mqfactory.message import Message
 
 '''
@@ -12,26 +16,116 @@ Acknowledgment works in several phases:
 - when used, a subscription on an ack channel is made
 - when sending a message, an "ack" tag is added, containing the ack channel
 - after sending the message, the send message is added back to the outbox with
-  a timestamp
+  a timestamp and is only made available again when the timeout has passed
 - if the message is ready to be send again, but the time since sending it hasn't
-  surpassed a timeout, sending is defered
+  surpassed a timeout, sending is defered until the timeout
 - if the message is ready to be send again, and the the timeout has passed, it
   is just send again
 - if an acknowledgement is received, the corresponding message is removed
+- acknowledgements are sent with a high priority, to avoid having them wait
+  behind bulk messages, both at the sending and receiving side
+- confirms for messages that are handled in the same batch are combined into a
+  single acknowledgement per ack channel, holding a list of ids. optionally
+  confirms are collected for a window (in ms), or until max_confirms are
+  pending, before sending them.
+- the timeout adapts to the round-trip times that are measured per destination,
+  and is doubled for every resend of a message
 '''
 
-def check_timeout(message):
+TIMEOUT     = 5000
+MIN_TIMEOUT = 200
+MAX_TIMEOUT = 60000
+
+def check_timeout(message, timeout=TIMEOUT):
   if not "sent" in message.tags: return True # not sent == send it!
-  return clock.now() - message.tags["sent"] >= 5000
+  return clock.now() - message.tags["sent"] >= timeout
+
+# estimates the retransmission timeout from measured round-trip times, as TCP
+# does (RFC 6298): a smoothed round-trip time and its variation, bounded by a
+# minimum and maximum timeout. all times are in ms.
+
+class RoundTrip(object):
+  def __init__(self, timeout=TIMEOUT, min_timeout=MIN_TIMEOUT,
+                     max_timeout=MAX_TIMEOUT, alpha=0.125, beta=0.25, k=4):
+    self.min_timeout = min_timeout
+    self.max_timeout = max_timeout
+    self.alpha       = alpha
+    self.beta        = beta
+    self.k           = k
+    self.srtt        = None
+    self.rttvar      = None
+    self.rto         = self.bound(timeout)
+    self.samples     = 0
+    self.lock        = Lock()
+
+  def bound(self, timeout):
+    return max(self.min_timeout, min(self.max_timeout, timeout))
+
+  def sample(self, rtt):
+    with self.lock:
+      if self.srtt is None:
+        self.srtt   = rtt
+        self.rttvar = rtt / 2.0
+      else:
+        self.rttvar = (1 - self.beta) * self.rttvar + \
+                      self.beta * abs(self.srtt - rtt)
+        self.srtt   = (1 - self.alpha) * self.srtt + self.alpha * rtt
+      self.rto      = self.bound(self.srtt + self.k * self.rttvar)
+      self.samples += 1
+
+  # the timeout is doubled for every retransmission
+
+  def timeout(self, transmissions=1):
+    return self.bound(self.rto * 2 ** max(0, transmissions - 1))
+
+  def stats(self):
+    return {
+      "srtt"    : self.srtt,
+      "rttvar"  : self.rttvar,
+      "rto"     : self.rto,
+      "samples" : self.samples
+    }
 
 class Acknowledgement(object):
-  def __init__(self, mq, ack_channel="ack"):
+  def __init__(self, mq, ack_channel="ack", timeout=TIMEOUT, window=None,
+                     max_confirms=100, min_timeout=MIN_TIMEOUT,
+                     max_timeout=MAX_TIMEOUT):
     self.mq = mq
     self.ack_channel = self.mq.name + "/" + ack_channel
+    self.timeout = timeout
+    self.min_timeout = min_timeout
+    self.max_timeout = max_timeout
+    self.destinations = {}
+    self.window = window
+    self.max_confirms = max_confirms
+    self.pending = {}
+    self.timers = {}
+    self.lock = Lock()
     self.mq.on_message(self.ack_channel, self.handle)
   
   def log(self, msg, level=logger.info):
     level("{0}: {1}".format(self.mq.name, msg))
+
+  def round_trip(self, to):
+    try:
+      return self.destinations[to]
+    except KeyError:
+      return self.destinations.setdefault(to, RoundTrip(
+        self.timeout, self.min_timeout, self.max_timeout
+      ))
+
+  # the resend timeout for a message, based on its destination and the number
+  # of times it was sent
+
+  def timeout_for(self, message):
+    return self.round_trip(message.to).timeout(
+      message.private.get("transmissions", 1)
+    )
+
+  def stats(self):
+    return dict(
+      (to, rtt.stats()) for to, rtt in list(self.destinations.items())
+    )
     
   def request_and_wait(self, message):
     # don't do anything special for ack messages
@@ -44,35 +138,219 @@ class Acknowledgement(object):
     else:
       # the ack tag is present, so this message was sent already at least once
       # check for timeout and let it be sent again, or Defer until timeout
-      if not check_timeout(message):
+      timeout = self.timeout_for(message)
+      if not check_timeout(message, timeout):
         logger.debug("DEFER: message ack was previously requests, but not long enough to resend")
-        raise DeferException
+        raise DeferException(until=message.tags["sent"] + timeout)
       self.log("need to resend message {0}".format(message.id))
 
   def record_sent_time(self, message):
     # don't do anything special for ack messages, simple let it be deleted
     if "confirm" in message.tags: return
-    # record sent time
+    # record sent time and number of transmissions
     message.tags["sent"] = clock.now()
+    message.private["transmissions"] = message.private.get("transmissions", 0) + 1
     logger.debug("DEFER: scheduling retry for {0}".format(message.id))
-    raise DeferException
+    raise DeferException(until=message.tags["sent"] + self.timeout_for(message))
 
   def give(self, message):
-    if "ack" in message.tags:
-      self.log("acknowledging {0}".format(message.id))
-      self.mq.send( message.tags["ack"], {}, { "confirm" : message.id } )
+    self.give_all([ message ])
+
+  def give_all(self, messages):
+    confirms = {}
+    for message in messages:
+      if "ack" in message.tags:
+        self.log("acknowledging {0}".format(message.id))
+        confirms.setdefault(message.tags["ack"], []).append(message.id)
+    for channel, ids in confirms.items():
+      if self.window is None:
+        self.confirm(channel, ids)
+      else:
+        self.collect(channel, ids)
+
+  # pending confirms are sent once the window has passed, or when enough of
+  # them are pending, whichever comes first
+
+  def collect(self, channel, ids):
+    with self.lock:
+      pending = self.pending.setdefault(channel, [])
+      pending.extend(ids)
+      full = len(pending) >= self.max_confirms
+      if not full and not channel in self.timers:
+        timer = Timer(self.window / 1000.0, self.flush, [ channel ])
+        timer.daemon = True
+        self.timers[channel] = timer
+        timer.start()
+    if full: self.flush(channel)
+
+  def flush(self, channel=None):
+    with self.lock:
+      channels = list(self.pending) if channel is None else [ channel ]
+      confirms = []
+      for channel in channels:
+        timer = self.timers.pop(channel, None)
+        if timer: timer.cancel()
+        ids = self.pending.pop(channel, None)
+        if ids: confirms.append((channel, ids))
+    for channel, ids in confirms:
+      self.confirm(channel, ids)
+
+  # a single confirm is sent as an id, to remain compatible with older peers
+
+  def confirm(self, channel, ids):
+    self.mq.send(channel, {}, {
+      "confirm"  : ids[0] if len(ids) == 1 else ids,
+      "priority" : HIGH
+    })
 
   def handle(self, message):
-    self.log("got ack for {0}".format(message.tags["confirm"]))
-    try:
-      self.mq.outbox.remove(self.mq.outbox[message.tags["confirm"]])
-      logger.debug("popped acked msg {0}".format(message.tags["confirm"]))
-    except KeyError:
-      logger.warning("unknown message ack {0}".format(message.tags["confirm"]))
+    confirms = message.tags["confirm"]
+    if not isinstance(confirms, list): confirms = [ confirms ]
+    self.log("got ack for {0}".format(", ".join(map(str, confirms))))
+    acked = []
+    for id in confirms:
+      try:
+        acked.append(self.mq.outbox[id])
+      except KeyError:
+        logger.warning("unknown message ack {0}".format(id))
+    if not acked: return
+    now = clock.now()
+    for msg in acked: self.measure(msg, now)
+    for msg, e in self.mq.outbox.remove_all(acked):
+      logger.error("removing acked msg {0} failed: {1}".format(msg.id, repr(e)))
+    logger.debug("popped {0} acked msg(s)".format(len(acked)))
+
+  # following Karn's algorithm, only acks of messages that were sent once are
+  # measured, since acks of resent messages can't be attributed to a single
+  # transmission. messages loaded from a store have no known transmissions.
 
-def Acknowledging(mq, ack=None, return_ack=False):
-  acknowledgement = ack or Acknowledgement(mq)
+  def measure(self, message, now):
+    if message.private.get("transmissions") != 1: return
+    self.round_trip(message.to).sample(now - message.tags["sent"])
+
+def Acknowledging(mq, ack=None, return_ack=False, window=None, max_confirms=100,
+                  timeout=TIMEOUT, min_timeout=MIN_TIMEOUT,
+                  max_timeout=MAX_TIMEOUT):
+  acknowledgement = ack or Acknowledgement(
+    mq, timeout=timeout, window=window, max_confirms=max_confirms,
+    min_timeout=min_timeout, max_timeout=max_timeout
+  )
   mq.before_sending.append(acknowledgement.request_and_wait)
   mq.after_sending.append(acknowledgement.record_sent_time)
-  mq.after_handling.append(acknowledgement.give)
+  mq.after_handling.append(
+    Hook(acknowledgement.give, acknowledgement.give_all)
+  )
+  mq.acknowledgement = acknowledgement
   return acknowledgement if return_ack else mq
+
+# resent messages are dropped before they are added to the inbox, and thus before
+# they are persisted, validated or handled, if their id was recorded recently.
+# ids are only recorded once their message was handled, so a message that failed
+# and was dead-lettered is accepted again when resent, and forged ids don't keep
+# genuine messages out. ids are kept for a limited time (in ms), up to a maximum
+# number of ids, dropping the least recently seen ones. the ack of a dropped
+# message is given again, since it was handled. a message that is resent while
+# the original is still in the inbox is dropped as well, without an ack.
+#
+# optionally the window is kept in a collection, to survive restarts.
+
+class Window(object):
+  def __init__(self, size=10000, ttl=600000, collection=None):
+    self.size       = size
+    self.ttl        = ttl
+    self.collection = collection
+    self.ids        = OrderedDict()  # id -> (recorded, key in collection)
+    self.loaded     = collection is None
+    self.lock       = Lock()
+
+  def load(self):
+    if self.loaded: return
+    for doc in sorted(self.collection.load(), key=lambda doc: doc["seen"]):
+      self.ids[doc["id"]] = (doc["seen"], doc["_id"])
+    self.loaded = True
+    self.expire(clock.now())
+
+  # returns True for ids that were recorded within the window. recently seen ids
+  # are kept longer when the window is full, but never beyond their ttl, which
+  # is checked here, since expiring stops at the first id that didn't expire.
+
+  def seen(self, id):
+    with self.lock:
+      self.load()
+      now = clock.now()
+      self.expire(now)
+      if not id in self.ids: return False
+      recorded, key = self.ids[id]
+      if self.expired(recorded, now):
+        del self.ids[id]
+        if self.collection: self.collection.remove_all([ key ])
+        return False
+      touch(self.ids, id)
+      return True
+
+  def expired(self, recorded, now):
+    return self.ttl is not None and now - recorded >= self.ttl
+
+  def record(self, id):
+    self.record_all([ id ])
+
+  def record_all(self, ids):
+    with self.lock:
+      self.load()
+      now = clock.now()
+      for id in ids:
+        if id in self.ids:
+          touch(self.ids, id)
+          continue
+        key = None
+        if self.collection:
+          key = self.collection.add({ "id" : id, "seen" : now })
+        self.ids[id] = (now, key)
+      self.expire(now)
+
+  def expire(self, now):
+    expired = []
+    while self.ids:
+      id, (seen, key) = next(iter(self.ids.items()))
+      if len(self.ids) <= self.size and not self.expired(seen, now):
+        break
+      self.ids.popitem(last=False)
+      expired.append(key)
+    if self.collection and expired:
+      self.collection.remove_all(expired)
+
+  def __len__(self):
+    return len(self.ids)
+
+class Deduplication(object):
+  def __init__(self, mq, window):
+    self.mq         = mq
+    self.window     = window
+    self.duplicates = 0
+
+  def drop_duplicate(self, message):
+    handled = self.window.seen(message.id)
+    if not handled and not message.id in self.mq.inbox.messages: return
+    logger.info("{0}: dropping duplicate {1}".format(self.mq.name, message.id))
+    self.duplicates += 1
+    acknowledgement = getattr(self.mq, "acknowledgement", None)
+    if acknowledgement and handled:
+      acknowledgement.give(message)
+    raise DropException()
+
+  def record(self, message):
+    self.window.record(message.id)
+
+  def record_all(self, messages):
+    self.window.record_all([ message.id for message in messages ])
+
+  def stats(self):
+    return { "ids" : len(self.window), "duplicates" : self.duplicates }
+
+def Deduplicating(mq, size=10000, ttl=600000, collection=None):
+  mq.deduplication = Deduplication(mq, Window(size, ttl, collection))
+  mq.inbox.before_add.append(mq.deduplication.drop_duplicate)
+  mq.after_handling.append(
+    Hook(mq.deduplication.record, mq.deduplication.record_all)
+  )
+  return mq
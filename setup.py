@@ -26,6 +26,11 @@ INSTALL_REQUIRES = [
   "paho-mqtt",
   "cryptography"
 ]
+EXTRAS_REQUIRE   = {
+  "msgpack" : [ "msgpack" ],
+  "fast"    : [ "ujson" ],
+  "compress": [ "lz4", "zstandard" ]
+}
 ENTRY_POINTS     = {}
 SCRIPTS          = []
 
@@ -55,5 +60,6 @@ if __name__ == "__main__":
         url=URL,
         classifiers=CLASSIFIERS,
         install_requires=INSTALL_REQUIRES,
+        extras_require=EXTRAS_REQUIRE,
         entry_points=ENTRY_POINTS,
         scripts=SCRIPTS)
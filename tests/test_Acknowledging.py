@@ -3,8 +3,10 @@ import pytest
 from mock import Mock, patch
 
 from mqfactory               import DeferException
+from mqfactory.Queue         import HIGH
+from mqfactory.message       import Message
 from mqfactory.transport.qos import check_timeout
-from mqfactory.transport.qos import Acknowledging, Acknowledgement
+from mqfactory.transport.qos import Acknowledging, Acknowledgement, RoundTrip
 
 def test_timeout_on_missing_sent_time(message):
   assert check_timeout(message)
@@ -47,10 +49,11 @@ def test_dont_record_sent_time_on_ack(mq, message):
 def test_record_sent_time(mocked_time, mq, message):
   mocked_time.return_value = 123
   ack = Acknowledgement(mq,)
-  with pytest.raises(DeferException):
+  with pytest.raises(DeferException) as e:
     ack.record_sent_time(message)
   assert "sent" in message.tags
   assert message.tags["sent"] == 123
+  assert e.value.until == 5123
 
 @patch("mqfactory.tools.clock.now")
 def test_wait_for_timeout(mocked_time, mq, message):
@@ -60,9 +63,10 @@ def test_wait_for_timeout(mocked_time, mq, message):
   with pytest.raises(DeferException):
     ack.record_sent_time(message)
   # wait
-  with pytest.raises(DeferException):
+  with pytest.raises(DeferException) as e:
     mocked_time.return_value = 2000
     ack.request_and_wait(message)
+  assert e.value.until == 6000
   # carry on
   mocked_time.return_value = 6100
   ack.request_and_wait(message)
@@ -71,7 +75,9 @@ def test_give_ack(mq, message):
   ack = Acknowledgement(mq)
   message.tags["ack"] = "somewhere"
   ack.give(message)
-  mq.send.assert_called_with( message.tags["ack"], {}, { "confirm" : message.id } )
+  mq.send.assert_called_with(
+    message.tags["ack"], {}, { "confirm" : message.id, "priority" : HIGH }
+  )
 
 def test_dont_give_ack_on_ack(mq, message):
   ack = Acknowledgement(mq)
@@ -84,9 +90,10 @@ def test_handling_of_acks(mq, message):
   ack = Acknowledgement(mq)
   mq.on_message.assert_called_with(ack.ack_channel, ack.handle)
   message.tags["confirm"] = "some message id"
-  mq.outbox.__getitem__.return_value = "some message object"
+  acked = Message("somewhere", "payload")
+  mq.outbox.__getitem__.return_value = acked
   ack.handle(message)
-  mq.outbox.remove.assert_called_with("some message object")
+  mq.outbox.remove_all.assert_called_with([ acked ])
 
 def test_not_handling_of_unknown_message_to_ack(mq, message):
   ack = Acknowledgement(mq)
@@ -94,4 +101,107 @@ def test_not_handling_of_unknown_message_to_ack(mq, message):
   message.tags["confirm"] = "some message id"
   mq.outbox.__getitem__.side_effect = KeyError()
   ack.handle(message)
-  mq.outbox.remove.assert_not_called()
+  mq.outbox.remove_all.assert_not_called()
+
+def test_handling_of_batched_acks(mq, message):
+  ack = Acknowledgement(mq)
+  message.tags["confirm"] = [ "a", "unknown", "b" ]
+  outbox = { "a" : Message("a", "payload"), "b" : Message("b", "payload") }
+  mq.outbox.__getitem__.side_effect = lambda id: outbox[id]
+  ack.handle(message)
+  mq.outbox.remove_all.assert_called_once_with([ outbox["a"], outbox["b"] ])
+
+def test_confirms_of_a_batch_are_combined(mq, message):
+  ack = Acknowledgement(mq)
+  messages = [ message.copy() for _ in range(3) ]
+  for msg, channel, id in zip(messages, [ "x", "y", "x" ], [ "1", "2", "3" ]):
+    msg.tags.update({ "ack" : channel, "id" : id })
+  ack.give_all(messages)
+  assert mq.send.call_count == 2
+  mq.send.assert_any_call("x", {}, { "confirm" : [ "1", "3" ], "priority" : HIGH })
+  mq.send.assert_any_call("y", {}, { "confirm" : "2", "priority" : HIGH })
+
+def test_confirms_are_collected_until_max_confirms(mq, message):
+  ack = Acknowledgement(mq, window=60000, max_confirms=2)
+  message.tags["ack"] = "somewhere"
+  ack.give(message)
+  mq.send.assert_not_called()
+  ack.give(message)
+  mq.send.assert_called_once_with(
+    "somewhere", {}, { "confirm" : [ message.id, message.id ], "priority" : HIGH }
+  )
+  assert ack.timers == {}
+
+def test_confirms_are_sent_after_window(mq, message):
+  ack = Acknowledgement(mq, window=100)
+  message.tags["ack"] = "somewhere"
+  ack.give(message)
+  mq.send.assert_not_called()
+  ack.timers["somewhere"].join(1)
+  mq.send.assert_called_once_with(
+    "somewhere", {}, { "confirm" : message.id, "priority" : HIGH }
+  )
+
+def test_round_trip_estimation():
+  rtt = RoundTrip(timeout=5000, min_timeout=100, max_timeout=10000)
+  assert rtt.timeout() == 5000
+  rtt.sample(200)
+  assert rtt.srtt == 200 and rtt.rttvar == 100 and rtt.rto == 600
+  rtt.sample(200)
+  assert rtt.rttvar == 75 and rtt.rto == 500
+  assert rtt.timeout(transmissions=3) == 2000
+  assert rtt.timeout(transmissions=10) == 10000
+  rtt.sample(1)
+  rtt.sample(1)
+  assert rtt.rto >= 100
+
+@patch("mqfactory.tools.clock.now")
+def test_acks_adapt_timeout_per_destination(mocked_time, mq, message):
+  ack = Acknowledgement(mq)
+  mocked_time.return_value = 1000
+  ack.request_and_wait(message)
+  with pytest.raises(DeferException) as e:
+    ack.record_sent_time(message)
+  assert e.value.until == 6000
+  confirm = Message(ack.ack_channel, {}, { "confirm" : message.id })
+  mq.outbox.__getitem__.return_value = message
+  mocked_time.return_value = 1100
+  ack.handle(confirm)
+  assert ack.stats() == { message.to : {
+    "srtt" : 100, "rttvar" : 50, "rto" : 300, "samples" : 1
+  } }
+  # a next message to the same destination times out sooner, and backs off
+  other = Message(message.to, "payload")
+  ack.request_and_wait(other)
+  with pytest.raises(DeferException) as e:
+    ack.record_sent_time(other)
+  assert e.value.until == 1400
+  mocked_time.return_value = 1400
+  ack.request_and_wait(other)
+  with pytest.raises(DeferException) as e:
+    ack.record_sent_time(other)
+  assert e.value.until == 2000
+
+@patch("mqfactory.tools.clock.now")
+def test_acks_of_resent_messages_are_not_measured(mocked_time, mq, message):
+  ack = Acknowledgement(mq)
+  mocked_time.return_value = 1000
+  for _ in range(2):
+    ack.request_and_wait(message)
+    with pytest.raises(DeferException):
+      ack.record_sent_time(message)
+    mocked_time.return_value += 5000
+  mq.outbox.__getitem__.return_value = message
+  ack.handle(Message(ack.ack_channel, {}, { "confirm" : message.id }))
+  assert ack.stats()[message.to]["samples"] == 0
+
+def test_handling_of_acks_with_integer_ids(mq, message):
+  ack = Acknowledgement(mq)
+  message.tags["confirm"] = [ 1, 2 ]
+  outbox = { 1 : Message("a", "payload"), 2 : Message("b", "payload") }
+  mq.outbox.__getitem__.side_effect = lambda id: outbox[id]
+  ack.handle(message)
+  mq.outbox.remove_all.assert_called_once_with([ outbox[1], outbox[2] ])
+  message.tags["confirm"] = 1
+  ack.handle(message)
+  mq.outbox.remove_all.assert_called_with([ outbox[1] ])
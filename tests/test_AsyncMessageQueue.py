@@ -0,0 +1,174 @@
+import pytest
+import asyncio
+import json
+
+from mock import Mock
+
+from mqfactory.AsyncMessageQueue  import AsyncMessageQueue
+from mqfactory.message            import Message
+from mqfactory.message.format.js  import JsonFormatting
+from mqfactory.transport.aio      import AsyncTransport
+from mqfactory.transport.aio_mqtt import AsyncMQTTTransport
+from mqfactory.transport.qos      import Acknowledging
+
+class LocalTransport(AsyncTransport):
+  def __init__(self):
+    super(LocalTransport, self).__init__()
+    self.sent     = []
+    self.handlers = {}
+
+  async def connect(self):
+    pass
+
+  async def _send(self, message):
+    self.sent.append(message)
+
+  def _on_message(self, to, handler):
+    self.handlers[to] = handler
+
+def run(coroutine):
+  return asyncio.run(coroutine)
+
+def test_sending_messages():
+  async def scenario():
+    transport = LocalTransport()
+    mq = JsonFormatting(AsyncMessageQueue(transport))
+    await mq.send("to", "payload")
+    assert await mq.process_outbox()
+    assert len(mq.outbox) == 0
+    return transport.sent
+
+  sent = run(scenario())
+  assert len(sent) == 1
+  assert sent[0].to == "to"
+  assert json.loads(sent[0].payload)["payload"] == "payload"
+
+def test_async_hooks_and_handlers():
+  async def scenario():
+    transport = LocalTransport()
+    mq = AsyncMessageQueue(transport)
+    handled = []
+    async def tag(message):
+      await asyncio.sleep(0)
+      message.tags["hooked"] = True
+    async def handle(message):
+      handled.append(message)
+    mq.before_handling.append(tag)
+    mq.on_message("topic", handle)
+    await transport.handlers["topic"](Message("topic", "payload"))
+    assert await mq.process_inbox()
+    return handled
+
+  handled = run(scenario())
+  assert len(handled) == 1
+  assert handled[0].tags["hooked"]
+
+def test_iterating_inbox():
+  async def scenario():
+    transport = LocalTransport()
+    mq = AsyncMessageQueue(transport)
+    mq.on_message("topic")
+    task = asyncio.ensure_future(mq.run())
+    for i in range(3):
+      await transport.handlers["topic"](Message("topic", i))
+    received = []
+    async for message in mq.inbox:
+      received.append(message.payload)
+      if len(received) == 3: break
+    mq.stop()
+    await task
+    return received
+
+  assert run(scenario()) == [0, 1, 2]
+
+def test_setting_up_before_running_the_loop():
+  transport = LocalTransport()
+  mq = AsyncMessageQueue(transport)
+  mq.on_message("topic")
+  mq.send("to", "payload")
+
+  async def scenario():
+    task = asyncio.ensure_future(mq.run())
+    await transport.handlers["topic"](Message("topic", "hi"))
+    received = await mq.inbox.__anext__()
+    mq.stop()
+    await task
+    return received.payload
+
+  assert run(scenario()) == "hi"
+  assert len(transport.sent) == 1
+
+def test_running_with_sync_aspects():
+  async def scenario():
+    transport = LocalTransport()
+    mq = Acknowledging(AsyncMessageQueue(transport))
+    mq.on_message("topic", lambda message: None)
+    task = asyncio.ensure_future(mq.run())
+    await transport.handlers["topic"](Message("topic", "hi", { "ack" : "x/ack" }))
+    await asyncio.sleep(0.05)
+    mq.stop()
+    await task
+    return transport.sent
+
+  sent = run(scenario())
+  assert len(sent) == 1
+  assert sent[0].to == "x/ack"
+
+def test_async_mqtt_transport():
+  async def scenario():
+    paho = Mock()
+    transport = AsyncMQTTTransport("mqtt://localmock:1883", paho=paho)
+    receive = Mock()
+    transport.on_message("topic", receive)
+    connecting = asyncio.ensure_future(transport.connect())
+    await asyncio.sleep(0)
+    paho.connect.assert_called_with("localmock", 1883)
+    transport.handle_on_connect(None, None, None, 0)
+    await connecting
+    paho.subscribe.assert_called_with([ ("topic", 0) ])
+
+    await transport.send(Message("to", "payload"))
+    paho.publish.assert_called_with("to", "payload", 0)
+
+    assert paho.on_message == transport.handle_on_message
+    msg = Mock()
+    msg.configure_mock(topic="topic", payload="incoming")
+    transport.handle_on_message(None, None, msg)
+    await asyncio.sleep(0)
+    return receive
+
+  receive = run(scenario())
+  receive.assert_called_once()
+  assert receive.call_args[0][0].payload == "incoming"
+
+def test_async_mqtt_transport_reconnects():
+  async def scenario():
+    paho = Mock()
+    transport = AsyncMQTTTransport(
+      "mqtt://localmock:1883", paho=paho, reconnect_delay=0.01
+    )
+    transport.on_message("topic", Mock())
+    connecting = asyncio.ensure_future(transport.connect())
+    await asyncio.sleep(0)
+    transport.handle_on_connect(None, None, None, 0)
+    await connecting
+
+    # broker blip, first reconnect fails
+    paho.connect.side_effect = ConnectionRefusedError()
+    transport.handle_on_disconnect(None, None, 1)
+    assert not transport.is_connected()
+    await asyncio.sleep(0.015)
+    assert paho.connect.call_count == 2
+    paho.connect.side_effect = None
+    paho.subscribe.reset_mock()
+    await asyncio.sleep(0.025)
+    assert paho.connect.call_count == 3
+    transport.handle_on_connect(None, None, None, 0)
+    await asyncio.sleep(0)
+    assert transport.is_connected()
+    assert transport.reconnecting is None
+    paho.subscribe.assert_called_with([ ("topic", 0) ])
+    await transport.send(Message("to", "payload"))
+    paho.publish.assert_called_with("to", "payload", 0)
+
+  run(scenario())
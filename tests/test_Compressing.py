@@ -0,0 +1,100 @@
+import pytest
+from mock import Mock
+
+from mqfactory                     import MessageQueue
+from mqfactory.message             import Message
+from mqfactory.message.format.js   import JsonFormatting
+from mqfactory.message.compression import Compression, Compressing
+from mqfactory.message.compression import Dictionaries, CODECS
+from mqfactory.transport.loopback  import Loopback, LoopbackTransport
+
+TELEMETRY = b'{"payload":{"sensor":"temperature","unit":"celsius","value":21.5},' \
+            b'"tags":{"id":"01M5712RNE9HNPS616RXCD41SG"}}'
+
+def test_small_payloads_are_not_compressed():
+  message = Message("to", b"small")
+  Compression(min_size=128).compress(message)
+  assert message.payload == b"small"
+
+def test_compressed_payloads_are_marked_and_restored():
+  message = Message("to", TELEMETRY * 10)
+  compression = Compression(min_size=0)
+  compression.compress(message)
+  assert message.payload.startswith(b"\x00zlib\x00")
+  assert len(message.payload) < len(TELEMETRY * 10)
+  compression.decompress(message)
+  assert message.payload == TELEMETRY * 10
+
+def test_uncompressed_payloads_are_left_untouched():
+  message = Message("to", TELEMETRY)
+  Compression().decompress(message)
+  assert message.payload == TELEMETRY
+
+def test_dictionaries_improve_small_messages():
+  dictionaries = Dictionaries()
+  id = dictionaries.train("sensors/#", [ TELEMETRY ] * 10)
+  assert dictionaries.lookup("sensors/1") == id
+  assert dictionaries.lookup("other") is None
+  plain   = Message("other",     TELEMETRY)
+  trained = Message("sensors/1", TELEMETRY)
+  compression = Compression(min_size=0, dictionaries=dictionaries)
+  compression.compress(plain)
+  compression.compress(trained)
+  assert trained.payload.startswith(b"\x00zlib:" + id.encode("ascii") + b"\x00")
+  assert len(trained.payload) < len(plain.payload)
+  compression.decompress(trained)
+  assert trained.payload == TELEMETRY
+
+def test_unknown_dictionary_fails():
+  dictionaries = Dictionaries()
+  dictionaries.train("sensors/#", [ TELEMETRY ])
+  message = Message("sensors/1", TELEMETRY)
+  Compression(min_size=0, dictionaries=dictionaries).compress(message)
+  with pytest.raises(KeyError):
+    Compression().decompress(message)
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_available_codecs(codec):
+  message = Message("to", TELEMETRY * 10)
+  compression = Compression(codec=codec, min_size=0)
+  compression.compress(message)
+  assert message.payload.startswith(b"\x00" + codec.encode("ascii"))
+  compression.decompress(message)
+  assert message.payload == TELEMETRY * 10
+
+@pytest.mark.parametrize("codec", sorted(CODECS))
+def test_decompression_is_limited(codec):
+  bomb = Message("to", b"\x00" * 1000000)
+  Compression(codec=codec, min_size=0).compress(bomb)
+  assert len(bomb.payload) < 10000
+  with pytest.raises(ValueError):
+    Compression(max_size=999999).decompress(bomb)
+  Compression(max_size=1000000).decompress(bomb)
+  assert bomb.payload == b"\x00" * 1000000
+
+@pytest.mark.skipif(not "lz4" in CODECS, reason="lz4 isn't installed")
+def test_lz4_refuses_dictionaries():
+  dictionaries = Dictionaries()
+  dictionaries.train("sensors/#", [ TELEMETRY ])
+  with pytest.raises(ValueError):
+    Compression(codec="lz4", dictionaries=dictionaries)
+  with pytest.raises(ValueError):
+    CODECS["lz4"].compress(TELEMETRY, dictionary=b"dictionary")
+
+def test_compressing_formatted_messages():
+  broker   = Loopback()
+  sender   = Compressing(JsonFormatting(MessageQueue(LoopbackTransport(broker))),
+                         min_size=0)
+  receiver = Compressing(JsonFormatting(MessageQueue(LoopbackTransport(broker))),
+                         min_size=0)
+  handler  = Mock()
+  receiver.on_message("test", handler)
+  sent = Mock()
+  broker.subscribe("test", sent)
+  sender.send("test", { "data" : "x" * 1000 })
+  sender.process_outbox()
+  receiver.process_inbox()
+  (wire,), _ = sent.call_args
+  assert len(wire.payload) < 1000
+  (msg,), _ = handler.call_args
+  assert msg.payload == { "data" : "x" * 1000 }
@@ -0,0 +1,116 @@
+from mock import Mock, patch
+
+from mqfactory                    import MessageQueue
+from mqfactory.message.format.js  import JsonFormatting
+from mqfactory.store.memory       import MemoryCollection
+from mqfactory.transport.loopback import Loopback, LoopbackTransport
+from mqfactory.transport.qos      import Acknowledging, Deduplicating, Window
+
+@patch("mqfactory.tools.clock.now")
+def test_window_forgets_ids_after_ttl(mocked_time):
+  window = Window(ttl=1000)
+  mocked_time.return_value = 1000
+  assert not window.seen("a")
+  window.record("a")
+  assert window.seen("a")
+  mocked_time.return_value = 2000
+  assert not window.seen("a")
+  assert len(window) == 0
+
+@patch("mqfactory.tools.clock.now")
+def test_window_doesnt_keep_seen_ids_beyond_ttl(mocked_time):
+  collection = MemoryCollection()
+  window = Window(ttl=1000, collection=collection)
+  mocked_time.return_value = 0
+  window.record("a")
+  mocked_time.return_value = 500
+  window.record("b")
+  mocked_time.return_value = 600
+  assert window.seen("a")
+  mocked_time.return_value = 1200
+  assert not window.seen("a")
+  assert window.seen("b")
+  assert len(window) == 1
+  assert len(collection.docs) == 1
+
+def test_window_keeps_most_recently_seen_ids():
+  window = Window(size=2)
+  window.record_all([ "a", "b" ])
+  assert window.seen("a")
+  window.record("c")
+  assert len(window) == 2
+  assert window.seen("a")
+  assert not window.seen("b")
+
+def test_window_survives_restarts():
+  collection = MemoryCollection()
+  window = Window(size=2, collection=collection)
+  for id in [ "a", "b", "c" ]: window.record(id)
+  assert len(collection.docs) == 2
+  window = Window(size=2, collection=collection)
+  assert window.seen("c")
+  assert not window.seen("a")
+
+def connected(broker, name):
+  mq = Acknowledging(MessageQueue(LoopbackTransport(broker), name=name))
+  return JsonFormatting(mq)
+
+def test_duplicates_are_dropped_before_the_inbox():
+  broker   = Loopback()
+  sender   = connected(broker, "sender")
+  receiver = Deduplicating(connected(broker, "receiver"))
+  validate = Mock()
+  receiver.before_handling.append(validate)
+  handler  = Mock()
+  receiver.on_message("test", handler)
+  sender.send("test", "payload")
+  (message,) = sender.outbox.all()
+  sender.process_outbox()
+  sender.transport.send(message)  # resent before it was handled
+  assert len(receiver.inbox) == 1
+  receiver.process_inbox(max_batch=10)
+  validate.assert_called_once()
+  handler.assert_called_once()
+  assert receiver.deduplication.stats() == { "ids" : 1, "duplicates" : 1 }
+  # only the original message is acked, once it is handled
+  assert len(receiver.outbox) == 1
+
+def test_duplicates_are_acked_again_after_handling():
+  broker   = Loopback()
+  sender   = connected(broker, "sender")
+  receiver = Deduplicating(connected(broker, "receiver"))
+  handler  = Mock()
+  receiver.on_message("test", handler)
+  sender.send("test", "payload")
+  (message,) = sender.outbox.all()
+  sender.process_outbox()
+  receiver.process_inbox()
+  receiver.outbox.remove(receiver.outbox.all()[0])  # the ack got lost
+  sender.transport.send(message)
+  assert len(receiver.inbox) == 0
+  handler.assert_called_once()
+  receiver.process_outbox()
+  sender.process_inbox()
+  assert len(sender.outbox) == 0
+
+def test_failed_messages_are_accepted_again_when_resent():
+  broker   = Loopback()
+  sender   = connected(broker, "sender")
+  receiver = Deduplicating(connected(broker, "receiver"))
+  receiver.backoff.attempts = 1
+  handler  = Mock(side_effect=[ Exception("failed"), None ])
+  receiver.on_message("test", handler)
+  sender.send("test", "payload")
+  (message,) = sender.outbox.all()
+  sender.process_outbox()
+  receiver.process_inbox()
+  assert len(receiver.dead) == 1
+  assert len(receiver.outbox) == 0
+  sender.transport.send(message)  # resent after the ack timed out
+  assert len(receiver.inbox) == 1
+  assert len(receiver.outbox) == 0
+  receiver.process_inbox()
+  assert handler.call_count == 2
+  receiver.process_outbox()
+  sender.process_inbox()
+  assert len(sender.outbox) == 0
@@ -63,7 +63,7 @@ def test_sending_two_messages_with_retries_and_acks(mocked_time, mocked_uuid,
       "id" : "1",
       "ack": mq.name + "/ack"
     }
-  }, sort_keys=True)
+  }, sort_keys=True, separators=(",", ":")).encode("utf-8")
   transport._send.reset_mock()
 
   mq.process_outbox() # send 2 and update with sent time
@@ -85,31 +85,14 @@ def test_sending_two_messages_with_retries_and_acks(mocked_time, mocked_uuid,
       "id" : "2",
       "ack": mq.name + "/ack"
     }
-  }, sort_keys=True)
+  }, sort_keys=True, separators=(",", ":")).encode("utf-8")
   transport._send.reset_mock()
   
-  mq.process_outbox() # defer 1 due to no timeout
-  outbox.update.assert_called_with( 1, {
-    "to": "to 1",
-    "payload": "payload 1",
-    "tags": {
-      "id": "1",
-      "ack": mq.name + "/ack",
-      "sent": 3
-    }
-  })
-  transport._send.assert_not_called()
-
-  mq.process_outbox() # defer 2
-  outbox.update.assert_called_with( 2, {
-    "to": "to 2",
-    "payload": "payload 2",
-    "tags": {
-      "id": "2",
-      "ack": mq.name + "/ack",
-      "sent": 5
-    }
-  })
+  # both messages are deferred until their timeout, so nothing is due
+  outbox.update.reset_mock()
+  mq.process_outbox()
+  mq.process_outbox()
+  outbox.update.assert_not_called()
   transport._send.assert_not_called()
 
   # move time forward to trigger timeouts
@@ -122,7 +105,7 @@ def test_sending_two_messages_with_retries_and_acks(mocked_time, mocked_uuid,
     "tags": {
       "id": "1",
       "ack": mq.name + "/ack",
-      "sent": 5012
+      "sent": 5013
     }
   })
   transport._send.assert_called_once()
@@ -135,7 +118,7 @@ def test_sending_two_messages_with_retries_and_acks(mocked_time, mocked_uuid,
       "ack": mq.name + "/ack",
       "sent": 3
     }
-  }, sort_keys=True)
+  }, sort_keys=True, separators=(",", ":")).encode("utf-8")
   transport._send.reset_mock()  
 
   # simulate "ack 1" from other party (aka "to 1")
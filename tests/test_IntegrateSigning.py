@@ -1,6 +1,10 @@
-import json
+from mock import Mock, patch
 
 from mqfactory                      import MessageQueue
+from mqfactory.MessageQueue         import Backoff
+from mqfactory.message.format       import jsonlib
+from mqfactory.message.format.js    import JsonFormatting
+from mqfactory.transport.loopback   import Loopback, LoopbackTransport
 from mqfactory.message.security     import Signing
 from mqfactory.message.security.rsa import RsaSignature
 
@@ -20,3 +24,44 @@ def test_ensure_sent_messages_are_signed(transport, message, keys, me):
   assert msg.to == message.to
   assert msg.payload == message.payload
   assert "signature" in msg.tags
+
+def test_signed_messages_are_encoded_once_per_hop(keys, me):
+  broker   = Loopback()
+  sender   = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=RsaSignature(keys, me=me)
+  ))
+  receiver = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=RsaSignature(keys, me=me)
+  ))
+  handler = Mock()
+  receiver.on_message("test", handler)
+  sender.send("test", { "data" : "payload" })
+  with patch("mqfactory.message.format.jsonlib.dumps",
+             wraps=jsonlib.dumps) as dumps:
+    encodings = lambda: len([ args for args, _ in dumps.call_args_list \
+                                   if isinstance(args[0], dict) ])
+    sender.process_outbox()
+    assert encodings() == 1
+    receiver.process_inbox()
+    assert encodings() == 1
+  (msg,), _ = handler.call_args
+  assert msg.payload == { "data" : "payload" }
+  assert not "signature" in msg.tags
+
+def test_tampered_canonical_encoding_fails_validation(keys, me):
+  broker   = Loopback()
+  sender   = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=RsaSignature(keys, me=me)
+  ))
+  receiver = MessageQueue(LoopbackTransport(broker), backoff=Backoff(attempts=1))
+  receiver = JsonFormatting(Signing(receiver, adding=RsaSignature(keys, me=me)))
+  handler = Mock()
+  receiver.on_message("test", handler)
+  def tamper(message):
+    message.payload = message.payload.replace(b"payload", b"tampered")
+  sender.transport.before_sending.append(tamper)
+  sender.send("test", "payload")
+  sender.process_outbox()
+  receiver.process_inbox()
+  handler.assert_not_called()
+  assert len(receiver.dead_letters()) == 1
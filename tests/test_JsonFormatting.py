@@ -1,7 +1,10 @@
 import json
 
 from mqfactory                   import MessageQueue
-from mqfactory.message.format.js import serialize, unserialize, JsonFormatting
+from mqfactory.message.format.js import serialize, unserialize, envelope
+from mqfactory.message.format.js import JsonFormatting
+from mqfactory.message.format    import jsonlib
+from mqfactory.transport.loopback import Loopback, LoopbackTransport
 
 def test_serialize(message):
   message.payload = { "data" : message.payload }
@@ -10,7 +13,7 @@ def test_serialize(message):
   assert message.payload == json.dumps({
     "tags" : { "id" : message.id },
     "payload" : initial_payload
-  }, sort_keys=True)
+  }, sort_keys=True, separators=(",", ":")).encode("utf-8")
 
 def test_unserialize(message):
   initial_payload = message.payload
@@ -26,3 +29,62 @@ def test_json_formatting_installer(mq):
   JsonFormatting(mq)
   mq.transport.before_sending.append.assert_called()
   mq.transport.after_receiving.append.assert_called()
+
+def test_sending_leaves_queued_message_untouched(message):
+  transport = LoopbackTransport(Loopback())
+  transport.connect()
+  transport.before_sending.append(serialize)
+  message.payload = { "data" : [ 1, 2, 3 ] }
+  transport.send(message)
+  assert message.payload == { "data" : [ 1, 2, 3 ] }
+  assert message.tags    == { "id" : message.id }
+
+def test_serialize_reuses_canonical_encoding(message):
+  message.tags["signature"] = { "origin" : "me" }
+  canonical = envelope(message)
+  message.private["canonical"] = canonical
+  message.tags["signature"]["hash"] = "hash"
+  serialize(message)
+  assert message.payload == canonical[:-1] + b',"hash":"hash"}'
+  assert json.loads(message.payload)["tags"]["signature"] == { "origin" : "me" }
+
+def test_unserialize_keeps_received_canonical_encoding(message):
+  message.tags["signature"] = { "origin" : "me" }
+  canonical = envelope(message)
+  message.payload = canonical[:-1] + b',"hash":"hash"}'
+  unserialize(message)
+  assert message.private["canonical"] == canonical
+  assert message.tags["signature"] == { "origin" : "me", "hash" : "hash" }
+
+def test_canonical_encoding():
+  doc = { "b" : [ 1, 2.5, None, True ], "a" : { "z" : "\u00e9/x", "y" : "" } }
+  expected = b'{"a":{"y":"","z":"\xc3\xa9/x"},"b":[1,2.5,null,true]}'
+  assert jsonlib.dumps(doc) == expected
+
+def test_canonical_encoding_of_numbers_and_keys():
+  doc = { "big" : 2**70, "large" : 1e16, "small" : 1e-7, "tiny" : 1e-05 }
+  assert jsonlib.dumps(doc) == \
+    b'{"big":1180591620717411303424,"large":1e+16,"small":1e-07,"tiny":1e-05}'
+  assert jsonlib.dumps({ 1 : "a" }) == b'{"1":"a"}'
+
+def test_all_backends_parse_like_the_standard_library():
+  doc = {
+    "b" : [ 1, 2.5, None, True ], "a" : { "z" : "\u00e9/x", "y" : "" },
+    "large" : 1e16, "small" : 1e-7, "float" : 0.30000000000000004,
+    "big" : 2**70
+  }
+  encoded = jsonlib.dumps(doc)
+  for backend in jsonlib.available():
+    parsed = backend.loads(encoded)
+    if backend.exact:
+      assert parsed == doc, backend.name
+      assert jsonlib.dumps(parsed) == encoded, backend.name
+    assert backend.loads(b"1e400") == float("inf"), backend.name
+
+def test_selecting_backend():
+  try:
+    assert jsonlib.use("json").name == "json"
+    assert jsonlib.loads(b'{"a":1}') == { "a" : 1 }
+  finally:
+    jsonlib.use()
+  assert jsonlib.backend.exact
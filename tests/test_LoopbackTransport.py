@@ -0,0 +1,42 @@
+import pytest
+from mock import Mock
+
+from mqfactory                    import MessageQueue
+from mqfactory.message.format.js  import JsonFormatting
+from mqfactory.transport.loopback import Loopback, LoopbackTransport
+
+def test_send_fails_before_connect(message):
+  transport = LoopbackTransport(Loopback())
+  with pytest.raises(AssertionError):
+    transport.send(message)
+
+def test_delivery_to_matching_subscriptions(message):
+  broker  = Loopback()
+  sender  = LoopbackTransport(broker)
+  exact, wildcard, other = Mock(), Mock(), Mock()
+  LoopbackTransport(broker).on_message("a/b", exact)
+  LoopbackTransport(broker).on_message("a/#",  wildcard)
+  LoopbackTransport(broker).on_message("c/+",  other)
+  sender.connect()
+  message.to = "a/b"
+  message.tags["tag"] = "value"
+  sender.send(message)
+  for handler in [ exact, wildcard ]:
+    (msg,), _ = handler.call_args
+    assert msg.to      == "a/b"
+    assert msg.payload == message.payload
+    assert not "tag" in msg.tags    # only the payload is transported
+  other.assert_not_called()
+
+def test_end_to_end_between_mqs():
+  broker   = Loopback()
+  sender   = JsonFormatting(MessageQueue(LoopbackTransport(broker)))
+  receiver = JsonFormatting(MessageQueue(LoopbackTransport(broker)))
+  handler  = Mock()
+  receiver.on_message("test", handler)
+  sender.send("test", "payload", { "tag" : "value" })
+  sender.send_and_receive()
+  receiver.send_and_receive()
+  (msg,), _ = handler.call_args
+  assert msg.payload     == "payload"
+  assert msg.tags["tag"] == "value"
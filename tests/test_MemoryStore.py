@@ -0,0 +1,36 @@
+from mqfactory.store.memory import MemoryStore, MemoryCollection
+
+def test_collections_are_created_once():
+  store = MemoryStore()
+  assert store["col"] is store["col"]
+  assert not store["col"] is store["other"]
+
+def test_adding_and_loading_documents():
+  col = MemoryCollection()
+  doc = { "doc" : "test 1" }
+  id1 = col.add(doc)
+  id2 = col.add({ "doc" : "test 2", "_id" : "given" })
+  assert id2 == "given"
+  assert not "_id" in doc
+  assert sorted(col.load(), key=lambda d: d["doc"]) == [
+    { "_id" : id1,     "doc" : "test 1" },
+    { "_id" : "given", "doc" : "test 2" }
+  ]
+
+def test_documents_are_copied():
+  col = MemoryCollection()
+  doc = { "doc" : { "nested" : 1 } }
+  id  = col.add(doc)
+  doc["doc"]["nested"] = 2
+  assert col[id] == { "doc" : { "nested" : 1 } }
+  col[id]["doc"]["nested"] = 3
+  assert col[id] == { "doc" : { "nested" : 1 } }
+  assert col["unknown"] is None
+
+def test_updating_and_removing_documents():
+  col = MemoryCollection()
+  id  = col.add({ "doc" : "test", "other" : 1 })
+  col.update(id, { "other" : 2 })
+  assert col[id] == { "doc" : "test", "other" : 2 }
+  col.remove_all([ id ])
+  assert col.load() == []
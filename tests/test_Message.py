@@ -1,4 +1,7 @@
-from mqfactory.message import Message
+from mock import patch
+
+from mqfactory.message     import Message
+from mqfactory.message.ids import Counter, Ulid
 
 def test_ensure_default_id_generation():
   message = Message("to", "payload")
@@ -33,3 +36,61 @@ def test_message_comparison(message):
   message2 = Message(message.to, message.payload, message.tags, message.id)
   assert message == message2
   assert not message != message2
+
+def test_deep_copy_does_not_share_payload_and_tags():
+  message = Message("to", { "data" : [ 1 ] }, { "tag" : { "a" : 1 } })
+  dup = message.copy()
+  assert dup == message
+  assert not dup.payload is message.payload
+  assert not dup.tags["tag"] is message.tags["tag"]
+
+def test_shallow_copy_shares_payload_but_not_tags():
+  message = Message("to", { "data" : [ 1 ] }, { "tag" : { "a" : 1 } })
+  dup = message.copy(deep=False)
+  assert dup == message
+  assert dup.payload is message.payload
+  dup.tags["extra"] = True
+  dup.payload = "replaced"
+  assert not "extra" in message.tags
+  assert message.payload == { "data" : [ 1 ] }
+
+def test_messages_are_slotted_and_lazy():
+  message = Message("to", "payload", id="some id")
+  assert not hasattr(message, "__dict__")
+  assert message._tags is None and message._private is None
+  assert message.id == "some id"
+  assert message.tags == { "id" : "some id" }
+  assert message.private == {}
+
+def test_replacing_tags_replaces_id():
+  message = Message("to", "payload")
+  message.tags = { "id" : "other id", "tag" : "value" }
+  assert message.id == "other id"
+
+def test_pluggable_id_generator():
+  default = Message.id_generator
+  try:
+    Message.id_generator = staticmethod(lambda: "generated")
+    assert Message("to", "payload").id == "generated"
+  finally:
+    Message.id_generator = staticmethod(default)
+  assert Message("to", "payload").id != "generated"
+
+def test_counter_ids_are_node_prefixed_and_ordered():
+  generate = Counter(node="node")
+  ids = [ generate() for _ in range(1000) ]
+  assert all(id.startswith("node-") for id in ids)
+  assert ids == sorted(ids)
+  assert len(set(ids)) == len(ids)
+
+def test_ulid_ids_are_time_ordered_and_monotonic():
+  generate = Ulid()
+  ids = [ generate() for _ in range(1000) ]
+  assert all(len(id) == 26 for id in ids)
+  assert ids == sorted(ids)
+  assert len(set(ids)) == len(ids)
+
+def test_ulid_encodes_timestamp():
+  with patch("time.time", return_value=1.5):
+    id = Ulid()()
+  assert id.startswith("00000001EW")  # 1500ms
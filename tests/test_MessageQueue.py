@@ -1,8 +1,14 @@
 import pytest
 import time
 
-from mqfactory         import Threaded, MessageQueue
-from mqfactory.message import Message
+from threading import Thread
+
+from mock import patch
+
+from mqfactory              import Threaded, MessageQueue, DeferException
+from mqfactory              import Bounded, QueueFullException
+from mqfactory.MessageQueue import Backoff
+from mqfactory.message      import Message
 
 def test_send_message(transport, message):
   mq = MessageQueue(transport)
@@ -87,6 +93,36 @@ def test_threaded_outbox_processing(transport, message):
   assert msg.to == message.to
   assert msg.payload == message.payload
 
+def test_threaded_processing_waits_for_messages(transport, message):
+  mq = Threaded(MessageQueue(transport), interval=10)
+
+  time.sleep(0.05) # processor thread is now waiting for activity
+  mq.send(message.to, message.payload)
+  time.sleep(0.05) # much less than the interval
+
+  transport.send.assert_called_once()
+  mq.processor.stop()
+  mq.processor.join(1)
+  assert not mq.processor.thread.is_alive()
+
+def test_polling_processor_can_be_stopped(transport):
+  mq = Threaded(MessageQueue(transport), interval=0.01, polling=True)
+  mq.processor.stop()
+  mq.processor.join(1)
+  assert not mq.processor.thread.is_alive()
+
+@patch("mqfactory.tools.clock.now")
+def test_idle_time(mocked_time, transport, message):
+  mocked_time.return_value = 1000
+  mq = MessageQueue(transport)
+  assert mq.idle() is None
+
+  mq.send(message.to, message.payload)
+  assert mq.idle() == 0
+
+  mq.outbox.defer(next(mq.outbox), until=1500)
+  assert mq.idle() == 0.5
+
 def test_failing_processing(transport, message):
   mq = MessageQueue(transport)
   class SomeException(Exception): pass
@@ -112,3 +148,202 @@ def number(number):
     msg.payload = "{0}{1}{0}".format(number, msg.payload)
     return msg
   return add_number
+
+def test_batch_processing(transport):
+  transport.send_all.return_value = []
+  mq = MessageQueue(transport)
+  for i in range(5):
+    mq.send("to", i)
+
+  assert mq.process_outbox(max_batch=3)
+  transport.send_all.assert_called_once()
+  assert [ msg.payload for msg in transport.send_all.call_args[0][0] ] == [0, 1, 2]
+  assert len(mq.outbox) == 2
+
+  assert mq.process_outbox(max_batch=3)
+  assert len(mq.outbox) == 0
+  assert not mq.process_outbox(max_batch=3)
+
+def test_batch_processing_with_deferred_and_failing_messages(transport):
+  transport.send_all.return_value = []
+  mq = MessageQueue(transport, backoff=Backoff(delay=0))
+  def select(msg):
+    if msg.payload == 1: raise DeferException(until=1)
+    if msg.payload == 2: raise ValueError("failing")
+  mq.before_sending.append(select)
+  for i in range(3):
+    mq.send("to", i)
+
+  assert mq.process_outbox(max_batch=3)
+  transport.send.assert_called_once()
+  assert len(mq.outbox) == 2
+  assert [ msg.payload for msg in mq.outbox.take(3) ] == [1, 2]
+
+def test_backoff():
+  backoff = Backoff(attempts=3, delay=100, factor=2, maximum=300)
+  assert backoff(1) == 100
+  assert backoff(2) == 200
+  assert backoff(3) == 300
+  assert not backoff.exhausted(2)
+  assert backoff.exhausted(3)
+  assert not Backoff(attempts=None).exhausted(1000)
+
+@patch("mqfactory.tools.clock.now")
+def test_failing_messages_are_retried_and_buried(mocked_time, transport, message):
+  mocked_time.return_value = 1000
+  mq = MessageQueue(transport, backoff=Backoff(attempts=3, delay=100))
+  def failing(msg):
+    raise ValueError("failing")
+  mq.before_sending.append(failing)
+  mq.send(message.to, message.payload)
+
+  assert not mq.process_outbox()
+  msg = mq.outbox.all()[0]
+  assert msg.private["attempts"] == 1
+  assert mq.idle() == 0.1
+
+  assert not mq.process_outbox() # not due yet
+  mocked_time.return_value = 1100
+  assert not mq.process_outbox()
+  assert msg.private["attempts"] == 2
+  mocked_time.return_value = 1300
+  assert not mq.process_outbox()
+
+  assert len(mq.outbox) == 0
+  assert mq.dead_letters() == [ msg ]
+  assert msg.tags["dead"]["box"] == "outbox"
+  assert msg.tags["dead"]["attempts"] == 3
+
+  mq.before_sending.remove(failing)
+  assert mq.replay() == [ msg ]
+  assert not "dead" in msg.tags
+  assert len(mq.dead) == 0
+  assert mq.process_outbox()
+  transport.send.assert_called_once()
+
+def test_replaying_dead_incoming_messages(transport, message):
+  mq = MessageQueue(transport, backoff=Backoff(attempts=1))
+  handled = []
+  def handle(msg):
+    if not handled:
+      handled.append(None)
+      raise ValueError("failing")
+    handled.append(msg)
+  mq.on_message(message.to, handle)
+  to, store_to_inbox = transport.on_message.call_args[0]
+  store_to_inbox(message)
+
+  mq.process_inbox()
+  assert mq.dead_letters() == [ message ]
+  mq.replay(message)
+  assert mq.process_inbox()
+  assert handled[1] is message
+
+def test_bounded_outbox(transport, message):
+  mq = Bounded(MessageQueue(transport), max_messages=1, overflow="block")
+  mq.send(message.to, message.payload)
+  with pytest.raises(QueueFullException):
+    mq.send(message.to, message.payload, timeout=0.01)
+
+def test_subscribing_again_replaces_handler(transport, message):
+  mq = MessageQueue(transport)
+  first, second = [], []
+  mq.on_message(message.to, first.append)
+  mq.on_message(message.to, second.append)
+  transport.on_message.assert_called_once()
+  to, store_to_inbox = transport.on_message.call_args[0]
+  store_to_inbox(message)
+  mq.process_inbox()
+  assert first  == []
+  assert second == [ message ]
+
+def test_handlers_are_looked_up_for_messages_without_subscriptions(transport):
+  mq = MessageQueue(transport)
+  handled = []
+  mq.on_message("a/#", lambda msg: handled.append(("a/#", msg.to)))
+  mq.on_message("a/+", lambda msg: handled.append(("a/+", msg.to)))
+  mq.on_message("b",   lambda msg: handled.append(("b",   msg.to)))
+  # e.g. messages that were loaded from a persistent inbox
+  mq.inbox.add(Message("a/b", "payload"))
+  mq.inbox.add(Message("b",   "payload"))
+  mq.process_inbox(max_batch=10)
+  assert handled == [ ("a/#", "a/b"), ("a/+", "a/b"), ("b", "b") ]
+
+@patch("mqfactory.tools.clock.now")
+def test_transport_failures_are_retried_until_sent(mocked_time, message):
+  from mqfactory.transport.loopback import Loopback, LoopbackTransport
+  mocked_time.return_value = 1000
+  broker    = Loopback()
+  transport = LoopbackTransport(broker)
+  received  = []
+  broker.subscribe(message.to, received.append)
+  mq = MessageQueue(transport, backoff=Backoff(attempts=2, delay=100))
+  mq.send(message.to, message.payload)
+  transport.disconnect()
+  for _ in range(10):
+    assert not mq.process_outbox()
+    mocked_time.return_value += 60000
+  msg = mq.outbox.all()[0]
+  assert not "attempts" in msg.private
+  assert len(mq.dead) == 0
+  transport.connect()
+  assert mq.process_outbox()
+  assert len(received) == 1
+  assert len(mq.outbox) == 0
+
+def test_bounded_dead_letters(transport):
+  mq = Bounded(MessageQueue(transport, backoff=Backoff(attempts=1)), dead=2)
+  def failing(msg):
+    raise ValueError("failing")
+  mq.before_sending.append(failing)
+  for payload in range(3): mq.send("to", payload)
+  mq.process_outbox(max_batch=3)
+  assert [ msg.payload for msg in mq.dead_letters() ] == [ 1, 2 ]
+
+def test_sending_while_processing_never_blocks(transport, message):
+  mq = Bounded(MessageQueue(transport), max_messages=1, overflow="block")
+  mq.send("somewhere", "filling the outbox")
+  def reply(msg):
+    mq.send("reply", "payload")
+  mq.on_message(message.to, reply)
+  to, store_to_inbox = transport.on_message.call_args[0]
+  store_to_inbox(message)
+  processing = Thread(target=mq.process_inbox)
+  processing.start()
+  processing.join(1)
+  assert not processing.is_alive()
+  assert len(mq.inbox) == 1   # failed, to be retried
+  assert len(mq.outbox) == 1
+
+def test_overlapping_subscriptions_all_handle_a_message():
+  from mqfactory.message.format.js  import JsonFormatting
+  from mqfactory.transport.loopback import Loopback, LoopbackTransport
+  broker   = Loopback()
+  sender   = JsonFormatting(MessageQueue(LoopbackTransport(broker)))
+  receiver = JsonFormatting(MessageQueue(LoopbackTransport(broker)))
+  handled  = []
+  receiver.on_message("sensors/#",      lambda msg: handled.append("all"))
+  receiver.on_message("sensors/+/temp", lambda msg: handled.append("temp"))
+  sender.send("sensors/1/temp", 21.5)
+  sender.process_outbox()
+  assert len(receiver.inbox) == 1
+  receiver.process_inbox()
+  assert handled == [ "all", "temp" ]
+
+@patch("mqfactory.tools.clock.now")
+def test_failing_handlers_are_retried_alone(mocked_time, transport, message):
+  mocked_time.return_value = 1000
+  mq = MessageQueue(transport)
+  handled = []
+  def failing(msg):
+    if not "failing" in handled:
+      handled.append("failing")
+      raise ValueError("failing")
+    handled.append("retried")
+  mq.on_message("#", lambda msg: handled.append("first"))
+  mq.on_message(message.to, failing)
+  mq.store_to_inbox(message)
+  assert not mq.process_inbox()
+  mocked_time.return_value = 2000
+  assert mq.process_inbox()
+  assert handled == [ "first", "failing", "retried" ]
@@ -79,3 +79,21 @@ def test_defer_exception_logging(mocked_logging, queue, collection, message):
   ms.after_defer(message)
   collection.update.assert_not_called()
   assert mocked_logging.error.called
+
+def test_batch_remove_and_defer(queue, collection, message):
+  ms = MessageStore(queue, collection)
+  messages = [ message, message.copy() ]
+  messages[0].private["store-id"] = 1
+  messages[1].private["store-id"] = 2
+  ms.after_remove_all(messages)
+  collection.remove_all.assert_called_with([1, 2])
+  ms.after_defer_all(messages)
+  collection.update_all.assert_called_with([
+    (1, dict(messages[0])), (2, dict(messages[1]))
+  ])
+
+def test_persisting_dead_letters(collection, transport, message):
+  mq = Persisting( MessageQueue(transport), dead=collection )
+  mq.dead.add(message)
+  assert collection.mock_calls[0] == call.load()
+  collection.add.assert_called_with(dict(message))
@@ -2,6 +2,8 @@ import copy
 import mongomock
 import pytest
 import pymongo
+from mock import Mock
+from pymongo import UpdateOne
 from bson.objectid import ObjectId 
 
 from mqfactory.store.mongo import MongoStore, MongoCollection
@@ -110,3 +112,34 @@ def test_updating_documents():
   col.update("id3", {"doc" : "something else"})
   doc = mongo.col.find_one({"_id" : "id3"}, {"_id": False})
   assert doc == {"doc" : "something else"}
+
+def test_batch_removing_documents():
+  mongo = mongomock.MongoClient().db
+  docs = [
+    { "doc" : "test 1" },
+    { "doc" : "test 2" },
+    { "doc" : "test 3", "_id" : "id3" }
+  ]
+  mongo.col.insert_many(copy.deepcopy(docs))
+  col = MongoCollection(mongo["col"])
+
+  loaded_docs = col.load()
+  col.remove_all([ loaded_docs[1]["_id"], "id3" ])
+  assert mongo.col.count_documents({}) == 1
+  doc = mongo.col.find_one({}, {"_id": False})
+  assert doc == {"doc" : "test 1"}
+
+def test_batch_updating_documents():
+  collection = Mock()
+  col = MongoCollection(collection)
+  id = ObjectId()
+  col.update_all([
+    (str(id), { "doc" : "updated 1" }),
+    ("id3",   { "doc" : "updated 3" })
+  ])
+  collection.bulk_write.assert_called_once()
+  operations = collection.bulk_write.call_args[0][0]
+  assert operations == [
+    UpdateOne({"_id" : id},    {"$set" : { "doc" : "updated 1" }}),
+    UpdateOne({"_id" : "id3"}, {"$set" : { "doc" : "updated 3" }})
+  ]
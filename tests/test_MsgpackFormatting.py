@@ -0,0 +1,77 @@
+import json
+import pytest
+
+msgpack = pytest.importorskip("msgpack")
+
+from mock import Mock
+
+from mqfactory                        import MessageQueue
+from mqfactory.message.format.js      import JsonFormatting
+from mqfactory.message.format.msgpack import serialize, unserialize
+from mqfactory.message.format.msgpack import MsgpackFormatting
+from mqfactory.transport.loopback     import Loopback, LoopbackTransport
+
+def test_serialize(message):
+  message.payload = { "data" : b"\x00\x01binary" }
+  serialize(message)
+  assert msgpack.unpackb(message.payload, raw=False) == {
+    "tags"    : { "id" : message.id },
+    "payload" : { "data" : b"\x00\x01binary" }
+  }
+
+def test_serialize_as_json_when_requested(message):
+  message.tags["content-type"] = "application/json"
+  initial_payload = message.payload
+  serialize(message)
+  assert json.loads(message.payload)["payload"] == initial_payload
+
+def test_unserialize_both_formats(message):
+  for encode in [ msgpack.packb, lambda raw: json.dumps(raw).encode("utf-8") ]:
+    message.payload = encode({
+      "tags"    : { "id" : "some id" },
+      "payload" : "payload"
+    })
+    unserialize(message)
+    assert message.payload == "payload"
+    assert message.tags    == { "id" : "some id" }
+
+def test_msgpack_formatting_installer(mq):
+  MsgpackFormatting(mq)
+  mq.transport.before_sending.append.assert_called()
+  mq.transport.after_receiving.append.assert_called()
+
+def test_mixed_fleet():
+  broker   = Loopback()
+  old      = JsonFormatting(MessageQueue(LoopbackTransport(broker)))
+  new      = MsgpackFormatting(MessageQueue(LoopbackTransport(broker)))
+  received = Mock()
+  new.on_message("new", received)
+  old.send("new", "from old")
+  old.process_outbox()
+  new.send("new", b"from new")
+  new.process_outbox()
+  new.process_inbox()
+  new.process_inbox()
+  payloads = [ args[0].payload for args, _ in received.call_args_list ]
+  assert payloads == [ "from old", b"from new" ]
+
+def test_signed_bytes_payloads(me):
+  from mqfactory.message.security      import Signing
+  from mqfactory.message.security.hmac import HmacSignature, generate_secret
+  keys     = { me : { "secret" : generate_secret() } }
+  broker   = Loopback()
+  sender   = MsgpackFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=HmacSignature(keys, me=me)
+  ))
+  receiver = MsgpackFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=HmacSignature(keys, me=me)
+  ))
+  received = Mock()
+  receiver.on_message("test", received)
+  sender.send("test", { "data" : b"\x00\x01binary", "b" : 1, "a" : [ 2 ] })
+  assert sender.process_outbox()
+  assert receiver.process_inbox()
+  (msg,), _ = received.call_args
+  assert msg.payload == { "data" : b"\x00\x01binary", "b" : 1, "a" : [ 2 ] }
+  assert msg.tags["content-type"] == "application/msgpack"
+  assert not "signature" in msg.tags
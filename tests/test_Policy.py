@@ -1,4 +1,11 @@
-from mqfactory.tools import Policy, Rule, CATCH_ALL
+import random
+from mock import patch
+
+import paho.mqtt.client as mqtt
+
+from mqfactory.message        import Message
+from mqfactory.tools          import Policy, Rule, CATCH_ALL, TopicTrie
+from mqfactory.transport.mqtt import TransportRule
 
 def test_empty_policy():
   p = Policy()
@@ -18,3 +25,94 @@ def test_policy():
   assert p.match({"a": 1, "b": 1, "c": 1}).value == "a=1,b=1,c=1"
   assert p.match({"a": 2, "b": 2, "c": 2}).value is None
   assert p.match({"d": 1}).value is None
+
+def linear(rules, instance):
+  return next((rule for rule in rules if rule.matches(instance)), CATCH_ALL)
+
+def test_compiled_policy_keeps_first_match_semantics():
+  random.seed(1)
+  rules = []
+  for i in range(200):
+    pattern = {}
+    if random.random() < 0.5: pattern["a"] = random.randint(0, 5)
+    if random.random() < 0.5: pattern["b"] = random.randint(0, 5)
+    if random.random() < 0.3:
+      pattern["to"] = random.choice([ "x/+", "x/#", "x/1", "+/2", "#" ])
+      rules.append(TransportRule(pattern, i))
+    else:
+      rules.append(Rule(pattern, i))
+  policy = Policy(rules)
+  for _ in range(500):
+    instance = { "to" : random.choice([ "x/1", "x/2", "y/2", "x" ]) }
+    if random.random() < 0.8: instance["a"] = random.randint(0, 5)
+    if random.random() < 0.8: instance["b"] = random.randint(0, 5)
+    assert policy.match(instance) is linear(rules, instance)
+
+def test_policy_matches_messages():
+  policy  = Policy([ Rule({ "to" : "a" }, "a"), TransportRule({ "to" : "b/#" }, "b") ])
+  assert policy.match(Message("a", "payload")).value == "a"
+  assert policy.match(Message("b/c", "payload")).value == "b"
+  assert policy.match(Message("c", "payload")).value is None
+
+def test_topic_policies_cache_results():
+  rule   = TransportRule({ "to" : "a/+" }, "a")
+  policy = Policy([ rule ])
+  with patch.object(TransportRule, "matches", wraps=rule.matches) as matches:
+    assert policy.match({ "to" : "a/b" }).value == "a"
+    assert policy.match({ "to" : "a/b" }).value == "a"
+  assert matches.call_count == 1
+
+def test_policies_with_other_keys_are_not_cached():
+  policy = Policy([ Rule({ "to" : "a", "b" : 1 }, "a") ])
+  assert policy.match({ "to" : "a", "b" : 1 }).value == "a"
+  assert policy.match({ "to" : "a", "b" : 2 }).value is None
+
+def test_added_rules_are_compiled():
+  policy = Policy([])
+  assert policy.match({ "a" : 1 }) is CATCH_ALL
+  policy.rules.append(Rule({ "a" : 1 }, "a"))
+  assert policy.match({ "a" : 1 }).value == "a"
+
+def test_replaced_rules_are_compiled():
+  policy = Policy([ Rule({ "to" : "a" }, "a") ])
+  assert policy.match({ "to" : "a" }).value == "a"
+  policy.rules[0] = Rule({ "to" : "a" }, "b")
+  assert policy.match({ "to" : "a" }).value == "b"
+
+def test_invalidated_rules_are_compiled():
+  rule   = Rule({ "to" : "a" }, "a")
+  policy = Policy([ rule ])
+  assert policy.match({ "to" : "a" }).value == "a"
+  rule.pattern = { "to" : "b" }
+  policy.invalidate()
+  assert policy.match({ "to" : "a" }) is CATCH_ALL
+  assert policy.match({ "to" : "b" }).value == "a"
+
+def test_topic_trie():
+  trie = TopicTrie()
+  for pattern in [ "a/b", "a/+", "a/#", "+/b", "#", "a/b/c", "$SYS/#" ]:
+    trie.add(pattern, pattern)
+  assert sorted(trie.match("a/b")) == sorted([ "a/b", "a/+", "a/#", "+/b", "#" ])
+  assert sorted(trie.match("a"))   == sorted([ "a/#", "#" ])
+  assert sorted(trie.match("a/b/c")) == sorted([ "a/#", "#", "a/b/c" ])
+  assert trie.match("$SYS/x") == [ "$SYS/#" ]
+  assert len(trie) == 7
+  assert trie.remove("a/b/c", "a/b/c")
+  assert not trie.remove("a/b/c", "a/b/c")
+  assert not "c" in trie.root.children["a"].children["b"].children
+  assert sorted(trie.match("a/b/c")) == sorted([ "a/#", "#" ])
+
+def test_topic_trie_agrees_with_paho():
+  random.seed(2)
+  levels   = [ "a", "b", "c" ]
+  patterns = set()
+  for _ in range(100):
+    pattern = [ random.choice(levels + [ "+" ]) for _ in range(random.randint(1, 3)) ]
+    if random.random() < 0.3: pattern.append("#")
+    patterns.add("/".join(pattern))
+  trie = TopicTrie()
+  for pattern in patterns: trie.add(pattern, pattern)
+  for _ in range(200):
+    topic = "/".join(random.choice(levels) for _ in range(random.randint(1, 4)))
+    assert sorted(trie.match(topic)) == \
+           sorted(p for p in patterns if mqtt.topic_matches_sub(p, topic))
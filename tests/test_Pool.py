@@ -0,0 +1,99 @@
+import pytest
+import time
+
+from threading import Event
+
+from mqfactory                    import MessageQueue, Pooled
+from mqfactory.message            import Message
+from mqfactory.message.format.js  import JsonFormatting
+from mqfactory.transport.loopback import Loopback, LoopbackTransport
+from mqfactory.transport.qos      import Acknowledging
+
+def deliver(mq, to, payload, tags=None):
+  store_to_inbox = [
+    handler for (topic, handler), _ in mq.transport.on_message.call_args_list \
+            if topic == to
+  ][0]
+  store_to_inbox(Message(to, payload, tags))
+
+def wait_until(condition, timeout=1.0):
+  end = time.time() + timeout
+  while not condition() and time.time() < end:
+    time.sleep(0.005)
+  return condition()
+
+def test_pooled_handling_keeps_order_per_topic(transport):
+  mq = Pooled(MessageQueue(transport), workers=4)
+  handled = { "a" : [], "b" : [] }
+  mq.on_message("a", lambda msg: handled["a"].append(msg.payload))
+  mq.on_message("b", lambda msg: handled["b"].append(msg.payload))
+
+  for i in range(20):
+    deliver(mq, "a", i)
+    deliver(mq, "b", i)
+  while mq.process_inbox(max_batch=8): pass
+
+  assert wait_until(lambda: len(mq.inbox) == 0)
+  assert handled["a"] == list(range(20))
+  assert handled["b"] == list(range(20))
+  mq.pool.stop()
+  mq.pool.join(1)
+
+def test_slow_handler_doesnt_block_other_topics(transport):
+  mq = Pooled(MessageQueue(transport), workers=2,
+              key=lambda msg: 0 if msg.to == "slow" else 1)
+  release = Event()
+  fast    = []
+  mq.on_message("slow", lambda msg: release.wait(1))
+  mq.on_message("fast", lambda msg: fast.append(msg))
+
+  deliver(mq, "slow", 1)
+  deliver(mq, "fast", 1)
+  mq.process_inbox(max_batch=2)
+
+  assert wait_until(lambda: len(fast) == 1)
+  assert mq.pool.stats() == { "workers" : 2, "depth" : 0, "busy" : 1 }
+  release.set()
+  assert wait_until(lambda: mq.pool.busy() == 0)
+
+def test_routing_on_tag(transport):
+  mq = Pooled(MessageQueue(transport), workers=8, key="session")
+  a = Message("x", None, { "session" : "a" })
+  b = Message("y", None, { "session" : "a" })
+  assert mq.pool.route(a) is mq.pool.route(b)
+
+def failing_handler(message):
+  if message.payload == "fail": raise ValueError("failing")
+
+def test_handling_in_process_pool(transport):
+  mq = Pooled(MessageQueue(transport), workers=2, processes=1)
+  mq.pool.on_message("topic", failing_handler)
+  deliver(mq, "topic", "ok")
+  deliver(mq, "topic", "fail")
+  mq.process_inbox(max_batch=2)
+
+  assert wait_until(lambda: len(mq.inbox) == 1, timeout=10)
+  assert wait_until(lambda: mq.pool.busy() == 0)
+  assert mq.inbox.all()[0].payload == "fail"
+  mq.pool.stop()
+
+def connected(broker, name):
+  mq = Acknowledging(MessageQueue(LoopbackTransport(broker), name=name))
+  return Pooled(JsonFormatting(mq), workers=2, processes=1)
+
+def test_acks_are_handled_in_process():
+  broker   = Loopback()
+  sender   = connected(broker, "sender")
+  receiver = connected(broker, "receiver")
+  receiver.pool.on_message("topic", failing_handler)
+  sender.send("topic", "ok")
+  sender.process_outbox()
+
+  receiver.process_inbox()
+  assert wait_until(lambda: len(receiver.outbox) == 1, timeout=10)
+  receiver.process_outbox()
+  sender.process_inbox()
+  assert wait_until(lambda: len(sender.outbox) == 0)
+  assert len(sender.dead) == 0
+  sender.pool.stop()
+  receiver.pool.stop()
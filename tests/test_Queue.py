@@ -1,10 +1,15 @@
 import pytest
 from mock import patch
 
-from time import time
+from time      import time
+from threading import Timer
 
 from mqfactory.message import Message
-from mqfactory.Queue   import Queue
+from mqfactory.Queue   import Queue, QueueFullException
+from mqfactory.Queue   import BLOCK, DROP_OLDEST, DROP_NEWEST
+from mqfactory.Queue   import LOW, NORMAL, HIGH
+from mqfactory.tools   import Hook, Policy
+from mqfactory.transport.mqtt import TransportRule
 
 @patch("mqfactory.tools.clock.now")
 def test_adding_messages_with_last_timestamp(mocked_time):
@@ -202,3 +207,224 @@ def test_aspects():
   assert tracked[13:] == [
     ("before_get",    None)
   ]
+
+@patch("mqfactory.tools.clock.now")
+def test_next_skips_removed_and_rescheduled_messages(mocked_time):
+  mocked_time.side_effect = range(1, 1000)
+
+  queue = Queue()
+  messages = [ Message(str(i), str(i), id=i) for i in range(100) ]
+  for message in messages:
+    queue.add(message)
+
+  for message in messages[:50]:
+    queue.remove(message)
+  assert next(queue) == messages[50]
+
+  for message in messages[50:75]:
+    queue.defer(message)
+  assert next(queue) == messages[75]
+
+  for message in messages[75:]:
+    queue.remove(message)
+  assert next(queue) == messages[50]
+  assert len(queue.lanes[NORMAL]) <= 2 * len(queue) + 64
+
+def test_readding_a_message_reschedules_it():
+  queue = Queue()
+  message = Message("1", "1", id=1)
+  queue.add(message)
+  queue.add(message)
+  queue.remove(message)
+  with pytest.raises(StopIteration):
+    next(queue)
+
+@patch("mqfactory.tools.clock.now")
+def test_deferring_messages_until_they_are_due(mocked_time):
+  mocked_time.return_value = 1
+
+  queue = Queue()
+  messages = [
+    Message("1", "1", id=1),
+    Message("2", "2", id=2)
+  ]
+  queue.add(messages[0])
+  queue.add(messages[1])
+
+  queue.defer(messages[0], until=100)
+  assert next(queue) == messages[1]
+  queue.defer(messages[1], until=50)
+  assert queue.due() == 50
+
+  with pytest.raises(StopIteration):
+    next(queue)
+
+  mocked_time.return_value = 50
+  assert next(queue) == messages[1]
+  queue.remove(messages[1])
+  with pytest.raises(StopIteration):
+    next(queue)
+
+  mocked_time.return_value = 100
+  assert next(queue) == messages[0]
+
+  queue.defer(messages[0])
+  assert queue.due() == 100
+  queue.remove(messages[0])
+  assert queue.due() is None
+
+@patch("mqfactory.tools.clock.now")
+def test_taking_messages(mocked_time):
+  mocked_time.return_value = 1
+
+  queue = Queue()
+  messages = [ Message(str(i), str(i), id=i) for i in range(5) ]
+  for message in messages:
+    queue.add(message)
+  queue.defer(messages[0], until=10)
+
+  taken = queue.take(3)
+  assert taken == messages[1:4]
+  assert queue.take(3) == [ messages[4] ]
+  assert queue.take(3) == []
+  assert len(queue) == 5
+
+  queue.release(messages[1])
+  queue.remove_all(taken[1:])
+  assert len(queue) == 3
+  assert queue.take(3) == [ messages[1] ]
+
+  queue.defer_all([ (messages[1], 5), (messages[4], None) ])
+  assert queue.take(3) == [ messages[4] ]
+  mocked_time.return_value = 10
+  assert queue.take(3) == [ messages[1], messages[0] ]
+
+def test_batch_aspects():
+  tracked = []
+  def track(aspect):
+    def tracker(message):
+      tracked.append( (aspect, message) )
+    return tracker
+  def track_all(aspect):
+    def tracker(messages):
+      tracked.append( (aspect, messages) )
+    return tracker
+
+  queue = Queue()
+  queue.before_remove.append(track("before_remove"))
+  queue.after_remove.append(Hook(track("after_remove"), track_all("after_remove_all")))
+
+  messages = [ Message(str(i), str(i), id=i) for i in range(2) ]
+  for message in messages:
+    queue.add(message)
+
+  assert queue.remove_all(messages) == []
+  assert tracked == [
+    ("before_remove",    messages[0]),
+    ("before_remove",    messages[1]),
+    ("after_remove_all", messages)
+  ]
+
+def test_bounded_queue_raises_when_full():
+  queue = Queue(max_messages=2)
+  queue.add(Message("1", "1", id=1))
+  queue.add(Message("2", "2", id=2))
+  with pytest.raises(QueueFullException):
+    queue.add(Message("3", "3", id=3))
+  assert len(queue) == 2
+
+def test_bounded_queue_by_bytes():
+  queue = Queue(max_bytes=10)
+  queue.add(Message("1", "12345", id=1))
+  queue.add(Message("2", "12345", id=2))
+  with pytest.raises(QueueFullException):
+    queue.add(Message("3", "1", id=3))
+  queue.remove(queue[1])
+  assert queue.bytes == 5
+  queue.add(Message("3", "1", id=3))
+  assert queue.bytes == 6
+
+def test_bounded_queue_drops_oldest_or_newest():
+  queue = Queue(max_messages=2, overflow=DROP_OLDEST)
+  messages = [ Message(str(i), str(i), id=i) for i in range(4) ]
+  for message in messages[:3]:
+    queue.add(message)
+  assert queue.all() == messages[1:3]
+  assert queue.take() == [ messages[1] ]   # in flight, won't be dropped
+  queue.add(messages[3])
+  assert queue.all() == [ messages[1], messages[3] ]
+
+  queue = Queue(max_messages=2, overflow=DROP_NEWEST)
+  for message in messages[:2]:
+    assert queue.add(message)
+  assert not queue.add(messages[2])
+  assert queue.all() == messages[:2]
+
+def test_bounded_queue_blocks_until_room():
+  queue = Queue(max_messages=1, overflow=BLOCK, timeout=0.05)
+  messages = [ Message(str(i), str(i), id=i) for i in range(2) ]
+  queue.add(messages[0])
+  with pytest.raises(QueueFullException):
+    queue.add(messages[1])
+
+  remover = Timer(0.05, queue.remove, [ messages[0] ])
+  remover.start()
+  assert queue.add(messages[1], timeout=1)
+  assert queue.all() == [ messages[1] ]
+
+def test_watermarks():
+  tracked = []
+  queue = Queue(high=3, low=1)
+  queue.on_high.append(lambda q: tracked.append(("high", len(q))))
+  queue.on_low.append(lambda q: tracked.append(("low", len(q))))
+  messages = [ Message(str(i), str(i), id=i) for i in range(4) ]
+  for message in messages:
+    queue.add(message)
+  assert tracked == [ ("high", 3) ]
+  queue.remove_all(messages[:2])
+  assert tracked == [ ("high", 3) ]
+  queue.remove(messages[2])
+  assert tracked == [ ("high", 3), ("low", 1) ]
+
+def test_strict_priority_lanes():
+  queue = Queue()
+  bulk    = [ Message("bulk", i, id=i) for i in range(3) ]
+  control = Message("control", "ack", { "priority" : HIGH }, id="c")
+  low     = Message("low", "low", { "priority" : LOW }, id="l")
+  queue.add(low)
+  for message in bulk:
+    queue.add(message)
+  queue.add(control)
+  assert next(queue) == control
+  assert queue.take(5) == [ control ] + bulk + [ low ]
+
+@patch("mqfactory.tools.clock.now")
+def test_lanes_skip_messages_that_arent_due(mocked_time):
+  mocked_time.return_value = 1
+  queue = Queue()
+  control = Message("control", "ack", { "priority" : HIGH }, id="c")
+  bulk    = Message("bulk", "bulk", id="b")
+  queue.add(control)
+  queue.add(bulk)
+  queue.defer(control, until=10)
+  assert next(queue) == bulk
+  assert queue.due() == 1
+
+def test_priority_policy():
+  queue = Queue()
+  queue.prioritize(policy=Policy([ TransportRule({"to" : "control/#"}, HIGH) ]))
+  bulk    = Message("data/1", "bulk", id="b")
+  control = Message("control/ack", "ack", id="c")
+  queue.add(bulk)
+  queue.add(control)
+  assert queue.take(2) == [ control, bulk ]
+
+def test_weighted_fair_lanes():
+  queue = Queue()
+  queue.prioritize(weights={ HIGH : 3, NORMAL : 1 })
+  for i in range(8):
+    queue.add(Message("bulk", i, id="b{0}".format(i)))
+    queue.add(Message("control", i, { "priority" : HIGH }, id="c{0}".format(i)))
+  taken = [ message.to for message in queue.take(8) ]
+  assert taken.count("control") == 6
+  assert taken.count("bulk") == 2
@@ -1,6 +1,7 @@
 import pytest
 
 import base64
+from mock import Mock, patch
 
 from cryptography.exceptions import InvalidSignature
 
@@ -59,3 +60,72 @@ def test_failing_validation(message, keys, me):
   message.payload = message.payload + "something bad"
   with pytest.raises(InvalidSignature):
     signer.validate(message)
+
+def test_decoded_keys_are_cached(keys, me):
+  collection = Mock(wraps=keys)
+  collection.__getitem__ = Mock(side_effect=keys.__getitem__)
+  decoded = Decoded(collection)
+  assert decoded[me] is decoded[me]
+  assert collection.__getitem__.call_count == 1
+  assert decoded.stats() == { "hits" : 1, "misses" : 1, "size" : 1 }
+
+def test_only_public_keys_are_needed(keys, me):
+  decoded = Decoded({ me : { "public" : keys[me]["public"] } })
+  assert encode(decoded[me]["public"]) == keys[me]["public"]
+
+def test_unknown_keys_are_cached(keys):
+  collection = Mock()
+  collection.__getitem__ = Mock(return_value=None)
+  decoded = Decoded(collection)
+  for _ in range(2):
+    with pytest.raises(KeyError):
+      decoded["unknown"]
+  assert collection.__getitem__.call_count == 1
+  assert decoded.misses == 1 and decoded.hits == 1
+
+@patch("mqfactory.tools.clock.now")
+def test_cached_keys_expire(now, keys, me):
+  now.return_value = 0
+  decoded = Decoded(keys, ttl=1000, negative_ttl=10)
+  key = decoded[me]
+  with pytest.raises(KeyError):
+    decoded["unknown"]
+  now.return_value = 500
+  assert decoded[me] is key
+  keys["unknown"] = keys[me]
+  decoded["unknown"]
+  now.return_value = 1500
+  assert not decoded[me] is key
+
+@patch("mqfactory.tools.clock.now")
+def test_keys_added_after_a_miss_are_picked_up(now, keys, me):
+  now.return_value = 0
+  known   = keys[me]
+  keys    = { }
+  decoded = Decoded(keys)
+  with pytest.raises(KeyError):
+    decoded["new"]
+  keys["new"] = known
+  now.return_value = 4999
+  with pytest.raises(KeyError):
+    decoded["new"]
+  now.return_value = 5000
+  assert "public" in decoded["new"]
+
+def test_least_recently_used_keys_are_evicted(keys, me):
+  keys["other"] = keys[me]
+  keys["third"] = keys[me]
+  decoded = Decoded(keys, size=2)
+  decoded[me]
+  decoded["other"]
+  decoded[me]
+  decoded["third"]
+  assert list(decoded.cache) == [ me, "third" ]
+
+def test_invalidation(keys, me):
+  decoded = Decoded(keys)
+  key = decoded[me]
+  decoded.invalidate(me)
+  assert not decoded[me] is key
+  decoded.invalidate()
+  assert decoded.stats()["size"] == 0
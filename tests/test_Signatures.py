@@ -0,0 +1,224 @@
+import pytest
+from mock import Mock, patch
+from functools import partial
+
+from cryptography.exceptions import InvalidSignature
+
+from mqfactory                          import MessageQueue
+from mqfactory.message                  import Message
+from mqfactory.message.format.js        import JsonFormatting
+from mqfactory.message.security         import Signing, Offloaded, merkle
+from mqfactory.transport.loopback       import Loopback, LoopbackTransport
+from mqfactory.message.security.keys    import encode
+from mqfactory.message.security.rsa     import RsaSignature
+from mqfactory.message.security.ed25519 import Ed25519Signature
+from mqfactory.message.security.hmac    import HmacSignature, generate_secret
+from mqfactory.message.security.hmac    import Secrets
+from mqfactory.message.security         import rsa, ed25519
+from mqfactory.tools                    import Policy, Rule
+
+def pem_keys(module):
+  def generate(me):
+    private, public = module.generate_key_pair()
+    return { me : { "private" : encode(private), "public" : encode(public) } }
+  return generate
+
+def secret_keys(me):
+  return { me : { "secret" : generate_secret() } }
+
+SIGNATURES = [
+  (RsaSignature,     pem_keys(rsa)),
+  (Ed25519Signature, pem_keys(ed25519)),
+  (HmacSignature,    secret_keys)
+]
+
+@pytest.fixture(params=SIGNATURES, ids=lambda s: s[0].__name__)
+def signer(request, me):
+  signature, generate = request.param
+  return signature(generate(me), me=me)
+
+def test_signing_and_validation(signer, message, me):
+  signer.sign(message, ts="now")
+  signature = message.tags["signature"]
+  assert signature["origin"] == me
+  assert signature["ts"]     == "now"
+  assert isinstance(signature["hash"], str)
+  message.private.pop("canonical")   # validate without received encoding
+  signer.validate(message)
+  assert not "signature" in message.tags
+
+def test_failing_validation(signer, message):
+  signer.sign(message)
+  message.private.pop("canonical")
+  message.payload = message.payload + "something bad"
+  with pytest.raises(InvalidSignature):
+    signer.validate(message)
+
+def test_unknown_origin(signer, message):
+  signer.sign(message)
+  message.tags["signature"]["origin"] = "unknown"
+  with pytest.raises(KeyError):
+    signer.validate(message)
+
+def test_policy(signer):
+  signer.policy = Policy([ Rule({"to": "unsigned"}, False) ])
+  message = Message("unsigned", "payload")
+  assert signer.sign(message) == False
+  assert not "signature" in message.tags
+
+def test_hmac_secrets_can_be_text(message, me):
+  signer = HmacSignature({ me : { "secret" : "shared" } }, me=me)
+  signer.sign(message)
+  HmacSignature({ me : { "secret" : b"shared" } }, me=me).validate(message)
+
+def test_hmac_secrets_are_cached(me):
+  keys       = secret_keys(me)
+  collection = Mock()
+  collection.__getitem__ = Mock(side_effect=keys.__getitem__)
+  signer     = HmacSignature(collection, me=me)
+  for i in range(3):
+    message = Message("to", "payload {0}".format(i))
+    signer.sign(message)
+    signer.validate(message)
+  assert collection.__getitem__.call_count == 1
+
+def test_unknown_hmac_secrets_raise_key_errors():
+  collection = Mock()
+  collection.__getitem__ = Mock(return_value=None)
+  with pytest.raises(KeyError):
+    Secrets(collection)["unknown"]
+
+@pytest.mark.parametrize("count", [ 1, 2, 3, 5, 8 ])
+def test_merkle_proofs_lead_to_root(count):
+  leaves = [ merkle.leaf(str(i).encode("ascii")) for i in range(count) ]
+  root, proofs = merkle.tree(leaves)
+  for leaf, proof in zip(leaves, proofs):
+    assert merkle.root(leaf, proof) == root
+  if count > 1:
+    assert merkle.root(leaves[0], proofs[1]) != root
+
+@pytest.fixture(params=SIGNATURES, ids=lambda s: s[0].__name__)
+def batch_signer(request, me):
+  signature, generate = request.param
+  return signature(generate(me), me=me, batch=True)
+
+def test_batch_signing_signs_root_once(batch_signer):
+  messages = [ Message("to", "payload {0}".format(i)) for i in range(5) ]
+  with patch.object(batch_signer, "signed", wraps=batch_signer.signed) as signed:
+    assert batch_signer.sign_all(messages) == []
+  assert signed.call_count == 1
+  roots = set(message.tags["signature"]["hash"]["root"] for message in messages)
+  assert len(roots) == 1
+  with patch.object(batch_signer, "verify", wraps=batch_signer.verify) as verify:
+    for message in messages:
+      message.private.pop("canonical")
+      batch_signer.validate(message)
+      assert not "signature" in message.tags
+  assert verify.call_count == 1
+
+def test_batch_signing_detects_tampering(batch_signer):
+  messages = [ Message("to", "payload {0}".format(i)) for i in range(3) ]
+  batch_signer.sign_all(messages)
+  messages[0].private.pop("canonical")
+  batch_signer.validate(messages[0])
+  messages[1].private.pop("canonical")
+  messages[1].payload = "tampered"
+  with pytest.raises(InvalidSignature):
+    batch_signer.validate(messages[1])
+
+def test_batch_signing_respects_policy(batch_signer):
+  batch_signer.policy = Policy([ Rule({"to": "unsigned"}, False) ])
+  messages = [ Message("unsigned", "payload"), Message("to", "payload"),
+               Message("to", "other") ]
+  batch_signer.sign_all(messages)
+  assert not "signature" in messages[0].tags
+  assert "proof" in messages[1].tags["signature"]["hash"]
+
+def test_batch_signing_fails_only_unencodable_messages(batch_signer):
+  messages = [ Message("to", "good 1"), Message("to", set([ 1, 2 ])),
+               Message("to", "good 2") ]
+  failed = batch_signer.sign_all(messages)
+  assert [ message for message, _ in failed ] == [ messages[1] ]
+  assert isinstance(failed[0][1], TypeError)
+  assert not "signature" in messages[1].tags
+  for message in [ messages[0], messages[2] ]:
+    message.private.pop("canonical")
+    batch_signer.validate(message)
+
+def test_batches_over_the_wire(me):
+  keys     = secret_keys(me)
+  broker   = Loopback()
+  sender   = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)),
+    adding=HmacSignature(keys, me=me, batch=True)
+  ))
+  receiver = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=HmacSignature(keys, me=me)
+  ))
+  handler = Mock()
+  receiver.on_message("test", handler)
+  for i in range(4): sender.send("test", { "index" : i })
+  sender.process_outbox(max_batch=4)
+  receiver.process_inbox(max_batch=4)
+  indices = [ args[0].payload["index"] for args, _ in handler.call_args_list ]
+  assert indices == [ 0, 1, 2, 3 ]
+
+def test_offloaded_signing_and_validation_in_threads(signer):
+  offloaded = Offloaded(signer, workers=2)
+  messages  = [ Message("to", "payload {0}".format(i)) for i in range(6) ]
+  assert offloaded.sign_all(messages) == []
+  assert all("signature" in message.tags for message in messages)
+  messages[2].private.pop("canonical")
+  messages[2].payload = "tampered"
+  failed = offloaded.validate_all(messages)
+  assert [ message for message, _ in failed ] == [ messages[2] ]
+  assert isinstance(failed[0][1], InvalidSignature)
+  assert [ "signature" in message.tags for message in messages ] == \
+         [ False, False, True, False, False, False ]
+  offloaded.stop()
+
+def test_offloaded_signing_in_processes(me):
+  keys      = secret_keys(me)
+  factory   = partial(HmacSignature, keys, me=me, batch=True)
+  offloaded = Offloaded(factory(), workers=2, processes=True, factory=factory)
+  messages  = [ Message("to", "payload {0}".format(i)) for i in range(4) ]
+  assert offloaded.sign_all(messages) == []
+  assert "proof" in messages[0].tags["signature"]["hash"]
+  for message in messages: message.private.pop("canonical")
+  assert offloaded.validate_all(messages) == []
+  assert not any("signature" in message.tags for message in messages)
+  messages = [ Message("to", "good"), Message("to", set([ 1, 2 ])) ]
+  failed = offloaded.sign_all(messages)
+  assert [ message for message, _ in failed ] == [ messages[1] ]
+  assert "proof" in messages[0].tags["signature"]["hash"]
+  message = Message("to", "single")
+  offloaded.sign(message)
+  offloaded.validate(message)
+  assert message.tags == { "id" : message.id }
+  offloaded.stop()
+
+def test_offloaded_signing_setup(mq, signature):
+  Signing(mq, adding=signature, workers=2)
+  assert isinstance(mq.signature, Offloaded)
+  assert mq.signature.signature is signature
+  mq.signature.stop()
+
+def test_payload_appended_after_hash_is_rejected(me):
+  keys     = secret_keys(me)
+  broker   = Loopback()
+  sender   = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=HmacSignature(keys, me=me)
+  ))
+  receiver = JsonFormatting(Signing(
+    MessageQueue(LoopbackTransport(broker)), adding=HmacSignature(keys, me=me)
+  ))
+  handler = Mock()
+  receiver.on_message("test", handler)
+  def inject(message):
+    message.payload = message.payload[:-1] + b',"payload":"injected"}'
+  sender.transport.before_sending.append(inject)
+  sender.send("test", "payload")
+  sender.process_outbox()
+  receiver.process_inbox()
+  handler.assert_not_called()
+  assert len(receiver.inbox) == 0
@@ -0,0 +1,45 @@
+import json
+
+from mqfactory import bench
+
+def test_stack_suite_measures_all_combinations():
+  results = bench.stack(3)
+  assert sorted(results) == sorted(name for name, _ in bench.STACKS)
+  for result in results.values():
+    assert result["messages"] == 3
+    assert result["msgs_per_s"] > 0
+    assert result["p50_ms"] <= result["p99_ms"]
+
+def test_message_suite_measures_all_generators():
+  results = bench.message(100)
+  assert sorted(results) == sorted(name for name, _ in bench.GENERATORS)
+  for result in results.values():
+    assert result["bytes_per_msg"] > 0
+
+def test_percentile():
+  assert bench.percentile([], 50) is None
+  assert bench.percentile([ 3, 1, 2 ], 50) == 2
+  assert bench.percentile(list(range(1, 101)), 99) == 99
+
+def test_json_output(tmpdir):
+  output = str(tmpdir.join("results.json"))
+  bench.main([ "queue", "--messages", "10", "--output", output ])
+  with open(output) as fp:
+    results = json.load(fp)
+  assert "python" in results
+  assert sorted(results["results"]["queue"]) == sorted(
+    [ "10", "100", "1000", "10000", "100000" ]
+  )
+
+def test_backends_suite_compares_available_backends():
+  results = bench.backends(10)
+  assert "json" in results
+  for shapes in results.values():
+    assert sorted(shapes) == sorted(bench.SHAPES)
+
+def test_signatures_suite_measures_all_signatures():
+  results = bench.signatures(2)
+  assert sorted(results) == sorted(name for name, _ in bench.SIGNATURES)
+
+def test_policy_suite_compares_matchers():
+  assert sorted(bench.policy(10)) == [ "cached", "compiled", "linear" ]